@@ -0,0 +1,205 @@
+"""
+ASGI entry point for pro1 project.
+
+Django 1.11 没有异步视图，这里把WSGI应用包装成ASGI应用，例如：
+
+    uvicorn pro1.asgi:application
+
+视图（查询数据库，检查权限）仍然在线程池中同步执行，但只在需要时占用线程：
+
+- 请求体先异步接收到临时文件中（小的在内存中），接收完成后才交给Django，
+  慢速的上传不占用线程
+- 响应体每次在线程池中读取一块（STREAM_BLOCK_SIZE），然后异步发送，
+  等待慢速的客户端接收时不占用线程
+- 客户端断开后立即停止读取文件
+- POST/PUT请求在接收请求体之前交给 ASGI_ADMISSION 检查，
+  例如超过配额的上传直接返回413，不接收请求体
+
+所以一个进程可以同时进行大量的慢速传输，线程数（ASGI_THREADS）
+只需要与同时执行的视图数量相当。
+"""
+
+import os
+import sys
+import asyncio
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pro1.settings')
+
+from django.conf import settings  # noqa: E402
+from django.core.wsgi import get_wsgi_application  # noqa: E402
+from django.utils.module_loading import import_string  # noqa: E402
+
+
+class FileWrapper:
+    """
+    提供给Django的 wsgi.file_wrapper，文件响应按照块大小读取，
+    而不是使用 StreamingHttpResponse 的迭代器
+    """
+
+    def __init__(self, filelike, block_size=None):
+        self.filelike = filelike
+        self.block_size = block_size or settings.STREAM_BLOCK_SIZE
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.filelike.read(self.block_size)
+        if data:
+            return data
+        raise StopIteration
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+
+class AsgiHandler:
+
+    def __init__(self, wsgi_app, executor=None):
+        self.wsgi_app = wsgi_app
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=getattr(settings, 'ASGI_THREADS', 32))
+        self.memory_size = getattr(settings, 'ASGI_BODY_MEMORY', 1024 * 1024)
+        admission = getattr(settings, 'ASGI_ADMISSION', None)
+        self.admit = import_string(admission) if admission else None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError('unsupported scope type: %s' % scope['type'])
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, func, *args)
+
+    def encode_headers(self, headers):
+        return [(k.lower().encode('latin1'), v.encode('latin1'))
+                for k, v in headers]
+
+    async def http(self, scope, receive, send):
+        if self.admit is not None and scope['method'] in ('POST', 'PUT'):
+            refused = await self.run(self.admit, self.environ(scope, None))
+            if refused is not None:
+                status, headers, content = refused
+                headers = headers + [('Content-Length', str(len(content)))]
+                await send({'type': 'http.response.start', 'status': status,
+                            'headers': self.encode_headers(headers)})
+                await send({'type': 'http.response.body', 'body': content})
+                return
+
+        # 异步接收整个请求体
+        body = SpooledTemporaryFile(max_size=self.memory_size)
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return
+            chunk = message.get('body', b'')
+            if chunk:
+                size += len(chunk)
+                # 超过内存的限制后会写到磁盘上，在线程池中写
+                if size > self.memory_size:
+                    await self.run(body.write, chunk)
+                else:
+                    body.write(chunk)
+            if not message.get('more_body', False):
+                break
+        body.seek(0)
+
+        # 客户端断开连接时停止发送
+        disconnected = asyncio.Event()
+
+        async def watch():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch())
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = self.encode_headers(headers)
+
+        environ = self.environ(scope, body)
+        # 分块传输的请求没有Content-Length，Django需要它读取请求体
+        environ.setdefault('CONTENT_LENGTH', str(size))
+        result = await self.run(self.wsgi_app, environ, start_response)
+        try:
+            await send({'type': 'http.response.start',
+                        'status': response['status'],
+                        'headers': response['headers']})
+            iterator = iter(result)
+            while not disconnected.is_set():
+                chunk = await self.run(next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk,
+                                'more_body': True})
+            if not disconnected.is_set():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            watcher.cancel()
+            if hasattr(result, 'close'):
+                await self.run(result.close)
+            body.close()
+
+    def environ(self, scope, body):
+        """根据ASGI的scope生成WSGI的environ"""
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        path = scope['path']
+        root = scope.get('root_path', '')
+        if root and path.startswith(root):
+            path = path[len(root):]
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root.encode('utf8').decode('latin1'),
+            'PATH_INFO': path.encode('utf8').decode('latin1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'REMOTE_ADDR': client[0],
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1').upper().replace('-', '_')
+            value = value.decode('latin1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name == 'CONTENT_LENGTH':
+                environ['CONTENT_LENGTH'] = value
+            else:
+                key = 'HTTP_' + name
+                if key in environ:
+                    value = environ[key] + ',' + value
+                environ[key] = value
+        return environ
+
+
+application = AsgiHandler(get_wsgi_application())
@@ -41,11 +41,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'share.metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'share.middleware.ShareStateMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'share.quota.QuotaMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -70,14 +73,40 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'pro1.wsgi.application'
 
+# ASGI部署（pro1/asgi.py）：执行视图的线程数，请求体在内存中保存的上限，
+# 超过时写入临时文件
+ASGI_THREADS = 32
+ASGI_BODY_MEMORY = 1024 * 1024
+# 接收请求体之前调用的函数，可以直接拒绝请求（例如超过配额的上传）
+ASGI_ADMISSION = 'share.quota.admit'
+
 
 # Database
 # https://docs.djangoproject.com/en/1.11/ref/settings/#databases
 
+# pro1.sqlite 是针对并发访问调整的SQLite后端（见 pro1/sqlite/base.py）：
+# WAL模式下读写互不阻塞，写事务在开始时取得写锁，
+# 并发的写操作按照timeout（秒）排队等待，而不是出错
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'pro1.sqlite',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # 保持连接，不必每个请求都重新打开数据库和设置PRAGMA
+        'CONN_MAX_AGE': 600,
+        'OPTIONS': {
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+            'pragmas': {
+                'journal_mode': 'WAL',
+                # WAL模式下NORMAL只在检查点时同步，断电可能丢失
+                # 最近的事务，但不会损坏数据库
+                'synchronous': 'NORMAL',
+                'mmap_size': 256 * 1024 * 1024,
+                # 负数的单位是KB
+                'cache_size': -64 * 1024,
+                'temp_store': 'MEMORY',
+            },
+        },
     }
 }
 
@@ -125,3 +154,110 @@ LOGIN_URL = '/share/login/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 API_LOGIN_URL = '/share/api/inform_login/'
+
+# 文件的存储布局：fanout（按校验和分级目录）或 daily（按上传日期分目录）
+STORAGE_LAYOUT = 'fanout'
+# fanout布局中每一级目录名取校验和的字符数
+STORAGE_FANOUT = (2, 2)
+
+# 存储后端及其参数，例如：
+# STORAGE_BACKEND = 'share.storage.ShardedStorage'
+# STORAGE_OPTIONS = {'volumes': ['/data1/media', '/data2/media']}
+# STORAGE_BACKEND = 'share.storage.S3Storage'
+# STORAGE_OPTIONS = {'endpoint': 'http://127.0.0.1:9000', 'bucket': 'share',
+#                    'access_key': '...', 'secret_key': '...'}
+STORAGE_BACKEND = 'share.storage.LocalStorage'
+STORAGE_OPTIONS = {}
+# 对象存储（S3Storage）的请求超时（秒），也可以在STORAGE_OPTIONS中用timeout指定
+STORAGE_TIMEOUT = 30
+
+# 压缩存储：压缩方式（gzip，zstd，None表示不压缩），
+# 需要压缩的MIME类型，试压缩的样本大小，压缩后与原大小的比例上限，
+# 以及压缩的文件的大小上限（压缩的文件定位到中间需要从头解压，更大的文件不压缩）
+COMPRESSION_CODEC = 'gzip'
+COMPRESSION_MIMETYPES = [r'^text/', r'^application/(json|xml|javascript)$',
+                         r'^image/svg\+xml$']
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_MIN_RATIO = 0.8
+COMPRESSION_MAX_SIZE = 16 * 1024 * 1024
+
+# 缩略图的尺寸（像素）及生成缩略图的线程数
+THUMBNAIL_SIZES = (64, 256)
+THUMBNAIL_WORKERS = 2
+
+# 文本预览：默认窗口大小，最大窗口大小，行偏移索引的间隔行数
+PREVIEW_WINDOW = 64 * 1024
+PREVIEW_MAX_WINDOW = 1024 * 1024
+PREVIEW_INDEX_STEP = 1000
+
+# 预先生成的验证码的数量，及每个验证码的最长保留时间（秒）
+CAPTCHA_POOL_SIZE = 200
+CAPTCHA_MAX_AGE = 600
+
+# 发送文件时每次读取的数据量，服务器提供 wsgi.file_wrapper 时由服务器发送
+STREAM_BLOCK_SIZE = 256 * 1024
+
+# 匿名共享文件的热点缓存（每个进程一份）：缓存项数，缓存的文件内容的总量，
+# 连同内容一起缓存的文件的大小上限（存储的大小），缓存项的有效时间（秒），
+# 各个进程共享版本号的缓存（共享或文件记录有变化时所有进程的缓存项都失效）
+HOT_CACHE_ENTRIES = 1024
+HOT_CACHE_BYTES = 64 * 1024 * 1024
+HOT_CACHE_BLOB_LIMIT = 256 * 1024
+HOT_CACHE_TTL = 30
+HOT_CACHE_VERSION_CACHE = 'hot'
+
+# 进程间共享的状态（验证码的答案及其使用记录）放在 share_state 缓存中，
+# 默认使用数据库中的缓存表（测试时自动创建，部署时运行 manage.py createcachetable），
+# 不需要额外的服务；有memcached时可以换成memcached。
+# default 是每个进程一份的内存缓存，只能存放各个进程自己的数据。
+# hot 是本机所有进程共享的文件缓存，只存放热点缓存的版本号（hotcache.py），
+# 部署在多台机器上时换成memcached
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'share_state': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'share_state_cache',
+    },
+    'hot': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'hot'),
+    },
+}
+
+# 匿名访问的状态（验证码的键，已验证的共享）的存储方式，都不访问数据库中的session：
+# cookie（签名后存放在cookie中，客户端可以读取，也可以重发旧的cookie，
+# 只能用于不需要保密的状态）或者 cache（存放在SHARE_STATE_CACHE中，
+# 需要是进程间共享的缓存）。
+# 验证码的答案总是保存在SHARE_STATE_CACHE中，cookie中只有随机的键
+SHARE_STATE_STORE = 'cookie'
+SHARE_STATE_CACHE = 'share_state'
+SHARE_STATE_COOKIE_NAME = 'share_state'
+SHARE_STATE_MAX_AGE = 24 * 3600
+SHARE_STATE_MAX_APPROVALS = 32
+
+# 运行指标（/share/metrics/），除管理员外只允许这些地址访问
+METRICS_ALLOWED_IPS = ['127.0.0.1']
+
+# 每个请求的统计以JSON的格式记录到 share.requests 日志中（INFO级别），
+# 需要时把下面的level改为INFO
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'share.requests': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
+}
+
+# 每个用户的配额（share/quota.py）：实际占用的字节数和文件数，
+# None表示不限制，可以在Usage中为单个用户另外设置
+QUOTA_BYTES = 10 * 1024 ** 3
+QUOTA_FILES = 1000000
@@ -0,0 +1,33 @@
+"""
+针对并发访问调整的SQLite后端，在 DATABASES 的 OPTIONS 中设置：
+
+    pragmas             每个新的连接执行的PRAGMA，例如WAL模式，
+                        synchronous=NORMAL，mmap_size，cache_size
+    transaction_mode    事务开始的方式：DEFERRED（SQLite的默认），
+                        IMMEDIATE 或者 EXCLUSIVE
+
+默认的DEFERRED事务先读后写时，如果其它连接已经取得了写锁，
+SQLite会立即返回 "database is locked"，不会等待 busy timeout。
+IMMEDIATE在事务开始时就取得写锁，需要时按照timeout等待，
+写操作的事务依次执行。
+"""
+
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        self.pragmas = params.pop('pragmas', {})
+        self.transaction_mode = params.pop('transaction_mode', 'DEFERRED')
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute('PRAGMA %s = %s' % (name, value)).fetchall()
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN %s' % self.transaction_mode)
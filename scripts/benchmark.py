@@ -0,0 +1,384 @@
+"""
+热点路径的性能测试
+
+测试的操作：list_dir，api ls -l，api mkdir -p，search，detail（匿名访问，
+需要查找父目录的共享），upload，download。每个操作记录延迟的p50/p99，
+每个请求的数据库查询次数，以及传输速度（MB/s），结果保存为JSON，
+可以与其它提交的结果比较。
+
+两种运行方式：
+
+1. 进程内（默认）：使用Django的测试客户端和测试数据库，对每个数据规模
+   （--sizes，File记录的数量）用 generate_dataset.py 生成数据后测试
+
+    python scripts/benchmark.py --sizes 2000 20000 200000 -o bench.json
+
+2. 访问本地运行的服务器（--url）：使用服务器的数据库中已有的数据，
+   测试用的文件和共享通过ORM查找或创建，所以需要与服务器使用相同的设置。
+   服务器以DEBUG模式运行时，查询次数从 X-DB-Queries 头中得到
+
+    python scripts/benchmark.py --url http://127.0.0.1:8000 \\
+        --user user0000000 -o bench.json
+
+与之前的结果比较：
+
+    python scripts/benchmark.py --compare old.json -o new.json
+"""
+
+import os
+from os.path import abspath, dirname
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+import http.cookiejar
+from io import BytesIO
+from uuid import uuid4
+
+# generate_dataset 导入时会设置好Django
+from generate_dataset import Generator, parse_args as dataset_args
+
+from django.conf import settings
+from django.db import connection
+from django.test import Client
+from django.test.utils import (CaptureQueriesContext, setup_test_environment,
+                               override_settings)
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from share.models import File, Share
+from share.hotcache import hot
+
+
+basedir = dirname(dirname(abspath(__file__)))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    k = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return values[k]
+
+
+class LocalDriver:
+    """进程内的测试客户端"""
+
+    def __init__(self):
+        self.client = Client()
+
+    def login(self, username, password):
+        assert self.client.login(username=username, password=password), \
+            'login failed'
+
+    def request(self, method, path, data=None, files=None, headers=None):
+        """返回(状态码, 响应内容, 查询次数)"""
+        headers = {'HTTP_' + k.upper().replace('-', '_'): v
+                   for k, v in (headers or {}).items()}
+        data = dict(data or {})
+        for name, (filename, content) in (files or {}).items():
+            data[name] = SimpleUploadedFile(filename, content)
+        # 查询记录有数量上限，每次清空以免计数不准
+        connection.queries_log.clear()
+        with CaptureQueriesContext(connection) as queries:
+            if method == 'GET':
+                res = self.client.get(path, data, **headers)
+            else:
+                res = self.client.post(path, data, **headers)
+            if res.streaming:
+                body = b''.join(res.streaming_content)
+            else:
+                body = res.content
+        return res.status_code, body, len(queries)
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args):
+        return None
+
+
+class HttpDriver:
+    """通过HTTP访问服务器"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(self.cookies), NoRedirect)
+
+    def login(self, username, password):
+        status, body, _ = self.request('POST', '/share/api/login/',
+                                       {'username': username,
+                                        'password': password})
+        assert json.loads(body.decode())['status'], 'login failed'
+        # 取得csrftoken
+        self.request('GET', '/share/upload/',
+                     headers={'Referer': self.url + '/share/'})
+
+    def cookie(self, name):
+        for c in self.cookies:
+            if c.name == name:
+                return c.value
+
+    def request(self, method, path, data=None, files=None, headers=None):
+        headers = dict(headers or {})
+        url = self.url + path
+        body = None
+        if method == 'GET' and data:
+            url += '?' + urllib.parse.urlencode(data, doseq=True)
+        elif method == 'POST':
+            token = self.cookie('csrftoken')
+            if token:
+                headers['X-CSRFToken'] = token
+            headers.setdefault('Referer', self.url + '/')
+            if files:
+                body, headers['Content-Type'] = encode_multipart(data, files)
+            else:
+                body = urllib.parse.urlencode(data or {}, doseq=True).encode()
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        req = urllib.request.Request(url, body, headers, method=method)
+        try:
+            res = self.opener.open(req)
+        except urllib.error.HTTPError as e:
+            res = e
+        with res:
+            content = res.read()
+            queries = res.headers.get('X-DB-Queries')
+            status = res.status if hasattr(res, 'status') else res.code
+        return status, content, queries and int(queries)
+
+
+def encode_multipart(data, files):
+    boundary = uuid4().hex
+    out = BytesIO()
+    for name, value in (data or {}).items():
+        out.write(('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n'
+                   '%s\r\n' % (boundary, name, value)).encode())
+    for name, (filename, content) in files.items():
+        out.write(('--%s\r\nContent-Disposition: form-data; name="%s"; '
+                   'filename="%s"\r\n'
+                   'Content-Type: application/octet-stream\r\n\r\n'
+                   % (boundary, name, filename)).encode())
+        out.write(content)
+        out.write(b'\r\n')
+    out.write(('--%s--\r\n' % boundary).encode())
+    return out.getvalue(), 'multipart/form-data; boundary=%s' % boundary
+
+
+class Fixture:
+    """测试用的目录，文件和共享"""
+
+    def __init__(self, opts, driver, anonymous):
+        self.opts = opts
+        self.driver = driver
+        self.anonymous = anonymous
+        self.user = opts.user
+        self.home = File.objects.get(name=opts.user, parent=None,
+                                     is_regular=False)
+        # 沿着第一个子目录找到最深的目录
+        node = self.home
+        names = [node.name]
+        while True:
+            sub = File.objects.filter(parent=node, is_regular=False) \
+                .order_by('name').first()
+            if sub is None:
+                break
+            node = sub
+            names.append(node.name)
+        self.deep_dir = node
+        self.deep_path = '/' + '/'.join(names)
+        self.counter = 0
+
+        # 下载用的文件，通过上传创建
+        self.download_name = 'bench-download-%s.bin' % uuid4().hex[:8]
+        self.upload(self.download_name, os.urandom(opts.download_size))
+        self.download_file = File.objects.get(parent=self.home,
+                                              name=self.download_name)
+
+        # 匿名共享最深的目录，匿名访问其中的文件需要查找所有的父目录
+        self.share = Share.objects.create(target=self.deep_dir, code=None)
+        self.shared_file = File.objects.filter(
+            parent=self.deep_dir, is_regular=True).first() or self.deep_dir
+
+    def upload(self, name, content):
+        status, _, queries = self.driver.request(
+            'POST', '/share/upload/',
+            {'next': '/share/list/%s/' % self.home.pk},
+            {'files': (name, content)})
+        assert status in (200, 302), 'upload failed: %s' % status
+        return queries
+
+    def unique(self):
+        self.counter += 1
+        return '%s-%s' % (uuid4().hex[:8], self.counter)
+
+    def cleanup(self):
+        self.share.delete()
+
+
+def case_list_dir(fx):
+    return fx.driver.request('GET', '/share/list/%s/' % fx.home.pk)
+
+
+def case_api_ls_long(fx):
+    return fx.driver.request('POST', '/share/api/ls/',
+                             {'long': 'True', 'names': [fx.deep_path]})
+
+
+def case_api_mkdir_p(fx):
+    path = '/%s/bench-mkdir/%s/a/b/c' % (fx.user, fx.unique())
+    return fx.driver.request('POST', '/share/api/mkdir/',
+                             {'parents': 'True', 'names': [path]})
+
+
+def case_search(fx):
+    return fx.driver.request('GET', '/share/search/', {'pattern': 'file0001'})
+
+
+def case_detail(fx):
+    return fx.anonymous.request('GET',
+                                '/share/detail/%s/' % fx.shared_file.pk)
+
+
+def case_upload(fx):
+    content = os.urandom(fx.opts.upload_size)
+    queries = fx.upload('bench-upload-%s.bin' % fx.unique(), content)
+    return 200, content, queries
+
+
+def case_download(fx):
+    return fx.driver.request('GET',
+                             '/share/download/%s/' % fx.download_file.pk)
+
+
+cases = [('list_dir', case_list_dir), ('api_ls_long', case_api_ls_long),
+         ('api_mkdir_p', case_api_mkdir_p), ('search', case_search),
+         ('detail', case_detail), ('upload', case_upload),
+         ('download', case_download)]
+
+
+def run_cases(fx, size, opts):
+    results = []
+    for name, func in cases:
+        if opts.cases and name not in opts.cases:
+            continue
+        for _ in range(opts.warmup):
+            func(fx)
+        latencies, queries, nbytes = [], [], 0
+        for _ in range(opts.repeat):
+            start = time.perf_counter()
+            status, body, count = func(fx)
+            latencies.append(time.perf_counter() - start)
+            assert status < 400, '%s failed: %s' % (name, status)
+            nbytes += len(body)
+            if count is not None:
+                queries.append(count)
+        total = sum(latencies)
+        result = {
+            'size': size, 'case': name, 'repeat': opts.repeat,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'queries': max(queries) if queries else None,
+            'mb_s': round(nbytes / total / 1e6, 3) if total else None,
+        }
+        print('%(size)10s %(case)-12s p50 %(p50_ms)9.3fms  '
+              'p99 %(p99_ms)9.3fms  queries %(queries)5s  '
+              '%(mb_s)9s MB/s' % result)
+        results.append(result)
+    return results
+
+
+def run_local(opts):
+    """进程内测试：每个规模使用一个新的测试数据库"""
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    media_root = tempfile.mkdtemp()
+    results = []
+    try:
+        with override_settings(MEDIA_ROOT=media_root):
+            for size in opts.sizes:
+                call_command('flush', interactive=False, verbosity=0)
+                hot.clear()
+                # 每个用户一棵深度3，每个目录4个子目录，20个文件的树，
+                # 约1785个条目
+                users = max(1, size // 1785)
+                Generator(dataset_args([
+                    '--users', str(users), '--blobs', 'sparse',
+                    '--median-size', '4k', '--seed', str(size)])).run()
+                opts.user = 'user0000000'
+                driver = LocalDriver()
+                driver.login(opts.user, 'abcd/1234')
+                fx = Fixture(opts, driver, LocalDriver())
+                results.extend(run_cases(fx, size, opts))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        shutil.rmtree(media_root, ignore_errors=True)
+    return results
+
+
+def run_http(opts):
+    driver = HttpDriver(opts.url)
+    driver.login(opts.user, opts.password)
+    fx = Fixture(opts, driver, HttpDriver(opts.url))
+    size = File.objects.count()
+    try:
+        return run_cases(fx, size, opts)
+    finally:
+        fx.cleanup()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=basedir).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """按照(规模, 操作)对比p50延迟和查询次数"""
+    before = {(r['size'], r['case']): r for r in old['results']}
+    print('\ncompared with %s' % (old.get('commit') or 'previous run'))
+    for r in new['results']:
+        o = before.get((r['size'], r['case']))
+        if o is None:
+            continue
+        ratio = r['p50_ms'] / o['p50_ms'] if o['p50_ms'] else float('inf')
+        print('%10s %-12s p50 x%.2f  queries %s -> %s' % (
+            r['size'], r['case'], ratio, o['queries'], r['queries']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark the hot paths')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2000, 20000],
+                        help='dataset sizes (File rows), in-process mode')
+    parser.add_argument('--url', help='benchmark a running server instead')
+    parser.add_argument('--user', default='user0000000')
+    parser.add_argument('--password', default='abcd/1234')
+    parser.add_argument('--cases', nargs='+', help='only run these cases')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--upload-size', type=int, default=256 * 1024)
+    parser.add_argument('--download-size', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--compare', help='previous result file')
+    parser.add_argument('-o', '--output', help='write results as JSON')
+    opts = parser.parse_args(argv)
+
+    results = run_http(opts) if opts.url else run_local(opts)
+    report = {'commit': git_commit(), 'time': time.strftime('%F %T'),
+              'target': opts.url or 'local', 'debug': settings.DEBUG,
+              'results': results}
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if opts.compare:
+        with open(opts.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""
+生成用于压力测试和性能测试的大规模数据
+
+每个用户的家目录下是一棵目录树：深度为depth，每个目录有fanout个子目录，
+files个文件。文件大小服从对数正态分布，一部分文件是已有文件的副本
+（共用RegularFile记录，与复制操作的结果相同），一部分文件和目录被共享。
+
+所有记录的主键预先分配，按广度优先的顺序生成，因此生成目录记录时，
+它的子目录和文件的id已经确定。记录以元组的形式积累，每batch条在一个事务中
+用executemany批量插入，不经过模型实例和ORM的SQL编译（它们占了大部分时间）。
+
+文件内容（--blobs）：
+    sparse  每个不同的文件创建一个稀疏文件，不占用磁盘空间，内容全是0
+    link    每个不同的文件是若干个随机内容的模板文件之一的硬链接
+    none    只生成数据库记录
+
+校验和是随机生成的，与文件内容无关。目录的统计和用户的使用量在最后
+重新计算（share/usage.py）。
+
+例如，生成约一千万个条目（100个用户，每人约10万个文件）：
+
+    python scripts/generate_dataset.py --users 100 --depth 4 --fanout 6 \\
+        --files 60 --blobs none
+"""
+
+import os
+from os.path import abspath, dirname
+import sys
+import time
+import random
+import hashlib
+import argparse
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+import django
+
+basedir = dirname(dirname(abspath(__file__)))
+os.chdir(basedir)
+sys.path.insert(0, '')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pro1.settings')
+django.setup()
+
+from django.apps import apps
+from django.db import connection, transaction
+from django.db.models import F, Max
+from django.core.management.color import no_style
+from django.contrib.auth.models import User
+from django.contrib.auth.hashers import make_password
+from django.utils import timezone
+from share.models import RegularFile, DirectoryFile, File, Share
+from share.storage import storage, blob_path
+from share.libs import gen_code, chunked
+from share.usage import recount
+
+
+class IdAllocator:
+    """从表中现有的最大主键之后分配主键"""
+
+    def __init__(self, model):
+        self.next = (model.objects.aggregate(m=Max('pk'))['m'] or 0) + 1
+
+    def __call__(self):
+        pk = self.next
+        self.next += 1
+        return pk
+
+
+# 每个模型批量插入的字段
+columns = {
+    File: ['id', 'name', 'owner', 'parent', 'object_pk', 'is_regular'],
+    DirectoryFile: ['id', 'subdirs', 'files', 'time', 'size', 'total_size',
+                    'total_files'],
+    RegularFile: ['id', 'size', 'received', 'time', 'digest', 'path',
+                  'finished', 'links', 'codec'],
+    Share: ['id', 'target', 'code', 'expire'],
+}
+
+
+def insert_sql(model):
+    qn = connection.ops.quote_name
+    names = [model._meta.get_field(x).column for x in columns[model]]
+    return 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(model._meta.db_table), ', '.join(qn(x) for x in names),
+        ', '.join(['%s'] * len(names)))
+
+
+class Generator:
+
+    def __init__(self, options):
+        self.opts = options
+        self.random = random.Random(options.seed)
+        self.now = timezone.now()
+        self.ids = {model: IdAllocator(model) for model in columns}
+        self.pending = defaultdict(list)
+        self.size = 0
+        self.sql = {model: insert_sql(model) for model in columns}
+        self.counts = Counter()
+        # 可以被复制的文件对象（最近的一部分），以及复制增加的链接数
+        self.reusable = []
+        self.extra_links = Counter()
+        self.templates = []
+        self.users = []
+
+    def add(self, model, *row):
+        self.pending[model].append(row)
+        self.counts[model.__name__] += 1
+        self.size += 1
+        if self.size >= self.opts.batch:
+            self.flush()
+
+    def flush(self):
+        """按照外键依赖的顺序插入"""
+        with transaction.atomic(), connection.cursor() as cursor:
+            for model in (RegularFile, DirectoryFile, File, Share):
+                rows = self.pending.pop(model, [])
+                if rows:
+                    cursor.executemany(self.sql[model], rows)
+        self.size = 0
+
+    def make_time(self):
+        """随机的时间，已经转换为数据库的格式"""
+        t = self.now - timedelta(seconds=self.random.randint(0, 90 * 86400))
+        return connection.ops.adapt_datetimefield_value(t)
+
+    def make_size(self):
+        size = self.random.lognormvariate(0, self.opts.size_sigma)
+        return min(int(size * self.opts.median_size), self.opts.max_size)
+
+    def maybe_share(self, file_pk):
+        if self.random.random() >= self.opts.share_density:
+            return
+        code = gen_code() if self.random.random() < 0.5 else None
+        expire = None
+        if self.random.random() < 0.5:
+            expire = self.now + timedelta(days=self.random.randint(-30, 30))
+            expire = connection.ops.adapt_datetimefield_value(expire)
+        self.add(Share, self.ids[Share](), file_pk, code, expire)
+
+    def make_regular(self):
+        """新建文件对象，或者复制已有的，返回文件对象的pk"""
+        if self.reusable and self.random.random() < self.opts.dup_ratio:
+            pk = self.random.choice(self.reusable)
+            self.extra_links[pk] += 1
+            return pk
+        pk = self.ids[RegularFile]()
+        digest = hashlib.sha1(b'%d-%d' % (self.opts.seed, pk)).hexdigest()
+        path = blob_path(digest, self.now)
+        size = self.make_blob(path)
+        self.add(RegularFile, pk, size, size, self.make_time(), digest, path,
+                 True, 1, '')
+        if len(self.reusable) < 10000:
+            self.reusable.append(pk)
+        else:
+            self.reusable[self.random.randrange(10000)] = pk
+        return pk
+
+    def make_blob(self, path):
+        """创建文件内容，返回文件大小"""
+        mode = self.opts.blobs
+        if mode == 'link':
+            if not self.templates:
+                self.make_templates()
+            template, size = self.random.choice(self.templates)
+        else:
+            size = self.make_size()
+        if mode == 'none':
+            return size
+        abspath = storage.path(path)
+        os.makedirs(dirname(abspath), mode=0o755, exist_ok=True)
+        if mode == 'link':
+            if not os.path.exists(abspath):
+                os.link(template, abspath)
+        else:
+            with open(abspath, 'wb') as f:
+                f.truncate(size)
+        return size
+
+    def make_templates(self):
+        dir = storage.path('.templates')
+        os.makedirs(dir, mode=0o755, exist_ok=True)
+        for i in range(16):
+            size = self.make_size()
+            path = os.path.join(dir, 'template-%02d' % i)
+            with open(path, 'wb') as f:
+                remain = size
+                while remain > 0:
+                    n = min(remain, 1024 * 1024)
+                    f.write(os.urandom(n))
+                    remain -= n
+            self.templates.append((path, size))
+
+    def make_user(self, n):
+        name = '%s%07d' % (self.opts.prefix, n)
+        user = User.objects.create(username=name, password=self.password)
+        self.users.append(user.pk)
+        self.counts['User'] += 1
+        home = (self.ids[File](), self.ids[DirectoryFile]())
+        self.add(File, home[0], name, user.pk, None, home[1], False)
+
+        # 广度优先：处理一个目录时，分配子节点的id并生成目录对象，
+        # 目录用(File的pk, DirectoryFile的pk)表示
+        level = [home]
+        for depth in range(self.opts.depth + 1):
+            next_level = []
+            for dir_pk, object_pk in level:
+                subdirs, files = [], []
+                if depth < self.opts.depth:
+                    for i in range(self.opts.fanout):
+                        sub = (self.ids[File](), self.ids[DirectoryFile]())
+                        self.add(File, sub[0], 'dir%03d' % i, user.pk, dir_pk,
+                                 sub[1], False)
+                        self.maybe_share(sub[0])
+                        subdirs.append(':%s' % sub[0])
+                        next_level.append(sub)
+                for i in range(self.opts.files):
+                    pk = self.ids[File]()
+                    self.add(File, pk, 'file%05d.bin' % i, user.pk, dir_pk,
+                             self.make_regular(), True)
+                    self.maybe_share(pk)
+                    files.append(':%s' % pk)
+                subdirs, files = ''.join(subdirs), ''.join(files)
+                self.add(DirectoryFile, object_pk, subdirs, files,
+                         self.make_time(), len(subdirs) + len(files), 0, 0)
+            level = next_level
+
+    def run(self):
+        opts = self.opts
+        dirs = sum(opts.fanout ** d for d in range(opts.depth + 1))
+        total = opts.users * (dirs + dirs * opts.files)
+        print('generating %s users, about %s entries' % (opts.users, total))
+        self.password = make_password(opts.password)
+        start = time.time()
+        for n in range(opts.users):
+            self.make_user(n)
+        self.flush()
+
+        # 复制得到的文件，链接数相同的合并为一条UPDATE语句
+        groups = defaultdict(list)
+        for pk, count in self.extra_links.items():
+            groups[count].append(pk)
+        for count, pks in groups.items():
+            for chunk in chunked(pks):
+                RegularFile.objects.filter(pk__in=chunk).update(
+                    links=F('links') + count)
+
+        # 目录的统计和用户的使用量
+        recount(apps, self.users)
+
+        # 预先分配了主键，需要同步数据库的序列（PostgreSQL等）
+        models = list(columns)
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(sql)
+
+        elapsed = time.time() - start
+        for name, count in sorted(self.counts.items()):
+            print('%-14s %d' % (name, count))
+        rows = sum(self.counts.values())
+        print('%d rows in %.1fs, %.0f rows/s' % (rows, elapsed,
+                                                 rows / max(elapsed, 1e-6)))
+
+
+def parse_size(text):
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    text = text.lower()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='generate a synthetic dataset')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--prefix', default='user', help='user name prefix')
+    parser.add_argument('--password', default='abcd/1234')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='levels of subdirectories under home')
+    parser.add_argument('--fanout', type=int, default=4,
+                        help='subdirectories per directory')
+    parser.add_argument('--files', type=int, default=20,
+                        help='files per directory')
+    parser.add_argument('--median-size', type=parse_size, default='64k')
+    parser.add_argument('--size-sigma', type=float, default=2.0,
+                        help='sigma of the log-normal size distribution')
+    parser.add_argument('--max-size', type=parse_size, default='1g')
+    parser.add_argument('--share-density', type=float, default=0.01,
+                        help='fraction of files and directories shared')
+    parser.add_argument('--dup-ratio', type=float, default=0.2,
+                        help='fraction of files that are copies')
+    parser.add_argument('--blobs', choices=['sparse', 'link', 'none'],
+                        default='sparse')
+    parser.add_argument('--batch', type=int, default=5000,
+                        help='rows per transaction')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    Generator(parse_args()).run()
@@ -0,0 +1,397 @@
+"""
+压力测试：模拟大量用户同时访问本地运行的服务器
+
+每个模拟的用户是一个线程，有自己的session，通过命令行客户端（share/client.py）
+的请求层访问服务器，按照给定的比例随机地执行以下操作：
+
+    login       重新登录（api/login）
+    ls          列出家目录或者其中一个子目录的详情（api/ls -l）
+    mkdir       创建多级目录（api/mkdir -p）
+    upload      上传一个文件（网页的上传表单）
+    download    下载自己的文件
+    fetch       匿名下载被匿名共享的文件
+    fetch_code  提交分享码后下载共享的文件（详情页，提交分享码，下载）
+
+结束后输出总的吞吐量，以及每种操作的次数，错误率，延迟的p50/p90/p99和传输速度，
+可以用来在上线之前确定worker的数量和数据库的设置。
+
+测试用的用户，文件和共享通过ORM查找或创建，所以需要与服务器使用相同的设置，
+通常先用 generate_dataset.py 生成数据（--blobs 不能是none，否则下载会失败）。
+上传的文件和创建的目录都在每个用户家目录下的 loadtest 目录中，
+测试用的共享和这些目录在结束时删除。例如：
+
+    python scripts/generate_dataset.py --users 20
+    python scripts/loadtest.py --url http://127.0.0.1:8000 --concurrency 50 \\
+        --duration 60 --mix ls=40 download=20 fetch=20 upload=10 mkdir=5 \\
+        fetch_code=4 login=1
+
+所有模拟的用户在同一个进程中，客户端本身的CPU占用较高时，
+可以同时运行多个实例（使用不同的 --offset）。
+"""
+
+import os
+from os.path import abspath, dirname
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from uuid import uuid4
+from collections import defaultdict
+
+import django
+import requests
+
+basedir = dirname(dirname(abspath(__file__)))
+os.chdir(basedir)
+sys.path.insert(0, '')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pro1.settings')
+django.setup()
+
+from django.contrib.auth.models import User
+from share import client
+from share.models import File, RegularFile, Share
+from share.libs import gen_code
+
+
+class Failed(Exception):
+    pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    k = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return values[k]
+
+
+def finished_files(query, limit):
+    """query中已经上传完成的文件，最多limit个"""
+    files = list(query.filter(is_regular=True).order_by('pk')[:limit * 4])
+    done = set(RegularFile.objects.filter(
+        pk__in=[f.object_pk for f in files], finished=True)
+        .values_list('pk', flat=True))
+    return [f for f in files if f.object_pk in done][:limit]
+
+
+class Account:
+    """一个测试用户，以及他的文件（多个模拟的用户可以共用一个帐号）"""
+
+    def __init__(self, user, opts):
+        self.username = user.username
+        self.password = opts.password
+        self.home = File.objects.get(owner=user, name=user.username,
+                                     parent=None, is_regular=False)
+        self.dirs = [''] + list(File.objects.filter(
+            parent=self.home, is_regular=False).order_by('pk')
+            .values_list('name', flat=True)[:20])
+        files = finished_files(File.objects.filter(owner=user), 20)
+        self.downloads = [f.pk for f in files]
+        self.workdir = None
+
+
+class Worker(threading.Thread):
+    """一个模拟的用户"""
+
+    def __init__(self, test, account, seed):
+        super().__init__(daemon=True)
+        self.test = test
+        self.account = account
+        self.random = random.Random(seed)
+        self.session = requests.Session()
+        self.anonymous = requests.Session()
+        self.counter = 0
+
+    def url(self, path):
+        return self.test.url + path
+
+    def api(self, name, data):
+        res, r = client.post(self.url('/share/api/%s/' % name), data,
+                             session=self.session)
+        if res is None:
+            raise Failed('%s: http %s' % (name, r.status_code))
+        if not res['status']:
+            raise Failed('%s: %s' % (name, res['errors']))
+        return len(r.content)
+
+    def csrf_token(self, session):
+        return session.cookies.get('csrftoken')
+
+    def get(self, session, path, expect=200, **kwargs):
+        """GET请求，分块读取响应，返回数据量"""
+        r = session.get(self.url(path), stream=True, allow_redirects=False,
+                        **kwargs)
+        with r:
+            if r.status_code != expect:
+                raise Failed('GET %s: http %s' % (path.split('/')[2],
+                                                  r.status_code))
+            size = 0
+            for chunk in r.iter_content(256 * 1024):
+                size += len(chunk)
+        return size
+
+    def unique(self):
+        self.counter += 1
+        return '%s-%s' % (uuid4().hex[:8], self.counter)
+
+    def op_login(self):
+        return self.api('login', {'username': self.account.username,
+                                  'password': self.account.password})
+
+    def op_ls(self):
+        name = self.random.choice(self.account.dirs)
+        return self.api('ls', {'long': True, 'directory': False,
+                               'names': [name] if name else []})
+
+    def op_mkdir(self):
+        return self.api('mkdir', {'parents': True, 'verbose': False,
+                                  'names': ['loadtest/%s/a/b' % self.unique()]})
+
+    def op_upload(self):
+        next_url = '/share/list/%s/' % self.account.workdir
+        if self.csrf_token(self.session) is None:
+            self.get(self.session, '/share/upload/',
+                     headers={'Referer': self.url(next_url)})
+        content = os.urandom(self.test.opts.upload_size)
+        r = self.session.post(
+            self.url('/share/upload/'), data={'next': next_url},
+            files={'files': ('upload-%s.bin' % self.unique(), content)},
+            headers={'X-CSRFToken': self.csrf_token(self.session),
+                     'Referer': self.url(next_url)},
+            allow_redirects=False)
+        if r.status_code != 302:
+            raise Failed('upload: http %s' % r.status_code)
+        return len(content)
+
+    def op_download(self):
+        if not self.account.downloads:
+            raise Failed('download: no files')
+        pk = self.random.choice(self.account.downloads)
+        return self.get(self.session, '/share/download/%s/' % pk)
+
+    def op_fetch(self):
+        pk = self.random.choice(self.test.public)
+        return self.get(self.anonymous, '/share/download/%s/' % pk)
+
+    def op_fetch_code(self):
+        # 每次都是新的访问者，需要先提交分享码
+        pk, code = self.random.choice(self.test.protected)
+        session = requests.Session()
+        with session:
+            size = self.get(session, '/share/detail/%s/' % pk)
+            r = session.post(self.url('/share/post_code/%s/' % pk),
+                             data={'code': code},
+                             headers={'X-CSRFToken': self.csrf_token(session),
+                                      'Referer': self.url('/share/')},
+                             allow_redirects=False)
+            if r.status_code != 302:
+                raise Failed('post_code: http %s' % r.status_code)
+            return size + self.get(session, '/share/download/%s/' % pk)
+
+    def run(self):
+        test = self.test
+        ops, weights = zip(*test.mix)
+        self.op_login()
+        time.sleep(self.random.uniform(0, test.opts.ramp_up))
+        done = 0
+        while not test.stopped.is_set():
+            if test.opts.operations and done >= test.opts.operations:
+                break
+            name = self.random.choices(ops, weights)[0]
+            start = time.perf_counter()
+            try:
+                size = getattr(self, 'op_' + name)()
+                error = None
+            except Failed as e:
+                size, error = 0, str(e)
+            except requests.RequestException as e:
+                size, error = 0, '%s: %s' % (name, type(e).__name__)
+            test.record(name, time.perf_counter() - start, size, error)
+            done += 1
+            if test.opts.think:
+                time.sleep(self.random.expovariate(1 / test.opts.think))
+
+
+class LoadTest:
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.url = opts.url.rstrip('/')
+        self.mix = opts.mix
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.bytes = defaultdict(int)
+        self.errors = defaultdict(lambda: defaultdict(int))
+        self.shares = []
+
+    def record(self, name, elapsed, size, error):
+        with self.lock:
+            self.latencies[name].append(elapsed)
+            self.bytes[name] += size
+            if error:
+                self.errors[name][error] += 1
+
+    def setup(self):
+        opts = self.opts
+        users = list(User.objects.filter(username__startswith=opts.prefix)
+                     .order_by('username')[opts.offset:opts.offset + opts.users])
+        assert users, 'no users named %s*' % opts.prefix
+        self.accounts = [Account(user, opts) for user in users]
+        print('%d accounts, %d simulated users' % (len(self.accounts),
+                                                   opts.concurrency))
+
+        # 测试用的共享：匿名共享和需要分享码的共享
+        candidates = finished_files(File.objects.filter(
+            owner__in=users), opts.shares * 2)
+        assert len(candidates) >= 2, 'not enough files to share'
+        half = len(candidates) // 2
+        self.public, self.protected = [], []
+        for file in candidates[:half]:
+            self.shares.append(Share.objects.create(target=file, code=None))
+            self.public.append(file.pk)
+        for file in candidates[half:]:
+            code = gen_code()
+            self.shares.append(Share.objects.create(target=file, code=code))
+            self.protected.append((file.pk, code))
+
+    def run(self):
+        opts = self.opts
+        workers = [Worker(self, self.accounts[i % len(self.accounts)],
+                          opts.seed + i)
+                   for i in range(opts.concurrency)]
+        # 每个帐号的工作目录
+        for worker in workers[:len(self.accounts)]:
+            worker.op_login()
+            worker.api('mkdir', {'parents': True, 'names': ['loadtest']})
+            worker.account.workdir = File.objects.get(
+                parent=worker.account.home, name='loadtest').pk
+
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        try:
+            if opts.operations:
+                for worker in workers:
+                    worker.join()
+            else:
+                time.sleep(opts.duration)
+        except KeyboardInterrupt:
+            pass
+        self.stopped.set()
+        for worker in workers:
+            worker.join()
+        self.elapsed = time.perf_counter() - start
+
+        # 删除工作目录
+        for worker in workers[:len(self.accounts)]:
+            worker.api('rmdir', {'recursive': True, 'names': ['loadtest']})
+
+    def cleanup(self):
+        for share in self.shares:
+            share.delete()
+
+    def report(self):
+        results = []
+        total = sum(len(x) for x in self.latencies.values())
+        failed = sum(sum(x.values()) for x in self.errors.values())
+        print('\n%d operations in %.1fs, %.1f ops/s, %.2f%% errors' % (
+            total, self.elapsed, total / self.elapsed,
+            100 * failed / max(total, 1)))
+        print('%-10s %7s %7s %8s %9s %9s %9s %9s %9s' % (
+            'operation', 'count', 'errors', 'ops/s', 'p50 ms', 'p90 ms',
+            'p99 ms', 'max ms', 'MB/s'))
+        for name, _ in self.mix:
+            latencies = self.latencies.get(name)
+            if not latencies:
+                continue
+            errors = sum(self.errors[name].values())
+            ms = lambda p: round(percentile(latencies, p) * 1000, 3)
+            result = {
+                'operation': name, 'count': len(latencies),
+                'errors': errors, 'error_rate': errors / len(latencies),
+                'ops_s': round(len(latencies) / self.elapsed, 3),
+                'p50_ms': ms(50), 'p90_ms': ms(90), 'p99_ms': ms(99),
+                'max_ms': round(max(latencies) * 1000, 3),
+                'mb_s': round(self.bytes[name] / self.elapsed / 1e6, 3),
+                'error_kinds': dict(self.errors[name]),
+            }
+            print('%(operation)-10s %(count)7d %(errors)7d %(ops_s)8.1f '
+                  '%(p50_ms)9.1f %(p90_ms)9.1f %(p99_ms)9.1f %(max_ms)9.1f '
+                  '%(mb_s)9.3f' % result)
+            results.append(result)
+        for name, kinds in sorted(self.errors.items()):
+            for error, count in sorted(kinds.items(), key=lambda x: -x[1]):
+                print('  %6d  %s' % (count, error))
+        return {'time': time.strftime('%F %T'), 'target': self.url,
+                'concurrency': self.opts.concurrency,
+                'elapsed': round(self.elapsed, 3), 'operations': total,
+                'errors': failed, 'results': results}
+
+
+operations = ['login', 'ls', 'mkdir', 'upload', 'download', 'fetch',
+              'fetch_code']
+
+
+def parse_mix(items):
+    """例如 ['ls=40', 'download=20']，返回[(操作, 比重)]"""
+    mix = []
+    for item in items:
+        name, _, weight = item.partition('=')
+        if name not in operations:
+            raise argparse.ArgumentTypeError('unknown operation: %s' % name)
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='load test a running server')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--prefix', default='user',
+                        help='use existing users with this name prefix')
+    parser.add_argument('--password', default='abcd/1234')
+    parser.add_argument('--users', type=int, default=10,
+                        help='number of accounts')
+    parser.add_argument('--offset', type=int, default=0,
+                        help='skip this many accounts (for parallel runs)')
+    parser.add_argument('--concurrency', type=int, default=20,
+                        help='simulated users')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to run')
+    parser.add_argument('--operations', type=int, default=0,
+                        help='operations per simulated user, '
+                             'instead of --duration')
+    parser.add_argument('--ramp-up', type=float, default=2,
+                        help='spread the start of the users over seconds')
+    parser.add_argument('--think', type=float, default=0,
+                        help='mean seconds between operations of a user')
+    parser.add_argument('--mix', nargs='+', default=[
+        'login=1', 'ls=30', 'mkdir=5', 'upload=10', 'download=30',
+        'fetch=20', 'fetch_code=4'], help='operation=weight')
+    parser.add_argument('--shares', type=int, default=10,
+                        help='files shared anonymously and with a code each')
+    parser.add_argument('--upload-size', type=int, default=256 * 1024)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='write results as JSON')
+    opts = parser.parse_args(argv)
+    try:
+        opts.mix = parse_mix(opts.mix)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    test = LoadTest(opts)
+    test.setup()
+    try:
+        test.run()
+    finally:
+        test.cleanup()
+    report = test.report()
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -47,8 +47,11 @@ sys.path.insert(0, '')
 os.environ['DJANGO_SETTINGS_MODULE'] = 'pro1.settings'
 django.setup()
 
+from django.apps import apps
 from django.contrib.auth.models import User
 from share.models import RegularFile, DirectoryFile, File, Share
+from share.storage import blob_path
+from share.usage import recount
 
 
 def digest(text=None, bytes=None, buffer=None, path=None):
@@ -93,10 +96,6 @@ def make_time():
     return timezone.now() - timedelta(days=random.randint(1,10))
 
 
-def make_path(time, digest):
-    return os.path.join(time.strftime('%Y%m%d'), digest)
-
-
 def create_directory(name, owner):
     fo = DirectoryFile.objects.create()
     dir = File.objects.create(name=name, owner=owner, is_regular=False)
@@ -129,7 +128,7 @@ def work():
             size = get_size(abspath)
             time = make_time()
             sha1 = digest(path=abspath)
-            store_path = make_path(time, sha1)
+            store_path = blob_path(sha1, time)
 
             print('creating RegularFile record for %s' % name)
             fo = RegularFile.objects.create(
@@ -160,6 +159,10 @@ def work():
             os.makedirs(dst_dir, mode=0o755, exist_ok=True)
             os.system('cp -v %s %s' % (abspath, dst))
 
+        # 目录的统计和用户的使用量（实际占用的空间只在上传时增加）
+        print('recounting usage of %s' % user['name'])
+        recount(apps, [u.pk])
+
 
 users = [
     {'name': 'alice', 'password': 'abcd/1234'},
@@ -8,8 +8,13 @@ from django.contrib.auth.decorators import login_required
 from django.shortcuts import get_object_or_404
 from django.http import Http404
 from django.conf import settings
+from django.db import transaction, IntegrityError
 
-from .models import File, DirectoryFile
+from .models import File, DirectoryFile, RegularFile, Usage
+from .libs import chunked
+from .views_libs import (copy_tree, move_file, delete_tree, get_home,
+                         TransferError)
+from .quota import QuotaExceeded
 
 
 @csrf_exempt
@@ -41,12 +46,10 @@ def inform_login(request):
 @login_required(login_url=settings.API_LOGIN_URL)
 @csrf_exempt
 def ls(request):
-    user = request.user
     long = request.POST.get('long', '') == 'True'
     directory = request.POST.get('directory', '') == 'True'
     names = request.POST.getlist('names', [])
-    home = get_object_or_404(File, owner=user, name=user.username,
-                             is_regular=False, parent=None)
+    home = get_home(request)
 
     # 第一步，取出所有的名字对应的文件或目录
     if not names:
@@ -118,11 +121,67 @@ def resolve_abspath(path, home):
         for name in names:
             obj = get_object_or_404(File, name=name, parent=parent)
             parent = obj
-        return obj
+        return parent
     except Http404:
         return None
 
 
+def resolve_paths(paths, home):
+    """
+    批量解析多个绝对路径，返回 {路径: File或None}。
+    同一层级的所有名字用一次查询取出，查询次数只与路径深度有关，
+    与路径的数量无关。
+    """
+    result = {}
+    # pending: 还没解析完的路径 -> (剩余的名字列表, 当前的父目录)
+    pending = {}
+    for path in set(paths):
+        names = path.split('/')[2:]
+        if names:
+            pending[path] = (names, home)
+        else:
+            result[path] = home
+
+    while pending:
+        parents = {parent.pk: parent for _, parent in pending.values()}
+        names = {names[0] for names, _ in pending.values()}
+        children = {}
+        for pks in chunked(parents, 400):
+            for name_chunk in chunked(names, 400):
+                qs = File.objects.filter(parent__in=pks, name__in=name_chunk)
+                for f in qs:
+                    children[(f.parent_id, f.name)] = f
+
+        next_pending = {}
+        for path, (names, parent) in pending.items():
+            obj = children.get((parent.pk, names[0]))
+            if obj is None:
+                result[path] = None
+            elif len(names) == 1:
+                result[path] = obj
+            else:
+                next_pending[path] = (names[1:], obj)
+        pending = next_pending
+    return result
+
+
+def load_objects(files):
+    """批量取出File对应的RegularFile/DirectoryFile，返回 {File.pk: object}"""
+    regs = {f.object_pk for f in files if f.is_regular}
+    dirs = {f.object_pk for f in files if not f.is_regular}
+    reg_objs = {}
+    dir_objs = {}
+    for pks in chunked(regs):
+        reg_objs.update(RegularFile.objects.in_bulk(pks))
+    for pks in chunked(dirs):
+        dir_objs.update(DirectoryFile.objects.in_bulk(pks))
+    objs = {}
+    for f in files:
+        pool = reg_objs if f.is_regular else dir_objs
+        objs[f.pk] = pool.get(f.object_pk)
+    return objs
+
+
 def transform_path(path, home):
     """
     把相对路径转成绝对路径，当绝对路径不在家目录下时报错，
@@ -157,7 +216,7 @@ def render_ls_output(files, long):
                     # 抽取字段：type, owner, size, time, name
                     record = {'regular': f.is_regular,
                               'owner': f.owner.username,
-                              'size': f.object.size,
+                              'size': f.object.total_size,
                               'time': f.object.time.strftime('%F %T'),
                               'name': getattr(f, 'requested_path', f.name)}
                     records.append(record)
@@ -171,8 +230,7 @@ def mkdir(request):
     user = request.user
     opt_parents = request.POST.get('parents', '') == 'True'
     names = request.POST.getlist('names', [])
-    home = get_object_or_404(File, owner=user, name=user.username,
-                             is_regular=False, parent=None)
+    home = get_home(request)
 
     created = []
     errors = []
@@ -190,16 +248,28 @@ def mkdir(request):
         else:
             if request_num - exists_num == 1:
                 # 父目录全部存在，可以直接创建
-                create_directory(path_elements[-1], user, objs[-1])
-                created.append(name)
+                try:
+                    create_directory(path_elements[-1], user, objs[-1])
+                except IntegrityError:
+                    # 检查之后，并发的请求创建了同名的文件
+                    errors.append('cannot create %s: file exists' % name)
+                else:
+                    created.append(name)
             else:
                 # 缺少部分父目录
                 if opt_parents:     # -d选项, 同时创建不存在的父目录
                     parent = objs[-1]
-                    for dir_name in path_elements[exists_num:]:
-                        dir = create_directory(dir_name, user, parent)
-                        created.append(dir_name)
-                        parent = dir
+                    try:
+                        with transaction.atomic():
+                            new = []
+                            for dir_name in path_elements[exists_num:]:
+                                dir = create_directory(dir_name, user, parent)
+                                new.append(dir_name)
+                                parent = dir
+                    except IntegrityError:
+                        errors.append('cannot create %s: file exists' % name)
+                    else:
+                        created.extend(new)
                 else:               # 出错
                     errmsg = 'cannot create %s: parent not exists' % name
                     errors.append(errmsg)
@@ -213,17 +283,34 @@ def mkdir(request):
 @login_required(login_url=settings.API_LOGIN_URL)
 @csrf_exempt
 def rmdir(request):
-    user = request.user
     opt_parents = request.POST.get('parents', '') == 'True'
+    recursive = request.POST.get('recursive', '') == 'True'
     names = request.POST.getlist('names', [])
-    home = get_object_or_404(File, owner=user, name=user.username,
-                             is_regular=False, parent=None)
+    home = get_home(request)
 
     removed = []
     errors = []
     for name in names:
         abspath = transform_path(name, home)
+        if abspath is None:
+            errors.append('no permission on %s' % name)
+            continue
         objs = collect_path_objects(abspath, home)
+        if recursive:
+            # 删除整个目录树，包括其中的文件
+            if len(objs) != len(abspath.split('/')) - 1:
+                errors.append('failed to remove: %s: not found' % name)
+            elif len(objs) == 1:
+                errors.append('failed to remove: %s: home directory' % name)
+            else:
+                path = objs[-1].abspath()
+                try:
+                    delete_tree(objs[-1])
+                except TransferError as e:
+                    errors.append('failed to remove: %s: %s' % (name, e))
+                else:
+                    removed.append(path)
+            continue
         for file in objs[-1:0:-1]:    # revert and exclude the home directory
             if file.is_regular:
                 errmsg = 'failed to remove: %s: not a directory' % name
@@ -242,11 +329,12 @@ def rmdir(request):
 
 
 def create_directory(name, owner, parent=None):
-    fo = DirectoryFile.objects.create()
-    dir = File.objects.create(name=name, owner=owner, is_regular=False)
-    dir.link(fo)
-    if parent:
-        parent.add(dir)
+    with transaction.atomic():
+        fo = DirectoryFile.objects.create()
+        dir = File.objects.create(name=name, owner=owner, is_regular=False,
+                                  object_pk=fo.pk)
+        if parent:
+            parent.add(dir)
     return dir
 
 
@@ -259,11 +347,136 @@ def delete_directory(dir):
 @login_required(login_url=settings.API_LOGIN_URL)
 @csrf_exempt
 def exists(request):
-    user = request.user
     name = request.POST.get('name')
-    home = get_object_or_404(File, owner=user, name=user.username,
-                             is_regular=False, parent=None)
+    home = get_home(request)
 
     files, errors = paths_to_files([name], home)
     res = {'status': bool(files), 'errors': errors}
     return JsonResponse(res)
+
+
+@login_required(login_url=settings.API_LOGIN_URL)
+@csrf_exempt
+def usage(request):
+    """用户的存储使用量：文件数，逻辑大小，实际占用"""
+    usage = Usage.objects.filter(user=request.user).first() or Usage()
+    output = {'files': usage.files, 'logical': usage.logical,
+              'physical': usage.physical}
+    return JsonResponse({'status': True, 'output': output, 'errors': []})
+
+
+@login_required(login_url=settings.API_LOGIN_URL)
+@csrf_exempt
+def stat(request):
+    """
+    批量查询文件的元数据，一次请求可以包含成千上万个路径或者校验和，
+    对每一项返回：是否存在，类型，大小，校验和，时间。
+    """
+    names = request.POST.getlist('names', [])
+    digests = request.POST.getlist('digests', [])
+    home = get_home(request)
+
+    errors = []
+    abspaths = {}
+    for name in names:
+        abspath = transform_path(name, home)
+        if abspath is None:
+            errors.append('no permission on %s' % name)
+        else:
+            abspaths[name] = abspath
+    resolved = resolve_paths(abspaths.values(), home)
+    found = [f for f in resolved.values() if f is not None]
+    objs = load_objects(found)
+
+    output = []
+    for name in names:
+        record = {'name': name, 'exists': False}
+        file = resolved.get(abspaths.get(name))
+        fo = objs.get(file.pk) if file else None
+        if fo is not None and getattr(fo, 'finished', True):
+            record.update(exists=True, regular=file.is_regular,
+                          size=fo.total_size, files=fo.total_files,
+                          time=fo.time.strftime('%F %T'),
+                          digest=getattr(fo, 'digest', None))
+        output.append(record)
+
+    # 按校验和查询服务器上已有的文件（用于秒传），只查询自己的文件，
+    # 不泄露其他用户是否有相同内容的文件
+    blobs = {}
+    owned = File.objects.filter(owner=request.user, is_regular=True)
+    for chunk in chunked(set(digests)):
+        qs = RegularFile.objects.filter(
+            digest__in=chunk, finished=True,
+            pk__in=owned.values('object_pk'))
+        for fo in qs:
+            blobs[fo.digest] = fo
+    for digest in digests:
+        record = {'digest': digest, 'exists': digest in blobs}
+        fo = blobs.get(digest)
+        if fo is not None:
+            record.update(regular=True, size=fo.size,
+                          time=fo.time.strftime('%F %T'))
+        output.append(record)
+
+    res = {'status': not bool(errors), 'output': output, 'errors': errors}
+    return JsonResponse(res)
+
+
+@login_required(login_url=settings.API_LOGIN_URL)
+@csrf_exempt
+def copy(request):
+    return transfer(request, 'copy')
+
+
+@login_required(login_url=settings.API_LOGIN_URL)
+@csrf_exempt
+def move(request):
+    return transfer(request, 'move')
+
+
+def transfer(request, operation):
+    """
+    复制或者移动文件/目录树，语义与cp -r/mv相同：
+    目标是已经存在的目录时，源放到目标目录之中；
+    否则只能有一个源，目标是源的新路径。
+    """
+    user = request.user
+    names = request.POST.getlist('names', [])
+    target = request.POST.get('target', '')
+    home = get_home(request)
+
+    done = []
+    errors = []
+    target_path = transform_path(target, home)
+    if target_path is None:
+        errors.append('no permission on %s' % target)
+        names = []
+    dest = target_path and resolve_abspath(target_path, home)
+    new_name = None
+    if target_path and not (dest and not dest.is_regular):
+        if len(names) != 1:
+            errors.append('target %s is not a directory' % target)
+            names = []
+        else:
+            parent_path, new_name = os.path.split(target_path)
+            dest = resolve_abspath(parent_path, home)
+            if dest is None or dest.is_regular or parent_path == '/':
+                errors.append('no such directory: %s' % parent_path)
+                names = []
+
+    files, path_errors = paths_to_files(names, home)
+    errors.extend(path_errors)
+    for file in files:
+        try:
+            if operation == 'copy':
+                copy_tree(file, dest, user, new_name)
+            else:
+                move_file(file, dest, new_name)
+        except (TransferError, QuotaExceeded) as e:
+            errors.append('cannot %s %s: %s' % (operation,
+                                                file.requested_path, e))
+        else:
+            done.append(file.requested_path)
+
+    res = {'status': not bool(errors), 'output': done, 'errors': errors}
+    return JsonResponse(res)
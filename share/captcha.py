@@ -0,0 +1,129 @@
+"""
+预先生成的验证码池
+
+后台线程预先生成(文本, PNG数据)放在池中，每个请求取走一个，
+池中的数量低于一半时唤醒后台线程补充。生成时间超过 CAPTCHA_MAX_AGE 的
+验证码会被丢弃，整个池子就这样不断轮换。每个验证码只发出一次，
+池子被取空时在请求中生成，不重用发出过的图片
+（否则攻击者可以积累图片到答案的对照表）。
+
+验证码的答案只保存在服务器端的缓存（SHARE_STATE_CACHE）中，
+request.share_state 里只有一个随机的键，客户端看不到答案。
+每个键只能验证一次，使用记录也保存在缓存中，重发旧的cookie不能重用验证码。
+多进程部署时 SHARE_STATE_CACHE 需要是进程间共享的缓存。
+"""
+
+import time
+import logging
+import threading
+from io import BytesIO
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.crypto import get_random_string, constant_time_compare
+
+from .views_libs import make_image, gentext, get_session_data, set_session_data
+from .metrics import captcha_renders, captcha_requests
+
+
+logger = logging.getLogger(__name__)
+
+
+def render():
+    """ 生成一个验证码，返回(文本, PNG数据) """
+    captcha_renders.inc()
+    text = gentext(4)
+    im = make_image(text)
+    imgout = BytesIO()
+    im.save(imgout, format='png')
+    return text, imgout.getvalue()
+
+
+class CaptchaPool:
+
+    def __init__(self, size=None, max_age=None):
+        self.size = size or getattr(settings, 'CAPTCHA_POOL_SIZE', 200)
+        self.max_age = max_age or getattr(settings, 'CAPTCHA_MAX_AGE', 600)
+        self.items = deque()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        """ 让后台线程退出，测试用 """
+        self.stopped = True
+        self.wakeup.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped:
+            self.expire()
+            try:
+                while len(self.items) < self.size and not self.stopped:
+                    self.items.append((time.monotonic(), render()))
+            except Exception:
+                # 生成失败时线程继续运行，稍后重试，池子空的时候在请求中生成
+                logger.exception('failed to render captcha')
+                time.sleep(1)
+                continue
+            self.wakeup.wait(self.max_age / 2)
+            self.wakeup.clear()
+
+    def expire(self):
+        deadline = time.monotonic() - self.max_age
+        while self.items and self.items[0][0] < deadline:
+            try:
+                self.items.popleft()
+            except IndexError:
+                break
+
+    def get(self):
+        """ 取出一个验证码，返回(文本, PNG数据) """
+        self.start()
+        try:
+            _, item = self.items.popleft()
+            captcha_requests.inc(source='pool')
+        except IndexError:
+            item = render()
+            captcha_requests.inc(source='rendered')
+        if len(self.items) < self.size // 2:
+            self.wakeup.set()
+        return item
+
+
+pool = CaptchaPool()
+
+
+def answers():
+    return caches[getattr(settings, 'SHARE_STATE_CACHE', 'default')]
+
+
+def remember(request, text):
+    """ 记录发给这个客户端的验证码的答案 """
+    key = get_random_string(32)
+    answers().set('captcha:' + key, text.lower(), settings.CAPTCHA_MAX_AGE)
+    set_session_data(request, 'captcha', key)
+
+
+def verify(request, text):
+    """ 对比验证码，无论是否匹配，这个验证码都不能再使用 """
+    key = get_session_data(request, 'captcha')
+    set_session_data(request, 'captcha', None)
+    if not key:
+        return False
+    cache = answers()
+    # add只在键不存在时成功，并发的重放也只有一个能通过
+    if not cache.add('captcha_used:' + key, 1, settings.CAPTCHA_MAX_AGE):
+        return False
+    answer = cache.get('captcha:' + key)
+    cache.delete('captcha:' + key)
+    return answer is not None and constant_time_compare(text.lower(), answer)
@@ -29,7 +29,7 @@ from thinap import ArgParser
 
 
 def help():
-    text = """available commands: login logout ls mkdir rmdir cp fetch
+    text = """available commands: login logout ls mkdir rmdir stat cp fetch
 
 路径表示法：
 
@@ -49,6 +49,15 @@ mkdir 命令用于创建远程目录
     -p 参数用于创建不存在的父目录，目标存在时也不出错
     -v 参数用于显示过程
 
+rmdir 命令用于删除远程的空目录
+
+    -r 参数用于递归删除整个目录树，包括其中的文件
+    -v 参数用于显示过程
+
+stat 命令用于批量查询远程文件的元数据，一次请求查询所有的路径
+
+    -s 参数后面跟校验和，查询服务器上是否已经有此内容的文件，可以多次使用
+
 cp 命令用于上传下载，远程路径写在前面是下载，写在后面是上传
 
     -o 参数使得不上传服务器上已有的文件 （秒传）
@@ -161,17 +170,28 @@ def logout(args, api):
     return True
 
 
+def post(api, data, cookies=None, session=None):
+    """
+    发送请求，返回(结果, 响应)，请求失败时结果是None。
+    session是requests.Session时使用它保存的cookie，
+    一个进程可以同时模拟多个用户（scripts/loadtest.py）
+    """
+    r = (session or requests).post(api, data=data, cookies=cookies)
+    if r.ok:
+        return r.json(), r
+    return None, r
+
+
 def send_request(api, data, send_cookies=True):
     if send_cookies:
         cookies = load_session()
     else:
         cookies = {}
-    r = requests.post(api, data=data, cookies=cookies)
-    if r.ok:
-        return r.json(), r
-    else:
+    res, r = post(api, data, cookies)
+    if res is None:
         print('request failed (code %s)' % r.status_code)
         return None, None
+    return res, r
 
 
 def ls(args, api):
@@ -253,15 +273,18 @@ def mkdir(args, api):
 
 def rmdir(args, api):
     request = {'parents': {'flag': '-p'},
+               'recursive': {'flag': '-r'},
                'verbose': {'flag': '-v'}}
     p = ArgParser()
     params = p.parse_args(args, request)
     mapping = params[0]
     parents = mapping.get('parents', False)
+    recursive = mapping.get('recursive', False)
     verbose = mapping.get('verbose', False)
     names = params[1] or []
 
-    data = dict(parents=parents, verbose=verbose, names=names)
+    data = dict(parents=parents, recursive=recursive, verbose=verbose,
+                names=names)
     res, r = send_request(api, data)
     if not res:
         return False
@@ -280,6 +303,38 @@ def rmdir(args, api):
         return True
 
 
+def stat(args, api):
+    request = {'digests': {'flag': '-s', 'arg': 1, 'multi': True}}
+    p = ArgParser()
+    params = p.parse_args(args, request)
+    mapping = params[0]
+    digests = mapping.get('digests', [])
+    names = params[1] or []
+
+    data = dict(names=names, digests=digests)
+    res, r = send_request(api, data)
+    if not res:
+        return False
+
+    # 字段：exists, regular, size, digest, time, name
+    for f in res['output']:
+        label = f.get('name', f.get('digest'))
+        if not f['exists']:
+            print('%s: not found' % label)
+            continue
+        type = '-' if f['regular'] else 'd'
+        print('%s %s %s %s %s' % (type, f['size'], f.get('digest') or '-',
+                                  f['time'], label))
+
+    # 输出错误信息
+    if not res['status']:
+        for e in res['errors']:
+            print('error:', e)
+        return False
+    else:
+        return True
+
+
 def cp(args, api):
     ...
 
@@ -307,6 +362,7 @@ if __name__ == '__main__':
         'ls': {'name': ls, 'api': 'http://127.0.0.1:8000/share/api/ls/'},
         'mkdir': {'name': mkdir, 'api': 'http://127.0.0.1:8000/share/api/mkdir/'},
         'rmdir': {'name': rmdir, 'api': 'http://127.0.0.1:8000/share/api/rmdir/'},
+        'stat': {'name': stat, 'api': 'http://127.0.0.1:8000/share/api/stat/'},
         'cp': {'name': cp, 'api': 'http://127.0.0.1:8000/share/api/cp/'},
         'fetch': {'name': fetch, 'api': 'http://127.0.0.1:8000/share/api/fetch/'},
     }
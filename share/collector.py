@@ -0,0 +1,200 @@
+"""
+回收服务器上不再使用的空间：
+
+1. 链接数为0的RegularFile记录（放入回收队列）
+2. 过期的、未完成的上传（临时文件及其RegularFile记录）
+3. 存储中没有任何记录引用的文件
+4. 没有任何记录使用其校验和的派生文件（.thumbs 中的缩略图，.lineidx 中的索引）
+
+数据库按主键分批扫描，文件系统按目录扫描，进度保存在状态文件中，
+中断后可以从上次的位置继续。文件系统操作按照设定的速率进行，
+避免影响正常的服务。
+"""
+
+import os
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import RegularFile, Reclaim
+from .libs import make_abspath, chunked
+from .storage import storage
+from .views_libs import reclaim_blobs
+
+
+# 按校验和存放派生文件的目录
+derived_dirs = ['.thumbs', '.lineidx']
+
+
+class Throttle:
+    """限制每秒的操作次数，rate为None时不限制"""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.last = 0
+
+    def wait(self):
+        if not self.rate:
+            return
+        delay = self.last + 1 / self.rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.last = time.monotonic()
+
+
+class Collector:
+
+    def __init__(self, grace=timedelta(days=1),
+                 upload_expire=timedelta(days=2), rate=None, batch=1000,
+                 state_path=None, dry_run=False):
+        self.grace = grace
+        self.upload_expire = upload_expire
+        self.throttle = Throttle(rate)
+        self.batch = batch
+        self.dry_run = dry_run
+        self.state_path = state_path or os.path.join(settings.MEDIA_ROOT,
+                                                     '.gc_state.json')
+        self.state = self.load_state()
+        self.stats = {'zero_link_rows': 0, 'partial_uploads': 0,
+                      'orphan_files': 0, 'derived_files': 0,
+                      'reclaimed_files': 0, 'bytes': 0}
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_state(self):
+        if self.dry_run:
+            return
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(self.state_path, 'w') as f:
+            json.dump(self.state, f)
+
+    def run(self):
+        self.collect_rows()
+        self.collect_orphans()
+        self.collect_derived()
+        if not self.dry_run:
+            count, size = reclaim_blobs()
+            self.stats['reclaimed_files'] += count
+            self.stats['bytes'] += size
+        return self.stats
+
+    def collect_rows(self):
+        """分批扫描RegularFile表，处理链接数为0的记录和过期的上传"""
+        now = timezone.now()
+        last_pk = self.state.get('last_pk', 0)
+        while True:
+            qs = RegularFile.objects.filter(pk__gt=last_pk).order_by('pk')
+            rows = list(qs[:self.batch])
+            if not rows:
+                break
+            last_pk = rows[-1].pk
+            for fo in rows:
+                if not fo.finished:
+                    if fo.time < now - self.upload_expire:
+                        self.remove_partial_upload(fo)
+                elif fo.links <= 0 and fo.time < now - self.grace:
+                    self.stats['zero_link_rows'] += 1
+                    if not self.dry_run:
+                        Reclaim.objects.create(path=fo.path, size=fo.size)
+                        fo.delete()
+            self.state['last_pk'] = last_pk
+            self.save_state()
+        # 一轮扫描完成，下次从头开始
+        self.state['last_pk'] = 0
+        self.save_state()
+
+    def remove_partial_upload(self, fo):
+        # 未完成的上传，path是本地临时文件的绝对路径
+        self.stats['partial_uploads'] += 1
+        if not os.path.isabs(fo.path):
+            # 已经记录了最终的路径（写入存储时中断），文件可能被其它记录共用，
+            # 由回收队列在没有引用时删除
+            if not self.dry_run:
+                with transaction.atomic():
+                    Reclaim.objects.create(path=fo.path, size=fo.size)
+                    fo.delete()
+            return
+        self.throttle.wait()
+        abspath = fo.path
+        try:
+            size = os.path.getsize(abspath)
+            if not self.dry_run:
+                os.remove(abspath)
+            self.stats['bytes'] += size
+        except FileNotFoundError:
+            ...
+        if not self.dry_run:
+            fo.delete()
+
+    def collect_orphans(self):
+        """删除没有被任何记录引用的文件"""
+        checkpoint = self.state.get('last_dir')
+        deadline = time.time() - self.grace.total_seconds()
+        for reldir, filenames in storage.walk():
+            if checkpoint is not None:
+                if reldir == checkpoint:
+                    checkpoint = None
+                continue
+            if not filenames:
+                continue
+
+            names = [os.path.join(reldir, x) for x in filenames]
+            # 未完成的上传使用临时文件的绝对路径
+            candidates = names + [make_abspath(x) for x in names
+                                  if make_abspath(x)]
+            known = set()
+            for chunk in chunked(candidates):
+                known.update(RegularFile.objects.filter(
+                    path__in=chunk).values_list('path', flat=True))
+                known.update(Reclaim.objects.filter(
+                    path__in=chunk).values_list('path', flat=True))
+
+            for name in names:
+                if name in known or make_abspath(name) in known:
+                    continue
+                self.throttle.wait()
+                st = storage.stat(name)
+                if st is None or st['mtime'] > deadline:
+                    continue
+                if not self.dry_run:
+                    storage.delete(name)
+                self.stats['orphan_files'] += 1
+                self.stats['bytes'] += st['size']
+
+            self.state['last_dir'] = reldir
+            self.save_state()
+        self.state.pop('last_dir', None)
+        self.save_state()
+
+    def collect_derived(self):
+        """删除原文件已经不存在的缩略图和行偏移索引"""
+        deadline = time.time() - self.grace.total_seconds()
+        for top in derived_dirs:
+            for reldir, filenames in storage.walk(top):
+                # 文件名以原文件的校验和开头
+                digests = {x.split('.')[0] for x in filenames}
+                known = set()
+                for chunk in chunked(digests):
+                    known.update(RegularFile.objects.filter(
+                        digest__in=chunk).values_list('digest', flat=True))
+                for filename in filenames:
+                    if filename.split('.')[0] in known:
+                        continue
+                    name = os.path.join(reldir, filename)
+                    self.throttle.wait()
+                    st = storage.stat(name)
+                    if st is None or st['mtime'] > deadline:
+                        continue
+                    if not self.dry_run:
+                        storage.delete(name)
+                    self.stats['derived_files'] += 1
+                    self.stats['bytes'] += st['size']
@@ -0,0 +1,161 @@
+"""
+文件内容的压缩存储
+
+上传时根据MIME类型，以及对开头一段数据试压缩的结果决定是否压缩，
+压缩方式记录在 RegularFile.codec 中（空字符串表示不压缩）。
+下载时，如果客户端接受该压缩方式（Accept-Encoding），直接发送压缩的数据，
+否则边读边解压。
+
+压缩的数据不能直接定位，读取中间的一段（预览，Range请求）需要从头解压，
+因此超过 COMPRESSION_MAX_SIZE 的文件不压缩，每次定位的代价不超过这个大小。
+
+zstd 需要安装 zstandard 模块，没有安装时使用 gzip。
+"""
+
+import re
+import zlib
+
+from django.conf import settings
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# 压缩方式 -> 存储路径的后缀
+suffixes = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def available(codec):
+    return codec == 'gzip' or (codec == 'zstd' and zstandard is not None)
+
+
+def choose_codec(mime, sample, size=None):
+    """
+    根据MIME类型，文件大小（size，未知时为None）和对样本的试压缩结果
+    选择压缩方式，不压缩时返回空字符串
+    """
+    codec = getattr(settings, 'COMPRESSION_CODEC', 'gzip')
+    if not codec:
+        return ''
+    max_size = getattr(settings, 'COMPRESSION_MAX_SIZE', 16 * 1024 * 1024)
+    if size is not None and max_size is not None and size > max_size:
+        return ''
+    if not available(codec):
+        codec = 'gzip'
+    patterns = getattr(settings, 'COMPRESSION_MIMETYPES', [r'^text/'])
+    if not any(re.match(pat, mime) for pat in patterns):
+        return ''
+    if not sample:
+        return ''
+    encoder = Encoder(codec)
+    size = len(encoder.compress(sample)) + len(encoder.flush())
+    min_ratio = getattr(settings, 'COMPRESSION_MIN_RATIO', 0.8)
+    return codec if size < len(sample) * min_ratio else ''
+
+
+class Encoder:
+    """流式压缩，codec为空字符串时原样输出"""
+
+    def __init__(self, codec):
+        self.codec = codec
+        if codec == 'gzip':
+            # wbits=31 生成gzip格式，可以直接作为 Content-Encoding: gzip 发送
+            self.obj = zlib.compressobj(6, zlib.DEFLATED, 31)
+        elif codec == 'zstd':
+            self.obj = zstandard.ZstdCompressor().compressobj()
+        else:
+            self.obj = None
+
+    def compress(self, data):
+        return self.obj.compress(data) if self.obj else data
+
+    def flush(self):
+        return self.obj.flush() if self.obj else b''
+
+
+class DecodedFile:
+    """读取压缩存储的文件，得到原始的内容，可以跳过开头的一段数据"""
+
+    def __init__(self, file, codec, start=0, end=None):
+        self.file = file
+        if codec == 'gzip':
+            self.obj = zlib.decompressobj(31)
+        else:
+            self.obj = zstandard.ZstdDecompressor().decompressobj()
+        self.buffer = b''
+        self.eof = False
+        self.remain = None if end is None else max(end - start, 0)
+        while start > 0 and self.remain != 0:
+            data = self.read_raw(min(start, 64 * 1024))
+            if not data:
+                break
+            start -= len(data)
+
+    def fill(self, size):
+        while not self.eof and len(self.buffer) < size:
+            data = self.file.read(64 * 1024)
+            if not data:
+                self.eof = True
+                if hasattr(self.obj, 'flush'):
+                    self.buffer += self.obj.flush()
+                break
+            self.buffer += self.obj.decompress(data)
+
+    def read_raw(self, size):
+        self.fill(size)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read(self, size=-1):
+        if self.remain is not None and (size < 0 or size > self.remain):
+            size = self.remain
+        if size < 0:
+            chunks = []
+            while True:
+                data = self.read_raw(64 * 1024)
+                if not data:
+                    break
+                chunks.append(data)
+            data = b''.join(chunks)
+        else:
+            data = self.read_raw(size)
+        if self.remain is not None:
+            self.remain -= len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(64 * 1024)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def accepts(request, codec):
+    """客户端是否接受该压缩方式，q=0 表示不接受"""
+    header = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    qvalues = {}
+    for item in header.split(','):
+        token, *params = [x.strip() for x in item.split(';')]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[token.lower()] = q
+    q = qvalues.get(codec, qvalues.get('*', 0.0))
+    return q > 0
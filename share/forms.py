@@ -20,3 +20,8 @@ class ShareForm(forms.Form):
 
 class UploadForm(forms.Form):
     files = forms.FileField(widget=forms.ClearableFileInput(attrs={'multiple': True}))
+
+
+class TransferForm(forms.Form):
+    target = forms.CharField(help_text='destination directory, e.g. /alice/docs')
+    name = forms.CharField(required=False, help_text='new name (optional)')
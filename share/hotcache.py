@@ -0,0 +1,197 @@
+"""
+匿名共享文件的热点缓存
+
+被匿名共享（shared_to_all）的文件常常被外链，短时间内有大量的访问。
+第一次访问时照常查询数据库，确认文件被匿名共享之后，把授权的结果和
+发送文件需要的信息（路径，大小，压缩方式，类型）记录在本进程的LRU缓存中，
+较小的文件连同内容一起缓存。之后的访问不再查询数据库，小文件直接从内存发送。
+
+缓存项在 HOT_CACHE_TTL 秒之后失效，匿名共享的失效时间更早时以共享为准。
+共享或文件记录有变化时，在进程间共享的缓存（HOT_CACHE_VERSION_CACHE）中
+换一个新的版本号，每次取缓存项时对比版本号，所有进程中旧的缓存项都不再使用
+（撤销的共享，删除的文件不会继续被发送）。版本号在变化时和事务提交后各换一次，
+避免其它进程在提交之前按照旧的数据重新填充缓存。
+"""
+
+import time
+import threading
+from io import BytesIO
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from .models import File, Share
+from .storage import storage
+from .compression import DecodedFile, accepts
+from .views_libs import blob_response
+from .metrics import cache_requests, record_download
+
+
+VERSION_KEY = 'hot_cache:version'
+
+
+class Entry:
+    __slots__ = ('name', 'path', 'size', 'stored_size', 'codec', 'digest',
+                 'content_type', 'data', 'deadline', 'version')
+
+    def open(self, start=0, end=None):
+        """与 RegularFile.open 相同，内容在内存中时不读取存储"""
+        if self.codec:
+            f = (storage.open(self.path) if self.data is None
+                 else BytesIO(self.data))
+            return DecodedFile(f, self.codec, start, end)
+        if self.data is None:
+            return storage.open(self.path, start, end)
+        return BytesIO(self.data[start:end])
+
+
+class HotCache:
+
+    def __init__(self, entries=None, max_bytes=None, blob_limit=None,
+                 ttl=None):
+        self.max_entries = entries or getattr(settings, 'HOT_CACHE_ENTRIES',
+                                              1024)
+        self.max_bytes = max_bytes or getattr(settings, 'HOT_CACHE_BYTES',
+                                              64 * 1024 * 1024)
+        self.blob_limit = blob_limit or getattr(
+            settings, 'HOT_CACHE_BLOB_LIMIT', 256 * 1024)
+        self.ttl = ttl or getattr(settings, 'HOT_CACHE_TTL', 30)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'fills': 0,
+                         'evictions': 0, 'invalidations': 0}
+
+    @staticmethod
+    def shared():
+        return caches[getattr(settings, 'HOT_CACHE_VERSION_CACHE', 'hot')]
+
+    def version(self):
+        """所有进程共享的版本号"""
+        return self.shared().get(VERSION_KEY)
+
+    def bump(self):
+        """换一个新的版本号，所有进程中已有的缓存项失效"""
+        self.shared().set(VERSION_KEY, get_random_string(16), None)
+        if self.entries:
+            self.clear()
+
+    def get(self, key):
+        """取出有效的缓存项，没有时返回None"""
+        version = self.version()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry.deadline <= time.monotonic()
+                                      or entry.version != version):
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.counters['misses'] += 1
+                cache_requests.inc(cache='hot', result='miss')
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            cache_requests.inc(cache='hot', result='hit')
+            return entry
+
+    def fill(self, key, file, fo, content_type):
+        """
+        file已经确认被匿名共享，记录发送它需要的信息。
+        没有永久的匿名共享时，缓存项不会晚于最晚失效的匿名共享。
+        先取版本号再查询共享，查询之后的变化都会换掉版本号。
+        """
+        version = self.version()
+        now = time.monotonic()
+        deadline = now + self.ttl
+        expires = [s.expire for s, _ in file.shares() if s.code is None]
+        if not expires:
+            return None
+        if None not in expires:
+            remain = (max(expires) - timezone.now()).total_seconds()
+            deadline = min(deadline, now + remain)
+        if deadline <= now:
+            return None
+
+        entry = Entry()
+        entry.name = file.name
+        entry.path = fo.path
+        entry.size = fo.size
+        entry.codec = fo.codec
+        entry.digest = fo.digest
+        entry.content_type = content_type
+        entry.deadline = deadline
+        entry.version = version
+        entry.stored_size = (storage.stat(fo.path)['size'] if fo.codec
+                             else fo.size)
+        entry.data = None
+        if entry.stored_size <= self.blob_limit:
+            with storage.open(fo.path) as f:
+                entry.data = f.read()
+
+        with self.lock:
+            self._drop(key)
+            self.entries[key] = entry
+            self.bytes += len(entry.data or b'')
+            self.counters['fills'] += 1
+            while (len(self.entries) > self.max_entries
+                   or self.bytes > self.max_bytes):
+                self._drop(next(iter(self.entries)))
+                self.counters['evictions'] += 1
+        return entry
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry.data or b'')
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            self.counters['invalidations'] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update(entries=len(self.entries), bytes=self.bytes)
+        return stats
+
+
+def response(request, entry):
+    """
+    根据缓存项发送文件，不访问数据库。内容在内存中的，一次性发送，
+    压缩存储的文件，客户端接受该压缩方式时发送压缩的数据。
+    Range请求以及不在内存中的文件，与普通的下载相同。
+    """
+    passthrough = not entry.codec or accepts(request, entry.codec)
+    if (entry.data is None or not passthrough
+            or 'HTTP_RANGE' in request.META):
+        return blob_response(request, entry, entry.content_type)
+    response = HttpResponse(entry.data)
+    record_download(len(entry.data))
+    if entry.codec:
+        response['Content-Encoding'] = entry.codec
+        response['Vary'] = 'Accept-Encoding'
+    response['Content-Length'] = str(entry.stored_size)
+    response['Content-Type'] = entry.content_type
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+hot = HotCache()
+
+
+@receiver(post_save, sender=Share)
+@receiver(post_delete, sender=Share)
+@receiver(post_save, sender=File)
+@receiver(post_delete, sender=File)
+def invalidate(sender, **kwargs):
+    hot.bump()
+    transaction.on_commit(hot.bump)
@@ -1,11 +1,10 @@
-import os
 import random
 
-from django.conf import settings
+from .storage import storage
 
 
 def make_abspath(path):
-    return os.path.join(settings.MEDIA_ROOT, path)
+    return storage.path(path)
 
 
 def gen_code(length=6):
@@ -14,3 +13,10 @@ def gen_code(length=6):
     chars = [chr(x) for x in nums]
     res = [random.choice(chars) for _ in range(length)]
     return ''.join(res)
+
+
+def chunked(seq, size=500):
+    """把序列切成固定大小的块，避免SQL语句中的参数过多"""
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
@@ -0,0 +1,45 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from share.collector import Collector
+
+
+class Command(BaseCommand):
+    help = ('Reclaim unreferenced blobs, expired partial uploads and '
+            'zero-link rows, report the space recovered')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int, default=24,
+                            help='only touch blobs older than this (hours)')
+        parser.add_argument('--upload-expire', type=int, default=48,
+                            help='partial uploads expire after this (hours)')
+        parser.add_argument('--rate', type=float, default=None,
+                            help='max file system operations per second')
+        parser.add_argument('--batch', type=int, default=1000,
+                            help='database rows per batch')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='only report, do not delete anything')
+        parser.add_argument('--loop', type=int, default=None,
+                            help='run forever, sleep this many seconds '
+                                 'between passes')
+
+    def handle(self, *args, **options):
+        while True:
+            collector = Collector(
+                grace=timedelta(hours=options['grace']),
+                upload_expire=timedelta(hours=options['upload_expire']),
+                rate=options['rate'], batch=options['batch'],
+                dry_run=options['dry_run'])
+            stats = collector.run()
+            self.stdout.write(
+                'zero-link rows: %(zero_link_rows)s, '
+                'partial uploads: %(partial_uploads)s, '
+                'orphan files: %(orphan_files)s, '
+                'derived files: %(derived_files)s, '
+                'reclaimed files: %(reclaimed_files)s, '
+                'bytes recovered: %(bytes)s' % stats)
+            if options['loop'] is None:
+                break
+            time.sleep(options['loop'])
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from share.models import RegularFile
+from share.storage import storage, blob_path
+from share.compression import suffixes
+from share.collector import Throttle
+
+
+class Command(BaseCommand):
+    help = ('Move existing blobs to the configured storage layout, '
+            'while the service keeps running')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=int, default=0,
+                            help='resume after this RegularFile pk')
+        parser.add_argument('--batch', type=int, default=1000,
+                            help='database rows per batch')
+        parser.add_argument('--rate', type=float, default=None,
+                            help='max blobs moved per second')
+
+    def handle(self, *args, **options):
+        throttle = Throttle(options['rate'])
+        last_pk = options['start']
+        moved = 0
+        while True:
+            qs = RegularFile.objects.filter(pk__gt=last_pk, finished=True)
+            rows = list(qs.order_by('pk')[:options['batch']])
+            if not rows:
+                break
+            for fo in rows:
+                old = fo.path
+                suffix = suffixes.get(fo.codec, '')
+                new = blob_path(fo.digest, fo.time, suffix=suffix)
+                if old == new or not storage.exists(old):
+                    continue
+                throttle.wait()
+                # 先建立新的链接，再修改记录，最后删除旧的路径，
+                # 迁移过程中任何时刻文件都可以通过记录中的路径访问
+                storage.link(old, new)
+                RegularFile.objects.filter(path=old).update(path=new)
+                storage.delete(old)
+                moved += 1
+            last_pk = rows[-1].pk
+            self.stdout.write('moved %s blobs, last pk %s' % (moved, last_pk))
+        self.stdout.write('done, moved %s blobs' % moved)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from share.storage import storage
+
+
+class Command(BaseCommand):
+    help = ('Move blobs to their preferred volume after volumes were added '
+            'to a sharded storage')
+
+    def handle(self, *args, **options):
+        if not hasattr(storage, 'rebalance'):
+            raise CommandError('the storage backend is not sharded')
+        moved = storage.rebalance()
+        self.stdout.write('moved %s blobs' % moved)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from share.views_libs import reclaim_blobs
+
+
+class Command(BaseCommand):
+    help = 'Remove the blobs queued for reclamation from the file system'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None,
+                            help='max number of queued blobs to process')
+
+    def handle(self, *args, **options):
+        count, size = reclaim_blobs(limit=options['limit'])
+        self.stdout.write('reclaimed %s files, %s bytes' % (count, size))
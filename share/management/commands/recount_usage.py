@@ -0,0 +1,17 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from share.usage import recount
+
+
+class Command(BaseCommand):
+    help = ('Recompute the directory totals and per-user storage usage '
+            'from the file records')
+
+    def add_arguments(self, parser):
+        parser.add_argument('users', nargs='*', type=int,
+                            help='user ids, default all users with files')
+
+    def handle(self, *args, **options):
+        recount(apps, options['users'] or None)
+        self.stdout.write('usage recounted')
@@ -0,0 +1,48 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from share.models import Share
+
+
+class Command(BaseCommand):
+    help = 'Delete expired shares in batches, optionally archive them first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=1000,
+                            help='rows deleted per transaction')
+        parser.add_argument('--archive', default=None,
+                            help='append expired shares to this file '
+                                 '(one JSON object per line) before deleting')
+        parser.add_argument('--loop', type=int, default=None,
+                            help='run forever, sleep this many seconds '
+                                 'between passes')
+
+    def handle(self, *args, **options):
+        while True:
+            count = sweep(options['batch'], options['archive'])
+            self.stdout.write('expired shares removed: %s' % count)
+            if options['loop'] is None:
+                break
+            time.sleep(options['loop'])
+
+
+def sweep(batch, archive=None):
+    """按照失效时间的索引分批删除失效的共享，返回删除的数量"""
+    count = 0
+    while True:
+        with transaction.atomic():
+            rows = list(Share.objects.expired().order_by('expire')
+                        .values('pk', 'target_id', 'code', 'expire')[:batch])
+            if not rows:
+                break
+            if archive:
+                with open(archive, 'a') as f:
+                    for row in rows:
+                        row['expire'] = row['expire'].isoformat()
+                        f.write(json.dumps(row) + '\n')
+            Share.objects.filter(pk__in=[x['pk'] for x in rows]).delete()
+        count += len(rows)
+    return count
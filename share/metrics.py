@@ -0,0 +1,352 @@
+"""
+运行指标
+
+进程内的计数器和直方图，由 /share/metrics/ 以Prometheus的文本格式输出。
+每个进程有自己的一份，多进程部署时由Prometheus按实例分别采集。
+
+请求的统计（RequestMetricsMiddleware）：每个视图的耗时，数据库查询次数和
+耗时，以及视图执行期间从存储读取和写入的数据量。流式发送响应体的时间和
+数据量不在其中，见传输的统计。
+"""
+
+import json
+import time
+import bisect
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.utils import CursorWrapper, CursorDebugWrapper
+
+
+logger = logging.getLogger('share.requests')
+
+# 默认的直方图分档
+time_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+count_buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Metric:
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels.get(x, '')) for x in self.labels)
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        text = ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\')
+                                     .replace('"', r'\"'))
+                        for k, v in pairs)
+        return '{%s}' % text
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield self.name + self.format_labels(key), value
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=time_buckets):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            item = self.values.get(key)
+            if item is None:
+                item = self.values[key] = [[0] * len(self.buckets), 0, 0]
+            if i < len(self.buckets):
+                item[0][i] += 1
+            item[1] += 1
+            item[2] += value
+
+    def samples(self):
+        with self.lock:
+            items = sorted((k, (list(v[0]), v[1], v[2]))
+                           for k, v in self.values.items())
+        for key, (counts, count, total) in items:
+            acc = 0
+            for bound, n in zip(self.buckets, counts):
+                acc += n
+                yield (self.name + '_bucket' +
+                       self.format_labels(key, [('le', bound)]), acc)
+            yield (self.name + '_bucket' +
+                   self.format_labels(key, [('le', '+Inf')]), count)
+            yield self.name + '_count' + self.format_labels(key), count
+            yield self.name + '_sum' + self.format_labels(key), total
+
+
+registry = []
+# 输出之前调用的函数，用来更新需要时才计算的值
+collectors = []
+
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+
+def render():
+    """Prometheus的文本格式"""
+    for func in collectors:
+        func()
+    lines = []
+    for metric in registry:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.type))
+        for name, value in metric.samples():
+            lines.append('%s %s' % (name, value))
+    return '\n'.join(lines) + '\n'
+
+
+request_duration = register(Histogram(
+    'share_request_duration_seconds', 'Time spent in the view',
+    ('view', 'method')))
+request_queries = register(Histogram(
+    'share_request_db_queries', 'Database queries per request',
+    ('view',), count_buckets))
+request_db_time = register(Histogram(
+    'share_request_db_seconds', 'Database time per request', ('view',)))
+storage_bytes = register(Counter(
+    'share_storage_bytes_total', 'Bytes read from and written to storage',
+    ('direction',)))
+
+transfer_bytes = register(Counter(
+    'share_transfer_bytes_total', 'Bytes downloaded and uploaded',
+    ('direction',)))
+transfer_duration = register(Histogram(
+    'share_transfer_duration_seconds', 'Duration of downloads and uploads',
+    ('direction',), (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800)))
+active_transfers = register(Gauge(
+    'share_active_transfers', 'Transfers in progress', ('direction',)))
+upload_dedup = register(Counter(
+    'share_upload_dedup_total',
+    'Uploads whose content was already stored (hit) or new (miss)',
+    ('result',)))
+magic_calls = register(Counter(
+    'share_libmagic_calls_total', 'MIME type detections with libmagic'))
+captcha_renders = register(Counter(
+    'share_captcha_renders_total', 'Captcha images rendered'))
+captcha_requests = register(Counter(
+    'share_captcha_requests_total',
+    'Captchas served from the pool or rendered in the request',
+    ('source',)))
+cache_requests = register(Counter(
+    'share_cache_requests_total', 'Cache lookups by cache and result',
+    ('cache', 'result')))
+quota_rejections = register(Counter(
+    'share_quota_rejections_total',
+    'Uploads and copies refused for exceeding the quota', ('reason',)))
+storage_used = register(Gauge(
+    'share_storage_used_bytes', 'Used space per storage volume',
+    ('volume',)))
+storage_total = register(Gauge(
+    'share_storage_total_bytes', 'Total space per storage volume',
+    ('volume',)))
+
+
+class Transfer:
+    """
+    统计一次下载：包装发送的文件，记录数据量和持续时间。
+    被包装的文件有fileno()时同样提供，服务器用sendfile发送时不经过read()，
+    此时按照预计的长度计算。
+    """
+
+    def __init__(self, file, length):
+        self.file = file
+        self.length = length
+        self.sent = 0
+        self.start = time.monotonic()
+        self.closed = False
+        if hasattr(file, 'fileno'):
+            self.fileno = file.fileno
+        active_transfers.inc(direction='download')
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.sent += len(data)
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.file.close()
+        active_transfers.inc(-1, direction='download')
+        transfer_bytes.inc(self.sent or self.length, direction='download')
+        transfer_duration.observe(time.monotonic() - self.start,
+                                  direction='download')
+
+
+def record_download(size):
+    """整个在内存中一次发送的下载"""
+    transfer_bytes.inc(size, direction='download')
+    transfer_duration.observe(0, direction='download')
+
+
+class track_upload:
+    """统计一次上传的处理，用于with语句"""
+
+    def __init__(self, size):
+        self.size = size
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        active_transfers.inc(direction='upload')
+
+    def __exit__(self, *args):
+        active_transfers.inc(-1, direction='upload')
+        transfer_bytes.inc(self.size, direction='upload')
+        transfer_duration.observe(time.monotonic() - self.start,
+                                  direction='upload')
+
+
+usage_checked = 0
+
+
+def collect_usage():
+    """存储的使用量，最多每分钟检查一次"""
+    global usage_checked
+    if usage_checked and time.monotonic() - usage_checked < 60:
+        return
+    from .storage import storage
+    for volume, st in storage.usage().items():
+        storage_used.set(st['used'], volume=volume)
+        storage_total.set(st['total'], volume=volume)
+    usage_checked = time.monotonic()
+
+
+collectors.append(collect_usage)
+
+
+# 当前线程正在处理的请求的统计
+local = threading.local()
+
+
+def count_storage(direction, size):
+    """存储读写的数据量，direction 是 read 或者 write"""
+    storage_bytes.inc(size, direction=direction)
+    stats = getattr(local, 'stats', None)
+    if stats is not None:
+        stats[direction] += size
+
+
+class QueryCounter:
+    """在当前线程的请求统计中记录每次查询的耗时，不格式化和记录SQL"""
+
+    def execute(self, sql, params=None):
+        start = time.monotonic()
+        try:
+            return super().execute(sql, params)
+        finally:
+            record_query(time.monotonic() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.monotonic()
+        try:
+            return super().executemany(sql, param_list)
+        finally:
+            record_query(time.monotonic() - start)
+
+
+class CountingCursor(QueryCounter, CursorWrapper):
+    pass
+
+
+class CountingDebugCursor(QueryCounter, CursorDebugWrapper):
+    pass
+
+
+def record_query(elapsed):
+    stats = getattr(local, 'stats', None)
+    if stats is not None:
+        stats['queries'] += 1
+        stats['db_time'] += elapsed
+
+
+class RequestMetricsMiddleware:
+    """
+    统计每个请求的耗时，数据库查询次数和耗时，存储的读写量。
+    DEBUG模式下以 X-* 头的形式附在响应中，同时记录到 share.requests 日志，
+    并汇总到直方图中。
+    Django 1.11 没有 connection.execute_wrapper（2.0加入），请求期间
+    替换本线程的连接的 make_cursor/make_debug_cursor 达到同样的效果，
+    不需要打开 force_debug_cursor 记录每条SQL。
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        conns = connections.all()
+        for conn in conns:
+            conn.make_cursor = (
+                lambda cursor, conn=conn: CountingCursor(cursor, conn))
+            conn.make_debug_cursor = (
+                lambda cursor, conn=conn: CountingDebugCursor(cursor, conn))
+        local.stats = {'read': 0, 'write': 0, 'queries': 0, 'db_time': 0.0}
+        start = time.monotonic()
+        try:
+            response = self.get_response(request)
+        finally:
+            elapsed = time.monotonic() - start
+            stats = local.stats
+            local.stats = None
+            for conn in conns:
+                del conn.make_cursor
+                del conn.make_debug_cursor
+
+        queries = stats['queries']
+        db_time = stats['db_time']
+        match = request.resolver_match
+        view = match.view_name if match else 'unknown'
+        request_duration.observe(elapsed, view=view, method=request.method)
+        request_queries.observe(queries, view=view)
+        request_db_time.observe(db_time, view=view)
+        logger.info(json.dumps({
+            'view': view, 'method': request.method,
+            'path': request.path, 'status': response.status_code,
+            'time': round(elapsed, 6), 'queries': queries,
+            'db_time': round(db_time, 6),
+            'storage_read': stats['read'], 'storage_write': stats['write']}))
+        if settings.DEBUG:
+            response['X-Request-Time'] = '%.6f' % elapsed
+            response['X-DB-Queries'] = str(queries)
+            response['X-DB-Time'] = '%.6f' % db_time
+            response['X-Storage-Read'] = str(stats['read'])
+            response['X-Storage-Write'] = str(stats['write'])
+        return response
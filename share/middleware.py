@@ -0,0 +1,78 @@
+import copy
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.utils.crypto import get_random_string
+
+
+class CookieStore:
+    """
+    数据签名后直接存放在cookie中，不需要访问数据库。
+    签名不加密，客户端可以读取，也可以重发旧的cookie，不要存放需要保密的数据
+    """
+
+    salt = 'share.middleware.CookieStore'
+
+    def load(self, cookie):
+        try:
+            return signing.loads(cookie, salt=self.salt,
+                                 max_age=settings.SHARE_STATE_MAX_AGE)
+        except signing.BadSignature:
+            return {}
+
+    def save(self, cookie, data):
+        return signing.dumps(data, salt=self.salt, compress=True)
+
+
+class CacheStore:
+    """数据存放在缓存中，cookie中只有一个随机的键"""
+
+    prefix = 'share_state:'
+
+    def __init__(self):
+        alias = getattr(settings, 'SHARE_STATE_CACHE', 'default')
+        self.cache = caches[alias]
+
+    def load(self, cookie):
+        return self.cache.get(self.prefix + cookie) or {}
+
+    def save(self, cookie, data):
+        cookie = cookie or get_random_string(32)
+        self.cache.set(self.prefix + cookie, data,
+                       settings.SHARE_STATE_MAX_AGE)
+        return cookie
+
+
+stores = {'cookie': CookieStore, 'cache': CacheStore}
+
+
+class ShareStateMiddleware:
+    """
+    匿名访问需要的少量状态（验证码，已经通过分享码验证的共享），
+    放在 request.share_state 中，不使用数据库中的session。
+    存储方式由 settings.SHARE_STATE_STORE 决定：cookie 或 cache。
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.store = stores[settings.SHARE_STATE_STORE]()
+
+    def __call__(self, request):
+        name = settings.SHARE_STATE_COOKIE_NAME
+        cookie = request.COOKIES.get(name)
+        data = self.store.load(cookie) if cookie else {}
+        request.share_state = data
+        original = copy.deepcopy(data)
+
+        response = self.get_response(request)
+
+        data = request.share_state
+        if data != original:
+            if data:
+                value = self.store.save(cookie, data)
+                response.set_cookie(name, value, httponly=True,
+                                    max_age=settings.SHARE_STATE_MAX_AGE)
+            else:
+                response.delete_cookie(name)
+        return response
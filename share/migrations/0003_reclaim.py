@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0002_auto_20180511_0532'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Reclaim',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=4096)),
+                ('size', models.IntegerField(default=0)),
+                ('time', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0003_reclaim'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='regularfile',
+            name='codec',
+            field=models.CharField(blank=True, default='', max_length=8),
+        ),
+    ]
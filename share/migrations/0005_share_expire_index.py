@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:27
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0004_regularfile_codec'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='share',
+            index=models.Index(fields=['target', 'expire'], name='share_share_target__a12f78_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='share',
+            index=models.Index(fields=['expire'], name='share_share_expire_3c6a3e_idx'),
+        ),
+    ]
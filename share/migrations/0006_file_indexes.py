@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def rename_duplicates(apps, schema_editor):
+    """同一个目录中重名的文件，除了最早的一个，都改为 名字 (n).扩展名"""
+    File = apps.get_model('share', 'File')
+    groups = (File.objects.exclude(parent=None).values('parent', 'name')
+              .annotate(n=Count('pk')).filter(n__gt=1))
+    for group in groups:
+        taken = set(File.objects.filter(parent=group['parent'])
+                    .values_list('name', flat=True))
+        dups = File.objects.filter(parent=group['parent'],
+                                   name=group['name']).order_by('pk')[1:]
+        stem, dot, ext = group['name'].rpartition('.')
+        if not stem:
+            stem, dot, ext = ext, '', ''
+        n = 1
+        for file in dups:
+            while True:
+                name = '%s (%d)%s%s' % (stem, n, dot, ext)
+                n += 1
+                if name not in taken:
+                    break
+            taken.add(name)
+            File.objects.filter(pk=file.pk).update(name=name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0005_share_expire_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='file',
+            name='parent',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='share.File'),
+        ),
+        migrations.RunPython(rename_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='file',
+            unique_together=set([('parent', 'name')]),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['parent', 'is_regular', 'name', 'owner', 'object_pk'], name='share_file_parent__a77131_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:59
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+from share.usage import recount
+
+
+def count_usage(apps, schema_editor):
+    recount(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0008_alter_user_username_max_length'),
+        ('share', '0006_file_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Usage',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('files', models.IntegerField(default=0)),
+                ('logical', models.BigIntegerField(default=0)),
+                ('physical', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='directoryfile',
+            name='total_files',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='directoryfile',
+            name='total_size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(count_usage, migrations.RunPython.noop),
+    ]
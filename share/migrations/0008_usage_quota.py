@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 23:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0007_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usage',
+            name='quota_bytes',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='usage',
+            name='quota_files',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 23:15
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0008_usage_quota'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='regularfile',
+            name='digest',
+            field=models.CharField(db_index=True, max_length=40),
+        ),
+    ]
@@ -2,13 +2,16 @@ import os
 import re
 
 import magic
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import User
-from django.conf import settings
-from django.db.models import F
+from django.db.models import F, Q
 from django.utils import timezone
 
-from .libs import make_abspath
+from .storage import storage
+from .thumbnails import thumbnail_names
+from .preview import index_name
+from .compression import DecodedFile
+from .metrics import magic_calls
 
 
 class File(models.Model):
@@ -17,15 +20,31 @@ class File(models.Model):
     # 拥有者
     owner = models.ForeignKey(User)
     # 所属的父目录
-    parent = models.ForeignKey('File', null=True)
+    parent = models.ForeignKey('File', null=True, db_index=False)
 
     # 后面的文件对象，通过property的方法根据文件类型，
     # 指向文件对象或目录对象
     object_pk = models.IntegerField(null=True)
     is_regular = models.BooleanField(default=True)  # directory/file
 
+    class Meta:
+        # 同一个目录中的名字不能重复，也用于按名字查找目录中的文件
+        unique_together = [('parent', 'name')]
+        # 包含了所有的字段，查询时不需要再读取表：目录的内容按照类型和
+        # 名字排序，以及家目录的查找（parent IS NULL, is_regular, name,
+        # owner）。以parent开始，parent不需要单独的索引
+        indexes = [
+            models.Index(fields=['parent', 'is_regular', 'name', 'owner',
+                                 'object_pk']),
+        ]
+
     @property
     def object(self):
+        # 列目录时批量读取的文件对象（load_objects），其它时候每次都查询
+        obj = self.__dict__.get('_object')
+        if (obj is not None and obj.pk == self.object_pk
+                and isinstance(obj, RegularFile) == self.is_regular):
+            return obj
         if self.is_regular:
             return RegularFile.objects.get(pk=self.object_pk)
         else:
@@ -35,26 +54,12 @@ class File(models.Model):
         """建立File与RegularFile/DirectoryFile之间的链接"""
         self.object_pk = fo.pk
         if isinstance(fo, RegularFile):
+            # 并发的复制和上传可能同时增加链接数，在数据库中加一
+            RegularFile.objects.filter(pk=fo.pk).update(
+                links=F('links') + 1)
             fo.links += 1
-            fo.save()
         self.save()
 
-    def unlink(self):
-        # 如果是最后一个指向文件的名字，则可以删除文件系统上的文件
-        assert self.is_regular, "only support regular file deletion"
-        fo = self.object
-        if fo.links == 1:
-            abspath = make_abspath(fo.path)
-            try:
-                os.remove(abspath)
-            except FileNotFoundError:
-                ...
-            fo.delete()
-        else:
-            fo.links = F('links') - 1
-            fo.save()
-        self.delete()
-
     def add(self, other):
         """往目录中添加子目录或常规文件"""
         fo = self.object
@@ -64,14 +69,15 @@ class File(models.Model):
             name = 'files'
         else:
             name = 'subdirs'
-        text = ':%s' % other.pk
+        text = ':%s:' % other.pk
         value = getattr(fo, name)
-        if text not in value:
-            setattr(fo, name, value + text)
+        if text not in value + ':':
+            setattr(fo, name, value + text[:-1])
             fo.size = len(fo.subdirs) + len(fo.files)
-            fo.save()
+            fo.save(update_fields=[name, 'size'])
             other.parent = self
             other.save()
+            self.update_totals(*other.totals())
 
     def remove(self, other):
         fo = self.object
@@ -81,12 +87,30 @@ class File(models.Model):
             name = 'files'
         else:
             name = 'subdirs'
-        text = ':%s' % other.pk
-        value = getattr(fo, name)
+        # 末尾加上冒号再比较，避免 :12 误匹配 :123
+        text = ':%s:' % other.pk
+        value = getattr(fo, name) + ':'
         if text in value:
-            setattr(fo, name, value.replace(text, ''))
+            setattr(fo, name, value.replace(text, ':', 1)[:-1])
             fo.size = len(fo.subdirs) + len(fo.files)
-            fo.save()
+            fo.save(update_fields=[name, 'size'])
+            size, files = other.totals()
+            self.update_totals(-size, -files)
+
+    def totals(self):
+        """文件或者整个目录树中常规文件的(总大小, 数量)"""
+        fo = self.object
+        return fo.total_size, fo.total_files
+
+    def update_totals(self, size, files):
+        """目录本身及所有父目录的统计，以及拥有者的使用量，增加size和files"""
+        if not size and not files:
+            return
+        pks = [node.object_pk for node in self.ancestors()]
+        DirectoryFile.objects.filter(pk__in=pks).update(
+            total_size=F('total_size') + size,
+            total_files=F('total_files') + files)
+        Usage.add(self.owner_id, files=files, logical=size)
 
     def mimetype(self):
         if not self.is_regular:
@@ -109,30 +133,35 @@ class File(models.Model):
             return 'octet'
 
     def raw_mimetype(self):
-        mime = magic.Magic(mime=True)
-        path = os.path.join(settings.MEDIA_ROOT, self.object.path)
-        return mime.from_file(path)
+        # 上传时已经记录了MIME类型，之前上传的文件第一次用到时检测并记录
+        fo = self.object
+        if not fo.mime:
+            magic_calls.inc()
+            with fo.open(0, 8192) as f:
+                fo.mime = magic.Magic(mime=True).from_buffer(f.read())
+            RegularFile.objects.filter(pk=fo.pk).update(mime=fo.mime)
+        return fo.mime
 
     def is_viewable(self):
         return self.mimetype() in ['pdf', 'text', 'image', 'audio', 'video']
 
-    def shares(self):
-        """查找文件本身及所有父母录所有的共享，返回迭代器，由近到远"""
-
-        def _shares(node):
-            return [x for x in node.share_set.all() if not x.is_expired()]
-
-        # 查找文件本身的共享
-        for s in _shares(self):
-            yield s, 'self'
-
-        # 查找所有的父目录的共享信息
+    def ancestors(self):
+        """文件本身及所有父目录，由近到远"""
         node = self
+        nodes = [node]
         while node.parent:
-            parent = node.parent
-            node = parent
-            for s in _shares(node):
-                yield s, 'parent'
+            node = node.parent
+            nodes.append(node)
+        return nodes
+
+    def shares(self):
+        """查找文件本身及所有父母录所有有效的共享，返回迭代器，由近到远"""
+        nodes = self.ancestors()
+        distance = {node.pk: i for i, node in enumerate(nodes)}
+        shares = Share.objects.live().filter(target__in=list(distance))
+        shares = sorted(shares, key=lambda x: (distance[x.target_id], x.pk))
+        for s in shares:
+            yield s, ('self' if s.target_id == self.pk else 'parent')
 
     def shared_status(self):
         """根据文件的共享状态返回字符串"""
@@ -175,6 +204,9 @@ class DirectoryFile(models.Model):
     time = models.DateTimeField(auto_now_add=True)
     # 目录的大小: subdirs和files的总长度
     size = models.IntegerField(default=0)
+    # 整个目录树中常规文件的总大小和数量，随着文件的增删增量地维护
+    total_size = models.BigIntegerField(default=0)
+    total_files = models.IntegerField(default=0)
 
 
 class RegularFile(models.Model):
@@ -184,14 +216,60 @@ class RegularFile(models.Model):
     received = models.IntegerField()
     # 开始上传时间
     time = models.DateTimeField(auto_now_add=True)
-    # 文件的校验和 (sha1)
-    digest = models.CharField(max_length=40)
+    # 文件的校验和 (sha1)，按校验和查询已有的文件（秒传）
+    digest = models.CharField(max_length=40, db_index=True)
     # 文件在服务器上的文件系统中的相对路径
     path = models.CharField(max_length=4096)
     # 文件上传是否完成
     finished = models.BooleanField(default=False)
     # 文件的链接数（类似文件系统的硬链接）
     links = models.IntegerField(default=0)
+    # 存储时的压缩方式，空字符串表示没有压缩
+    codec = models.CharField(max_length=8, default='', blank=True)
+    # 上传时检测的MIME类型，空字符串表示还没有检测
+    mime = models.CharField(max_length=255, default='', blank=True)
+
+    def open(self, start=0, end=None):
+        """读取文件的原始内容（解压之后的）中[start, end)范围的数据"""
+        if self.codec:
+            return DecodedFile(storage.open(self.path), self.codec, start, end)
+        return storage.open(self.path, start, end)
+
+    @staticmethod
+    def derived_names(digest):
+        """按校验和存放的派生文件：缩略图，行偏移索引"""
+        return thumbnail_names(digest) + [index_name(digest)]
+
+    @staticmethod
+    def delete_blob(path):
+        """
+        删除存储中的文件，没有记录使用相同的校验和时，同时删除派生文件。
+        调用者已经确认没有记录引用path
+        """
+        storage.delete(path)
+        digest = os.path.basename(path).split('.')[0]
+        if not RegularFile.objects.filter(digest=digest).exists():
+            for name in RegularFile.derived_names(digest):
+                storage.delete(name)
+
+    # 与DirectoryFile的统计相同的接口
+    @property
+    def total_size(self):
+        return self.size
+
+    @property
+    def total_files(self):
+        return 1
+
+
+class ShareQuerySet(models.QuerySet):
+
+    def live(self):
+        """没有失效的共享"""
+        return self.filter(Q(expire__isnull=True) | Q(expire__gt=timezone.now()))
+
+    def expired(self):
+        return self.filter(expire__lte=timezone.now())
 
 
 class Share(models.Model):
@@ -201,5 +279,51 @@ class Share(models.Model):
     # 该共享的失效时间
     expire = models.DateTimeField(null=True)
 
+    objects = ShareQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=['target', 'expire']),
+                   models.Index(fields=['expire'])]
+
     def is_expired(self):
         return self.expire is not None and self.expire <= timezone.now()
+
+
+class Reclaim(models.Model):
+    """链接数降为0的文件，等待在请求之外从文件系统上删除"""
+    # 文件在服务器上的文件系统中的相对路径
+    path = models.CharField(max_length=4096)
+    # 文件尺寸
+    size = models.IntegerField(default=0)
+    # 加入队列的时间
+    time = models.DateTimeField(auto_now_add=True)
+
+
+class Usage(models.Model):
+    """
+    用户的存储使用量，与文件的增删同时增量地更新：
+    logical是所有名字的文件大小之和（等于家目录的total_size），
+    physical是文件对象的大小之和，复制得到的名字共用同一个文件对象，
+    只计算一次
+    """
+    user = models.OneToOneField(User, primary_key=True)
+    # 常规文件的数量
+    files = models.IntegerField(default=0)
+    logical = models.BigIntegerField(default=0)
+    physical = models.BigIntegerField(default=0)
+    # 用户的配额，为空时使用 settings.QUOTA_BYTES/QUOTA_FILES（share/quota.py）
+    quota_bytes = models.BigIntegerField(null=True, blank=True)
+    quota_files = models.IntegerField(null=True, blank=True)
+
+    @classmethod
+    def add(cls, user_id, **deltas):
+        """增加各项的值，用户还没有记录时创建"""
+        changes = {name: F(name) + value for name, value in deltas.items()}
+        if cls.objects.filter(user_id=user_id).update(**changes):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(user_id=user_id, **deltas)
+        except IntegrityError:
+            # 并发的第一次写入已经创建了记录
+            cls.objects.filter(user_id=user_id).update(**changes)
@@ -0,0 +1,180 @@
+"""
+大文本文件的分页预览
+
+每次只读取文件的一个窗口（默认64KB），窗口的起止都对齐到行首。
+按行号跳转使用稀疏的行偏移索引：每隔 PREVIEW_INDEX_STEP 行记录一次该行的
+起始偏移，索引按校验和存放在存储的 .lineidx 目录中，每个文件只建立一次，
+文件被删除时一起删除（RegularFile.delete_blob，以及垃圾回收）。
+"""
+
+import os
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .storage import storage
+from .metrics import cache_requests
+
+
+def index_step():
+    return getattr(settings, 'PREVIEW_INDEX_STEP', 1000)
+
+
+def index_name(digest):
+    return os.path.join('.lineidx', digest[:2], digest + '.json')
+
+
+def skip_lines(chunk, pos, n, avg):
+    """
+    从pos开始跳过n个换行符，返回第n个换行符之后的位置，调用者保证chunk中
+    有足够的换行符。按平均行长avg估计范围，用bytes.count（C实现）计数，
+    不在Python中逐个查找换行符
+    """
+    while True:
+        end = min(pos + max(int(n * avg), 1), len(chunk))
+        count = chunk.count(b'\n', pos, end)
+        while count > n:
+            end = pos + (end - pos) // 2
+            count = chunk.count(b'\n', pos, end)
+        if count == n:
+            return chunk.rfind(b'\n', pos, end) + 1
+        n -= count
+        pos = end
+
+
+def build_index(fo, step):
+    """扫描文件，记录每隔step行的行首偏移"""
+    offsets = [0]
+    lines = 0
+    pos = 0
+    with fo.open() as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            left = chunk.count(b'\n')
+            avg = len(chunk) / max(left, 1)
+            # 到下一个需要记录的行首还有多少行
+            need = len(offsets) * step - lines
+            i = 0
+            while left >= need:
+                i = skip_lines(chunk, i, need, avg)
+                offsets.append(pos + i)
+                lines += need
+                left -= need
+                need = step
+            lines += left
+            pos += len(chunk)
+    return {'step': step, 'lines': lines, 'size': pos, 'offsets': offsets}
+
+
+# 最近使用的索引：校验和 -> 索引，按使用的先后排列，多个线程共用
+indexes = OrderedDict()
+indexes_lock = threading.Lock()
+
+
+def get_index(fo):
+    with indexes_lock:
+        index = indexes.get(fo.digest)
+        if index is not None:
+            indexes.move_to_end(fo.digest)
+    cache_requests.inc(cache='line_index',
+                       result='miss' if index is None else 'hit')
+    if index is None:
+        index = load_index(fo)
+        with indexes_lock:
+            indexes[fo.digest] = index
+            if len(indexes) > 32:
+                indexes.popitem(last=False)
+    return index
+
+
+def load_index(fo):
+    """取出行偏移索引，不存在就建立并保存"""
+    name = index_name(fo.digest)
+    try:
+        with storage.open(name) as f:
+            return json.loads(f.read().decode())
+    except FileNotFoundError:
+        ...
+    index = build_index(fo, index_step())
+    writer = storage.create()
+    try:
+        writer.write(json.dumps(index).encode())
+        writer.commit(name)
+    except Exception:
+        writer.abort()
+        raise
+    return index
+
+
+def read_window(fo, start, size):
+    """
+    从start开始读取大约size字节，返回(实际的起始偏移, 数据)。
+    起始位置向后对齐到行首，结束位置向前对齐到行尾（除非一行比窗口还长）。
+    """
+    start = max(0, min(start, fo.size))
+    begin = max(start - 1, 0)
+    with fo.open(begin, start + size) as f:
+        data = f.read()
+    if start > 0:
+        i = data.find(b'\n')
+        if i < 0:
+            return begin + len(data), b''
+        data = data[i + 1:]
+        start = begin + i + 1
+    end = start + len(data)
+    if end < fo.size:
+        i = data.rfind(b'\n')
+        if i >= 0:
+            data = data[:i + 1]
+    return start, data
+
+
+def line_offset(fo, line):
+    """第line行（从0开始）的起始偏移"""
+    index = get_index(fo)
+    step = index['step']
+    offsets = index['offsets']
+    line = max(0, min(line, index['lines']))
+    k = min(line // step, len(offsets) - 1)
+    pos = offsets[k]
+    skip = line - k * step
+    if not skip:
+        return pos
+    with fo.open(pos) as f:
+        while skip:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                break
+            i = -1
+            while skip:
+                i = chunk.find(b'\n', i + 1)
+                if i < 0:
+                    break
+                skip -= 1
+            if not skip:
+                return pos + i + 1
+            pos += len(chunk)
+    return pos
+
+
+def get_window(fo, mode='head', offset=0, line=0, size=None):
+    """按照模式取出窗口：head，tail，offset（字节偏移），line（行号）"""
+    default = getattr(settings, 'PREVIEW_WINDOW', 64 * 1024)
+    size = min(max(size or default, 1),
+               getattr(settings, 'PREVIEW_MAX_WINDOW', 1024 * 1024))
+    offset, line = max(offset, 0), max(line, 0)
+    if mode == 'tail':
+        start = max(fo.size - size, 0)
+    elif mode == 'offset':
+        start = offset
+    elif mode == 'line':
+        start = line_offset(fo, line)
+    else:
+        start = 0
+    start, data = read_window(fo, start, size)
+    return {'start': start, 'end': start + len(data), 'size': fo.size,
+            'data': data, 'window': size}
@@ -0,0 +1,154 @@
+"""
+用户的配额：实际占用的字节数（Usage.physical）和文件数（Usage.files）
+
+默认的配额是 settings.QUOTA_BYTES / QUOTA_FILES，Usage中的quota_bytes/
+quota_files不为空时以它们为准，None表示不限制。
+
+上传的请求由URL解析的结果识别（与分发到 views.upload 的规则相同）。
+上传在读取请求体之前检查（QuotaMiddleware，需要放在CsrfViewMiddleware
+检查表单之前起作用的位置，即AuthenticationMiddleware之后的任何位置）：
+Content-Length超过剩余的配额时直接返回413，不接收请求体。
+没有Content-Length或者估计不准时，由QuotaUploadHandler在接收数据时
+计数，超过时停止接收，视图返回413。
+ASGI部署时请求体在交给Django之前就已经接收，admit()在接收之前做同样的检查。
+handle_uploaded_file 写入每个文件时再检查一次，不依赖上面的检查。
+
+复制增加文件数，由copy_tree检查。超过配额时抛出QuotaExceeded。
+"""
+
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.http import HttpResponse
+from django.urls import resolve, Resolver404
+
+from .models import Usage
+from .metrics import quota_rejections
+
+
+class QuotaExceeded(ValueError):
+    """超过配额"""
+
+
+def remaining(user_id):
+    """剩余的(字节数, 文件数)，不限制的一项是None"""
+    usage = Usage.objects.filter(user_id=user_id).first() or Usage()
+    max_bytes = usage.quota_bytes
+    if max_bytes is None:
+        max_bytes = getattr(settings, 'QUOTA_BYTES', None)
+    max_files = usage.quota_files
+    if max_files is None:
+        max_files = getattr(settings, 'QUOTA_FILES', None)
+    return (None if max_bytes is None else max_bytes - usage.physical,
+            None if max_files is None else max_files - usage.files)
+
+
+def check(left, size=0, files=0):
+    """
+    left是remaining()的结果，增加size字节和files个文件是否超过配额，
+    超过时返回错误信息
+    """
+    bytes_left, files_left = left
+    if bytes_left is not None and size > bytes_left:
+        quota_rejections.inc(reason='bytes')
+        return 'quota exceeded: %d bytes left' % max(bytes_left, 0)
+    if files_left is not None and files > files_left:
+        quota_rejections.inc(reason='files')
+        return 'quota exceeded: %d files left' % max(files_left, 0)
+    return None
+
+
+def enforce(left, size=0, files=0):
+    """与check()相同，超过配额时抛出QuotaExceeded"""
+    error = check(left, size, files)
+    if error:
+        raise QuotaExceeded(error)
+
+
+def is_upload(method, path_info):
+    if method != 'POST':
+        return False
+    try:
+        return resolve(path_info).view_name == 'share:upload'
+    except Resolver404:
+        return False
+
+
+def content_length(meta):
+    try:
+        return int(meta.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return 0
+
+
+class QuotaUploadHandler(FileUploadHandler):
+    """接收上传的数据时计数，超过剩余的配额时停止接收"""
+
+    def __init__(self, request, left):
+        super().__init__(request)
+        self.left = left
+        self.size = 0
+        self.files = 0
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.files += 1
+        self.check()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.size += len(raw_data)
+        self.check()
+        return raw_data
+
+    def check(self):
+        error = check(self.left, self.size, self.files)
+        if error:
+            self.request.quota_error = error
+            raise StopUpload(connection_reset=True)
+
+    def file_complete(self, file_size):
+        return None
+
+
+class QuotaMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if (is_upload(request.method, request.path_info)
+                and request.user.is_authenticated()):
+            left = remaining(request.user.pk)
+            error = check(left, content_length(request.META), 1)
+            if error:
+                return HttpResponse(error, status=413)
+            if left != (None, None):
+                request.upload_handlers.insert(
+                    0, QuotaUploadHandler(request, left))
+        return self.get_response(request)
+
+
+def admit(environ):
+    """
+    ASGI部署时在接收请求体之前调用（settings.ASGI_ADMISSION），
+    拒绝时返回(状态码, 头, 内容)，否则返回None
+    """
+    if not is_upload(environ['REQUEST_METHOD'], environ['PATH_INFO']):
+        return None
+    cookies = {}
+    for item in environ.get('HTTP_COOKIE', '').split(';'):
+        name, _, value = item.strip().partition('=')
+        cookies[name] = value
+    key = cookies.get(settings.SESSION_COOKIE_NAME)
+    if not key:
+        return None
+    engine = import_module(settings.SESSION_ENGINE)
+    user_id = engine.SessionStore(key).get(SESSION_KEY)
+    if user_id is None:
+        return None
+    error = check(remaining(user_id), content_length(environ), 1)
+    if error:
+        return 413, [('Content-Type', 'text/plain')], error.encode()
+    return None
@@ -0,0 +1,507 @@
+"""
+文件内容在服务器上的存储
+
+文件按照校验和存放，存放的路径由布局(layout)决定：
+
+    fanout: 取校验和的前几段作为多级目录，如 ab/cd/abcd1234...，
+            每个目录中的条目数量有上限（默认每级256个）
+    daily:  旧的布局，按上传日期分目录，如 20180511/abcd1234...
+
+布局通过 settings.STORAGE_LAYOUT 和 settings.STORAGE_FANOUT 配置。
+
+存储后端通过 settings.STORAGE_BACKEND 和 settings.STORAGE_OPTIONS 配置，
+所有后端提供相同的接口：
+
+    open(name, start, end)  读取文件中[start, end)范围的内容
+    create()                创建一个写入器，接收数据后commit到最终的名字
+    delete(name)            删除文件
+    stat(name)              返回文件的大小和修改时间，不存在时返回None
+    walk(top)               遍历所有的文件（或者top目录下的文件），供垃圾回收使用
+    path(name)              文件在本地文件系统上的路径，不在本地时返回None
+    usage()                 每个卷的已用空间和总空间
+
+可用的后端：
+
+    share.storage.LocalStorage      单个目录，默认是MEDIA_ROOT
+    share.storage.ShardedStorage    多个磁盘，按校验和分布
+    share.storage.S3Storage         S3兼容的对象存储
+"""
+
+import io
+import os
+import hmac
+import shutil
+import hashlib
+import importlib
+import urllib.request
+import urllib.parse
+from urllib.error import HTTPError
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from xml.etree import ElementTree
+from tempfile import NamedTemporaryFile
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.functional import LazyObject, empty
+
+from .metrics import count_storage
+
+
+def blob_path(digest, time=None, layout=None, suffix=''):
+    """根据布局生成文件的相对路径，压缩存储的文件带有后缀"""
+    layout = layout or getattr(settings, 'STORAGE_LAYOUT', 'fanout')
+    if layout == 'daily':
+        return os.path.join(time.strftime('%Y%m%d'), digest + suffix)
+    widths = getattr(settings, 'STORAGE_FANOUT', (2, 2))
+    parts = []
+    pos = 0
+    for width in widths:
+        parts.append(digest[pos:pos + width])
+        pos += width
+    return os.path.join(*parts, digest + suffix)
+
+
+def block_size():
+    """流式发送文件时每次读取的数据量"""
+    return getattr(settings, 'STREAM_BLOCK_SIZE', 256 * 1024)
+
+
+class RangeFile:
+    """只读取底层文件中[start, end)范围的内容"""
+
+    def __init__(self, file, start=0, end=None):
+        self.file = file
+        self.remain = None if end is None else max(end - start, 0)
+        if start:
+            file.seek(start)
+        # 一直读到文件末尾的本地文件，提供fileno()，
+        # WSGI服务器的 wsgi.file_wrapper 可以用sendfile从当前位置发送
+        if self.remain is None and isinstance(file, io.BufferedReader):
+            self.fileno = file.fileno
+
+    def read(self, size=-1):
+        if self.remain is not None:
+            if size < 0 or size > self.remain:
+                size = self.remain
+            if size <= 0:
+                return b''
+        data = self.file.read(size) if size >= 0 else self.file.read()
+        if self.remain is not None:
+            self.remain -= len(data)
+        count_storage('read', len(data))
+        return data
+
+    def __iter__(self):
+        size = block_size()
+        while True:
+            data = self.read(size)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Writer:
+    """把上传的数据写入本地的临时文件，commit时放到最终的位置"""
+
+    def __init__(self, storage, dir):
+        os.makedirs(dir, mode=0o755, exist_ok=True)
+        self.storage = storage
+        self.file = NamedTemporaryFile(dir=dir, delete=False)
+        # 临时文件的路径，可以在上传完成之前记录到数据库中
+        self.name = self.file.name
+
+    def write(self, data):
+        self.file.write(data)
+        count_storage('write', len(data))
+
+    def commit(self, name):
+        self.file.close()
+        self.storage.put(self.name, name)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.name)
+        except FileNotFoundError:
+            ...
+
+
+class LocalStorage:
+    """存放在本地目录中的文件，root默认是MEDIA_ROOT"""
+
+    # 上传过程中的临时文件存放在这个子目录中
+    incoming = 'incoming'
+
+    def __init__(self, root=None):
+        self._root = root
+
+    @property
+    def root(self):
+        return self._root or settings.MEDIA_ROOT
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def create(self):
+        return Writer(self, self.path(self.incoming))
+
+    def put(self, tmpname, name):
+        """
+        把本地的临时文件放到name的位置。文件的内容由校验和决定，
+        name已经存在时不覆盖（可能正在被读取），直接删除临时文件
+        """
+        abspath = self.path(name)
+        dir = os.path.dirname(abspath)
+        os.makedirs(dir, mode=0o755, exist_ok=True)
+        if os.path.exists(abspath):
+            os.remove(tmpname)
+            return
+        try:
+            os.replace(tmpname, abspath)
+        except OSError:
+            # 临时文件在另一个文件系统上：先复制到目标目录中的临时文件，
+            # 再原子地改名，读取的一方不会看到不完整的文件
+            with open(tmpname, 'rb') as src, \
+                    NamedTemporaryFile(dir=dir, delete=False) as dst:
+                shutil.copyfileobj(src, dst, block_size())
+            try:
+                os.replace(dst.name, abspath)
+            except OSError:
+                os.remove(dst.name)
+                raise
+            os.remove(tmpname)
+
+    def link(self, src, dst):
+        """让文件同时可以通过两个名字访问（用于迁移布局）"""
+        abspath = self.path(dst)
+        os.makedirs(os.path.dirname(abspath), mode=0o755, exist_ok=True)
+        try:
+            os.link(self.path(src), abspath)
+        except FileExistsError:
+            ...
+
+    def open(self, name, start=0, end=None):
+        return RangeFile(open(self.path(name), 'rb'), start, end)
+
+    def stat(self, name):
+        try:
+            st = os.stat(self.path(name))
+        except FileNotFoundError:
+            return None
+        return {'size': st.st_size, 'mtime': st.st_mtime}
+
+    def exists(self, name):
+        return self.stat(name) is not None
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            ...
+
+    def walk(self, top=None):
+        """
+        按固定的顺序遍历所有文件，跳过以点开头的目录和文件。
+        top是以点开头的目录（如 .thumbs）时，只遍历这个目录
+        """
+        root = self.root
+        for dirpath, dirnames, filenames in os.walk(self.path(top or '')):
+            dirnames[:] = sorted(x for x in dirnames if not x.startswith('.'))
+            filenames = sorted(x for x in filenames if not x.startswith('.'))
+            reldir = os.path.relpath(dirpath, root)
+            yield ('' if reldir == '.' else reldir), filenames
+
+    def usage(self):
+        """返回每个卷的已用空间和总空间"""
+        st = shutil.disk_usage(self.root)
+        return {self.root: {'used': st.used, 'total': st.total}}
+
+
+class ShardedStorage:
+    """
+    分布在多个磁盘（卷）上的存储。
+
+    用rendezvous hashing按文件名中的校验和选择卷，增加卷的时候，
+    只有大约1/n的文件需要迁移到新卷；迁移完成之前，
+    在首选卷上找不到的文件会到其它卷上查找。
+    """
+
+    def __init__(self, volumes):
+        assert volumes, "at least one volume is required"
+        for root in volumes:
+            os.makedirs(root, mode=0o755, exist_ok=True)
+        self.volumes = [LocalStorage(root) for root in volumes]
+
+    def rank(self, name):
+        """按照优先顺序返回name所在的卷"""
+        key = os.path.basename(name)
+
+        def weight(volume):
+            text = ('%s:%s' % (volume.root, key)).encode()
+            return hashlib.sha1(text).digest()
+
+        return sorted(self.volumes, key=weight, reverse=True)
+
+    def locate(self, name):
+        for volume in self.rank(name):
+            if volume.exists(name):
+                return volume
+        return None
+
+    def path(self, name):
+        volume = self.locate(name) or self.rank(name)[0]
+        return volume.path(name)
+
+    def create(self):
+        # 临时文件写到剩余空间最多的卷上
+        volume = max(self.volumes, key=lambda x: shutil.disk_usage(x.root).free)
+        return Writer(self, volume.path(LocalStorage.incoming))
+
+    def put(self, tmpname, name):
+        self.rank(name)[0].put(tmpname, name)
+
+    def link(self, src, dst):
+        volume = self.locate(src)
+        if volume is not None:
+            volume.link(src, dst)
+
+    def open(self, name, start=0, end=None):
+        volume = self.locate(name)
+        if volume is None:
+            raise FileNotFoundError(name)
+        return volume.open(name, start, end)
+
+    def stat(self, name):
+        volume = self.locate(name)
+        return volume and volume.stat(name)
+
+    def exists(self, name):
+        return self.locate(name) is not None
+
+    def delete(self, name):
+        for volume in self.volumes:
+            volume.delete(name)
+
+    def walk(self, top=None):
+        for volume in self.volumes:
+            yield from volume.walk(top)
+
+    def usage(self):
+        res = {}
+        for volume in self.volumes:
+            res.update(volume.usage())
+        return res
+
+    def rebalance(self):
+        """把不在首选卷上的文件移动到首选卷，返回移动的文件数"""
+        moved = 0
+        for volume in self.volumes:
+            for reldir, filenames in volume.walk():
+                if reldir.split(os.sep)[0] == LocalStorage.incoming:
+                    continue
+                for filename in filenames:
+                    name = os.path.join(reldir, filename)
+                    primary = self.rank(name)[0]
+                    if primary is not volume:
+                        primary.put(volume.path(name), name)
+                        moved += 1
+        return moved
+
+
+class S3Storage:
+    """
+    S3兼容的对象存储，使用AWS Signature Version 4签名，
+    只依赖标准库。上传的数据先写到本地的临时文件，完成后一次PUT。
+    """
+
+    def __init__(self, endpoint, bucket, access_key, secret_key,
+                 region='us-east-1', prefix='', spool_dir=None, timeout=None):
+        self.endpoint = endpoint.rstrip('/')
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix
+        self._spool_dir = spool_dir
+        # 连接及每次读写的超时（秒），端点没有响应时不会一直阻塞
+        self.timeout = timeout or getattr(settings, 'STORAGE_TIMEOUT', 30)
+
+    @property
+    def spool_dir(self):
+        return self._spool_dir or os.path.join(settings.MEDIA_ROOT,
+                                               LocalStorage.incoming)
+
+    def path(self, name):
+        return None
+
+    def key(self, name):
+        return self.prefix + name
+
+    def sign(self, method, path, query, headers, payload_hash):
+        now = datetime.utcnow()
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        date = now.strftime('%Y%m%d')
+        host = urllib.parse.urlsplit(self.endpoint).netloc
+        headers.update({'Host': host, 'x-amz-date': amz_date,
+                        'x-amz-content-sha256': payload_hash})
+        names = sorted(headers, key=str.lower)
+        canonical_headers = ''.join('%s:%s\n' % (x.lower(), headers[x].strip())
+                                    for x in names)
+        signed_headers = ';'.join(x.lower() for x in names)
+        canonical_query = '&'.join(
+            '%s=%s' % (urllib.parse.quote(k, safe='-_.~'),
+                       urllib.parse.quote(v, safe='-_.~'))
+            for k, v in sorted(query.items()))
+        canonical = '\n'.join([method, path, canonical_query,
+                               canonical_headers, signed_headers,
+                               payload_hash])
+        scope = '%s/%s/s3/aws4_request' % (date, self.region)
+        to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                             hashlib.sha256(canonical.encode()).hexdigest()])
+
+        def _hmac(key, msg):
+            return hmac.new(key, msg.encode(), hashlib.sha256).digest()
+
+        key = _hmac(('AWS4' + self.secret_key).encode(), date)
+        for part in [self.region, 's3', 'aws4_request']:
+            key = _hmac(key, part)
+        signature = hmac.new(key, to_sign.encode(), hashlib.sha256).hexdigest()
+        headers['Authorization'] = (
+            'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, '
+            'Signature=%s' % (self.access_key, scope, signed_headers,
+                              signature))
+
+    def request(self, method, name=None, query=None, headers=None,
+                body=None):
+        path = '/%s' % self.bucket
+        if name is not None:
+            path += '/' + urllib.parse.quote(self.key(name))
+        query = query or {}
+        headers = headers or {}
+        self.sign(method, path, query, headers, 'UNSIGNED-PAYLOAD')
+        url = self.endpoint + path
+        if query:
+            url += '?' + urllib.parse.urlencode(sorted(query.items()))
+        req = urllib.request.Request(url, data=body, headers=headers,
+                                     method=method)
+        return urllib.request.urlopen(req, timeout=self.timeout)
+
+    def create(self):
+        return Writer(self, self.spool_dir)
+
+    def put(self, tmpname, name):
+        size = os.path.getsize(tmpname)
+        with open(tmpname, 'rb') as f:
+            headers = {'Content-Length': str(size)}
+            self.request('PUT', name, headers=headers, body=f).close()
+        os.remove(tmpname)
+
+    def link(self, src, dst):
+        source = '/%s/%s' % (self.bucket, urllib.parse.quote(self.key(src)))
+        headers = {'x-amz-copy-source': source}
+        self.request('PUT', dst, headers=headers).close()
+
+    def open(self, name, start=0, end=None):
+        headers = {}
+        if end is not None and end <= start:
+            # 空的范围在Range头中无法表示，服务器会忽略无效的范围发送整个文件
+            return RangeFile(io.BytesIO(), 0, 0)
+        if start or end is not None:
+            last = '' if end is None else end - 1
+            headers['Range'] = 'bytes=%s-%s' % (start, last)
+        try:
+            return RangeFile(self.request('GET', name, headers=headers))
+        except HTTPError as e:
+            if e.code == 404:
+                raise FileNotFoundError(name)
+            raise
+
+    def stat(self, name):
+        try:
+            r = self.request('HEAD', name)
+        except HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+        r.close()
+        mtime = r.headers.get('Last-Modified')
+        mtime = parsedate_to_datetime(mtime).timestamp() if mtime else 0
+        return {'size': int(r.headers['Content-Length']), 'mtime': mtime}
+
+    def exists(self, name):
+        return self.stat(name) is not None
+
+    def delete(self, name):
+        try:
+            self.request('DELETE', name).close()
+        except HTTPError as e:
+            if e.code != 404:
+                raise
+
+    def walk(self, top=None):
+        """按目录分组列出所有的对象"""
+        token = None
+        group, names = None, []
+        prefix = self.prefix + (top + '/' if top else '')
+        while True:
+            query = {'list-type': '2', 'prefix': prefix}
+            if token:
+                query['continuation-token'] = token
+            with self.request('GET', query=query) as r:
+                tree = ElementTree.parse(r)
+            root = tree.getroot()
+            ns = root.tag[:root.tag.index('}') + 1] if '}' in root.tag else ''
+            for item in root.iter(ns + 'Contents'):
+                key = item.find(ns + 'Key').text[len(self.prefix):]
+                # 与本地存储一样，跳过top之下以点开头的目录和文件
+                below = key[len(top) + 1:] if top else key
+                if any(x.startswith('.') for x in below.split('/')):
+                    continue
+                reldir, filename = os.path.split(key)
+                if reldir != group:
+                    if names:
+                        yield group, names
+                    group, names = reldir, []
+                names.append(filename)
+            token = root.findtext(ns + 'NextContinuationToken')
+            if not token:
+                break
+        if names:
+            yield group, names
+
+    def usage(self):
+        return {}
+
+
+def get_storage():
+    """根据配置创建存储后端"""
+    backend = getattr(settings, 'STORAGE_BACKEND', 'share.storage.LocalStorage')
+    options = getattr(settings, 'STORAGE_OPTIONS', {})
+    module_name, class_name = backend.rsplit('.', 1)
+    cls = getattr(importlib.import_module(module_name), class_name)
+    return cls(**options)
+
+
+class DefaultStorage(LazyObject):
+    def _setup(self):
+        self._wrapped = get_storage()
+
+
+storage = DefaultStorage()
+
+
+@receiver(setting_changed)
+def reset_storage(setting, **kwargs):
+    if setting in ('STORAGE_BACKEND', 'STORAGE_OPTIONS'):
+        storage._wrapped = empty
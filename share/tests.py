@@ -1,3 +1,1278 @@
-from django.test import TestCase
+import os
+import json
+import errno
+import socket
+import sqlite3
+import asyncio
+import gzip
+import shutil
+import tempfile
+import time
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from datetime import timedelta
+from concurrent.futures import Executor, Future
+from io import StringIO, BytesIO
+from unittest import mock
 
-# Create your tests here.
+from PIL import Image
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.signals import request_started, request_finished
+from django.core.wsgi import get_wsgi_application
+from django.apps import apps
+from django.db import close_old_connections, connection
+from django.db.models import QuerySet
+
+from .models import (File, RegularFile, DirectoryFile, Reclaim, Share,
+                     Usage)
+from .libs import make_abspath
+from .views_libs import (reclaim_blobs, blob_response, get_home, copy_tree,
+                         move_file, delete_tree, TransferError)
+from . import views_libs
+from .captcha import CaptchaPool, answers
+from . import captcha
+from .hotcache import hot, VERSION_KEY
+from .metrics import transfer_bytes, active_transfers, upload_dedup, magic_calls
+from .collector import Collector
+from .thumbnails import thumbnail_name
+from .preview import (get_window, index_name, build_index, get_index,
+                      indexes)
+from .usage import recount
+from .storage import (storage, blob_path, LocalStorage, ShardedStorage,
+                      S3Storage)
+from .views import handle_uploaded_file
+from .api import create_directory
+from .quota import is_upload, QuotaExceeded
+from pro1.asgi import AsgiHandler
+from pro1.sqlite.base import DatabaseWrapper
+
+
+class ShareTestCase(TestCase):
+    """
+    创建用户及其家目录，并使用临时的MEDIA_ROOT。
+    热点缓存的版本号放在内存缓存中，不在项目目录中创建文件缓存
+    """
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media_root,
+                                          HOT_CACHE_VERSION_CACHE='default')
+        self.override.enable()
+        self.user = User.objects.create_user('alice', password='abcd/1234')
+        self.home = create_directory('alice', self.user)
+        self.client.login(username='alice', password='abcd/1234')
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def upload(self, name, content, dir=None):
+        ufile = SimpleUploadedFile(name, content)
+        handle_uploaded_file(ufile, self.user, dir or self.home)
+        return File.objects.get(name=name, parent=dir or self.home)
+
+    def make_tree(self):
+        src = create_directory('src', self.user, self.home)
+        sub = create_directory('sub', self.user, src)
+        self.upload('a.txt', b'aaa', src)
+        self.upload('b.txt', b'bbb', sub)
+        return src
+
+
+class StatTest(ShareTestCase):
+
+    def test_stat_many_paths(self):
+        docs = create_directory('docs', self.user, self.home)
+        self.upload('a.txt', b'hello', docs)
+        names = ['docs', 'docs/a.txt', '/alice/docs/a.txt', 'missing',
+                 'docs/missing', '/bob/x']
+        res = self.client.post('/share/api/stat/', {'names': names}).json()
+        output = {r['name']: r for r in res['output']}
+        self.assertFalse(res['status'])
+        self.assertEqual(res['errors'], ['no permission on /bob/x'])
+        self.assertFalse(output['docs']['regular'])
+        self.assertEqual(output['docs/a.txt']['size'], 5)
+        self.assertTrue(output['/alice/docs/a.txt']['exists'])
+        self.assertFalse(output['missing']['exists'])
+        self.assertFalse(output['docs/missing']['exists'])
+
+    def test_stat_digests(self):
+        file = self.upload('a.txt', b'hello')
+        digest = file.object.digest
+        res = self.client.post('/share/api/stat/',
+                               {'digests': [digest, '0' * 40]}).json()
+        self.assertEqual([r['exists'] for r in res['output']], [True, False])
+        # 其他用户的文件不可见
+        bob = User.objects.create_user('bob', password='abcd/1234')
+        create_directory('bob', bob)
+        self.client.login(username='bob', password='abcd/1234')
+        res = self.client.post('/share/api/stat/', {'digests': [digest]})
+        self.assertEqual(res.json()['output'], [{'digest': digest,
+                                                 'exists': False}])
+
+
+class TransferTest(ShareTestCase):
+
+    def test_copy_tree_links_blobs(self):
+        src = self.make_tree()
+        dest = create_directory('dest', self.user, self.home)
+        res = self.client.post('/share/api/copy/',
+                               {'names': ['src'], 'target': 'dest'}).json()
+        self.assertTrue(res['status'], res['errors'])
+        copied = File.objects.get(name='src', parent=dest)
+        self.assertNotEqual(copied.object_pk, src.object_pk)
+        self.assertEqual(copied.object.subdirs.count(':'), 1)
+        self.assertEqual(copied.object.files.count(':'), 1)
+        b = File.objects.get(name='b.txt', parent__parent=copied)
+        self.assertEqual(b.object.links, 2)
+        self.assertEqual(RegularFile.objects.count(), 2)
+        self.assertIn(':%s' % copied.pk, dest.object.subdirs)
+
+    def test_move_and_rename(self):
+        src = self.make_tree()
+        dest = create_directory('dest', self.user, self.home)
+        res = self.client.post('/share/api/move/',
+                               {'names': ['src/a.txt'],
+                                'target': 'dest/c.txt'}).json()
+        self.assertTrue(res['status'], res['errors'])
+        moved = File.objects.get(parent=dest)
+        self.assertEqual(moved.name, 'c.txt')
+        self.assertEqual(moved.object.links, 1)
+        self.assertEqual(File.objects.get(pk=src.pk).object.files, '')
+
+    def test_move_into_itself(self):
+        src = self.make_tree()
+        res = self.client.post('/share/api/move/',
+                               {'names': ['src'], 'target': 'src/sub'}).json()
+        self.assertFalse(res['status'])
+        self.assertEqual(File.objects.get(pk=src.pk).parent, self.home)
+        sub = File.objects.get(name='sub', parent=src)
+        with self.assertRaises(TransferError):
+            copy_tree(src, sub, self.user)
+        with self.assertRaises(TransferError):
+            move_file(self.home, sub)
+
+    def test_name_taken_concurrently(self):
+        # 检查之后才出现的同名文件：数据库的唯一约束报错，不是500
+        src = self.make_tree()
+        a = File.objects.get(name='a.txt', parent=src)
+        self.upload('a.txt', b'xyz')
+        with mock.patch.object(views_libs, 'child_exists', return_value=False):
+            with self.assertRaises(TransferError):
+                copy_tree(a, self.home, self.user)
+            with self.assertRaises(TransferError):
+                move_file(a, self.home)
+        self.assertEqual(a.parent, src)
+        self.assertEqual(File.objects.get(pk=a.pk).parent, src)
+        self.assertEqual(RegularFile.objects.get(pk=a.object_pk).links, 1)
+
+        with mock.patch('share.views.child_exists', return_value=False):
+            res = self.client.post('/share/edit/%s/' % a.pk,
+                                   {'name': 'sub'})
+        self.assertContains(res, 'file exists: sub')
+        self.assertEqual(File.objects.get(pk=a.pk).name, 'a.txt')
+
+
+class DeleteTreeTest(ShareTestCase):
+
+    def test_recursive_rmdir(self):
+        src = self.make_tree()
+        self.client.post('/share/api/copy/', {'names': ['src/sub/b.txt'],
+                                              'target': 'b.txt'})
+        res = self.client.post('/share/api/rmdir/',
+                               {'names': ['src'], 'recursive': True}).json()
+        self.assertTrue(res['status'], res['errors'])
+        self.assertEqual(res['output'], ['/alice/src'])
+        self.assertFalse(File.objects.filter(pk=src.pk).exists())
+        self.assertEqual(File.objects.count(), 2)
+        self.assertEqual(DirectoryFile.objects.count(), 1)
+        self.assertEqual(self.home.object.subdirs, '')
+
+        # a.txt的链接数降为0，进入回收队列；b.txt 还有一个链接
+        self.assertEqual(RegularFile.objects.get().links, 1)
+        item = Reclaim.objects.get()
+        self.assertTrue(os.path.exists(make_abspath(item.path)))
+        self.assertEqual(reclaim_blobs(), (1, 3))
+        self.assertFalse(os.path.exists(make_abspath(item.path)))
+        self.assertFalse(Reclaim.objects.exists())
+
+    def test_tree_changed(self):
+        # 收集之后加入目录的文件（这里在同一个事务中加入，重试时一起回滚），
+        # 不会被级联删除而漏掉链接数和回收队列
+        src = self.make_tree()
+        sub = File.objects.get(name='sub', parent=src)
+        real = views_libs.collect_tree
+        calls = []
+
+        def collect_tree(file):
+            result = real(file)
+            calls.append(file.pk)
+            if len(calls) == 1:
+                self.upload('c.txt', b'ccc', sub)
+            return result
+
+        with mock.patch.object(views_libs, 'collect_tree', collect_tree):
+            delete_tree(src)
+        self.assertEqual(calls, [src.pk, src.pk])
+        self.assertEqual(File.objects.count(), 1)
+        self.assertFalse(RegularFile.objects.exists())
+        self.assertEqual(Reclaim.objects.count(), 2)
+        usage = Usage.objects.get(user=self.user)
+        self.assertEqual((usage.files, usage.logical, usage.physical),
+                         (0, 0, 0))
+
+    def test_delete_requires_owner(self):
+        src = self.make_tree()
+        User.objects.create_user('bob', password='abcd/1234')
+        self.client.login(username='bob', password='abcd/1234')
+        res = self.client.post('/share/delete/%s/' % src.pk,
+                               {'submit': 'Delete', 'next': '/share/'})
+        self.assertEqual(res.status_code, 404)
+        self.assertTrue(File.objects.filter(pk=src.pk).exists())
+
+
+class StorageTest(ShareTestCase):
+
+    def test_fanout_layout(self):
+        file = self.upload('a.txt', b'aaa')
+        digest = file.object.digest
+        self.assertEqual(file.object.path,
+                         '%s/%s/%s' % (digest[:2], digest[2:4], digest))
+        self.assertTrue(os.path.exists(make_abspath(file.object.path)))
+
+    def test_download(self):
+        file = self.upload('a.txt', b'hello world\n')
+        res = self.client.get('/share/download/%s/' % file.pk)
+        self.assertEqual(b''.join(res.streaming_content), b'hello world\n')
+        res = self.client.get('/share/view/%s/' % file.pk)
+        self.assertEqual(res['Content-Type'], 'text/plain')
+
+    def test_shared_blob_survives_unlink(self):
+        a = self.upload('a.txt', b'aaa')
+        b = self.upload('b.txt', b'aaa')
+        self.assertEqual(a.object.path, b.object.path)
+        delete_tree(a)
+        reclaim_blobs()
+        self.assertTrue(os.path.exists(make_abspath(b.object.path)))
+
+    def test_migrate_layout(self):
+        file = self.upload('a.txt', b'aaa')
+        fo = file.object
+        old = blob_path(fo.digest, fo.time, layout='daily')
+        os.makedirs(os.path.dirname(make_abspath(old)))
+        os.rename(make_abspath(fo.path), make_abspath(old))
+        RegularFile.objects.filter(pk=fo.pk).update(path=old)
+        call_command('migrate_layout', stdout=StringIO())
+        fo.refresh_from_db()
+        self.assertEqual(fo.path, blob_path(fo.digest))
+        self.assertTrue(os.path.exists(make_abspath(fo.path)))
+        self.assertFalse(os.path.exists(make_abspath(old)))
+
+        with override_settings(STORAGE_LAYOUT='daily'):
+            call_command('migrate_layout', stdout=StringIO())
+        fo.refresh_from_db()
+        self.assertEqual(fo.path, old)
+        self.assertTrue(os.path.exists(make_abspath(old)))
+
+    def test_path_recorded_before_commit(self):
+        # 写入存储时，数据库中已经有引用这个路径的记录，并发的删除不会删除它
+        paths = []
+        real_put = storage.put
+
+        def put(tmpname, name):
+            paths.append(list(RegularFile.objects.filter(path=name)))
+            real_put(tmpname, name)
+
+        with mock.patch.object(storage, 'put', put):
+            self.upload('a.txt', b'aaa')
+        self.assertEqual(len(paths[0]), 1)
+
+
+class CompressionTest(ShareTestCase):
+
+    def test_text_compressed_at_rest(self):
+        content = b''.join(b'line %d: something happened\n' % i
+                           for i in range(10000))
+        file = self.upload('app.log', content)
+        fo = file.object
+        self.assertEqual(fo.codec, 'gzip')
+        self.assertTrue(fo.path.endswith('.gz'))
+        self.assertEqual(fo.size, len(content))
+        self.assertLess(os.path.getsize(make_abspath(fo.path)),
+                        len(content) / 4)
+        with fo.open(100, 200) as f:
+            self.assertEqual(f.read(), content[100:200])
+
+        url = '/share/download/%s/' % file.pk
+        res = self.client.get(url)
+        self.assertEqual(b''.join(res.streaming_content), content)
+        self.assertEqual(res['Content-Length'], str(len(content)))
+        res = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(res['Content-Encoding'], 'gzip')
+        body = b''.join(res.streaming_content)
+        self.assertEqual(gzip.decompress(body), content)
+        res = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip;q=0, br')
+        self.assertFalse(res.has_header('Content-Encoding'))
+        self.assertEqual(b''.join(res.streaming_content), content)
+
+    def test_binary_stored_raw(self):
+        file = self.upload('data.bin', os.urandom(100000))
+        self.assertEqual(file.object.codec, '')
+
+    @override_settings(COMPRESSION_MAX_SIZE=100000)
+    def test_large_text_stored_raw(self):
+        content = b'x' * 100001
+        self.assertEqual(self.upload('big.log', content).object.codec, '')
+        self.assertEqual(self.upload('small.log', content[:99999]).object.codec,
+                         'gzip')
+
+
+class ListDirTest(ShareTestCase):
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get('/share/list/%s/' % self.home.pk)
+        self.assertEqual(res.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_queries(self):
+        # 查询的数量与目录中的文件数无关，也不再检测MIME类型
+        create_directory('docs', self.user, self.home)
+        self.upload('a.txt', b'aaa')
+        queries = self.count_queries()
+        for name in 'bcde':
+            self.upload(name + '.txt', name.encode() * 3)
+        create_directory('more', self.user, self.home)
+        calls = magic_calls.get()
+        self.assertEqual(self.count_queries(), queries)
+        self.assertEqual(magic_calls.get(), calls)
+
+    def test_mime_recorded(self):
+        file = self.upload('a.txt', b'hello\n')
+        self.assertEqual(file.object.mime, 'text/plain')
+        # 之前上传的文件第一次用到时检测并记录
+        RegularFile.objects.update(mime='')
+        self.assertEqual(file.mimetype(), 'text')
+        self.assertEqual(RegularFile.objects.get().mime, 'text/plain')
+
+
+class ThumbnailTest(ShareTestCase):
+
+    def test_thumbnail(self):
+        buf = BytesIO()
+        Image.new('RGB', (1600, 1200), color='red').save(buf, format='PNG')
+        file = self.upload('big.png', buf.getvalue())
+        digest = file.object.digest
+        url = '/share/thumbnail/%s/64/%s/' % (file.pk, digest)
+        res = self.client.get(url)
+        self.assertEqual(res['Content-Type'], 'image/jpeg')
+        self.assertIn('immutable', res['Cache-Control'])
+        im = Image.open(BytesIO(b''.join(res.streaming_content)))
+        self.assertEqual(im.size, (64, 48))
+
+        res = self.client.get('/share/thumbnail/%s/64/%s/' % (file.pk, '0' * 40))
+        self.assertEqual(res.status_code, 404)
+        res = self.client.get('/share/thumbnail/%s/65/%s/' % (file.pk, digest))
+        self.assertEqual(res.status_code, 404)
+
+
+@override_settings(PREVIEW_INDEX_STEP=100, PREVIEW_WINDOW=1000)
+class PreviewTest(ShareTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.content = b''.join(b'line %d\n' % i for i in range(100000))
+        self.file = self.upload('big.log', self.content)
+        self.url = '/share/preview/%s/' % self.file.pk
+
+    def get(self, **params):
+        params['format'] = 'raw'
+        res = self.client.get(self.url, params)
+        return int(res['X-Preview-Start']), res.content
+
+    def test_head_and_tail(self):
+        start, data = self.get()
+        self.assertEqual(start, 0)
+        self.assertTrue(data.startswith(b'line 0\n'))
+        self.assertTrue(data.endswith(b'\n'))
+        self.assertLessEqual(len(data), 1000)
+        start, data = self.get(mode='tail')
+        self.assertTrue(data.startswith(b'line '))
+        self.assertTrue(data.endswith(b'line 99999\n'))
+        self.assertEqual(self.content[start:], data)
+        res = self.client.get(self.url, {'mode': 'tail'})
+        self.assertContains(res, 'line 99999')
+
+    def test_offset_aligned(self):
+        start, data = self.get(mode='offset', offset=12345)
+        self.assertGreaterEqual(start, 12345)
+        self.assertEqual(self.content[start - 1:start], b'\n')
+        self.assertEqual(self.content[start:start + len(data)], data)
+
+    def test_invalid_window(self):
+        for params in ({'size': -1}, {'mode': 'offset', 'offset': -5},
+                       {'mode': 'line', 'line': 0}):
+            params['format'] = 'raw'
+            res = self.client.get(self.url, params)
+            self.assertEqual(res.status_code, 400, params)
+        window = get_window(self.file.object, size=-1, offset=-5)
+        self.assertLessEqual(len(window['data']), 8)
+        with self.file.object.open(10, 5) as f:
+            self.assertEqual(f.read(), b'')
+
+    def test_index(self):
+        index = build_index(self.file.object, 100)
+        self.assertEqual(index['lines'], 100000)
+        expected = [0]
+        for i in range(100, 100001, 100):
+            expected.append(self.content.index(b'line %d\n' % i)
+                            if i < 100000 else len(self.content))
+        self.assertEqual(index['offsets'], expected)
+
+        # 最近使用的索引不被淘汰
+        indexes.clear()
+        get_index(self.file.object)
+        for i in range(31):
+            indexes['%040x' % i] = {}
+        get_index(self.file.object)
+        get_index(self.upload('other.log', b'a\nb\n').object)
+        self.assertIn(self.file.object.digest, indexes)
+        self.assertNotIn('%040x' % 0, indexes)
+        indexes.clear()
+
+    def test_jump_to_line(self):
+        for line in [1, 100, 101, 12345, 100000]:
+            start, data = self.get(mode='line', line=line)
+            self.assertTrue(data.startswith(b'line %d\n' % (line - 1)), line)
+
+
+class CaptchaTest(ShareTestCase):
+
+    def test_pool(self):
+        pool = CaptchaPool(size=4)
+        self.addCleanup(pool.stop)
+        text, png = pool.get()
+        self.assertEqual(len(text), 4)
+        self.assertEqual(Image.open(BytesIO(png)).size, (70, 40))
+        for _ in range(20):
+            pool.get()
+
+    def test_drained_pool_renders(self):
+        pool = CaptchaPool(size=4)
+        pool.thread = threading.current_thread()    # 不启动后台线程
+        served = [pool.get()[1] for _ in range(5)]
+        self.assertEqual(len(set(served)), 5)
+
+    def test_render_failure(self):
+        # 生成失败时后台线程继续运行
+        real = captcha.render
+        pool = CaptchaPool(size=2)
+        failed = []
+
+        def render():
+            # 只让这个池子的线程失败一次，模块级的 captcha.pool 可能也在运行
+            if threading.current_thread() is pool.thread and not failed:
+                failed.append(1)
+                raise OSError('font missing')
+            return real()
+
+        try:
+            with self.assertLogs('share.captcha', 'ERROR'), \
+                    mock.patch.object(captcha, 'render', render):
+                pool.start()
+                for _ in range(50):
+                    if len(pool.items) == 2:
+                        break
+                    time.sleep(0.1)
+        finally:
+            pool.stop()
+        self.assertEqual(failed, [1])
+        self.assertEqual(len(pool.items), 2)
+
+    def test_login_with_captcha(self):
+        self.client.logout()
+        res = self.client.get('/share/captcha/')
+        self.assertEqual(res['Content-Type'], 'image/png')
+        key = res.wsgi_request.share_state['captcha']
+        text = answers().get('captcha:' + key)
+        res = self.client.post('/share/login/', {
+            'username': 'alice', 'password': 'abcd/1234', 'captcha': text})
+        self.assertEqual(res.status_code, 302)
+
+    @override_settings(SHARE_STATE_STORE='cache')
+    def test_replay(self):
+        self.client.logout()
+        res = self.client.get('/share/captcha/')
+        cookie = self.client.cookies['share_state'].value
+        key = res.wsgi_request.share_state['captcha']
+        text = answers().get('captcha:' + key)
+        # cookie中只有键，没有答案
+        self.assertNotIn(text, repr(res.wsgi_request.share_state))
+        data = {'username': 'alice', 'password': 'abcd/1234', 'captcha': text}
+        self.assertEqual(self.client.post('/share/login/', data).status_code,
+                         302)
+        self.client.logout()
+        self.client.cookies['share_state'] = cookie
+        res = self.client.post('/share/login/', data)
+        self.assertEqual(res.status_code, 200)
+        self.assertContains(res, '验证码不匹配')
+
+    def test_shared_cache(self):
+        # 答案需要在所有进程中可见，不能放在每个进程一份的内存缓存中
+        self.assertNotIsInstance(answers(), LocMemCache)
+
+
+class ShareStateTest(ShareTestCase):
+
+    def test_share_code_approval(self):
+        file = self.upload('a.txt', b'hello')
+        share = Share.objects.create(target=file, code='abcdef')
+        self.client.logout()
+        url = '/share/download/%s/' % file.pk
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.post('/share/post_code/%s/' % file.pk, {'code': 'abcdef'})
+        self.assertIn('share_state', self.client.cookies)
+        res = self.client.get(url)
+        self.assertEqual(b''.join(res.streaming_content), b'hello')
+        self.assertEqual(res.wsgi_request.share_state['shares'], [share.pk])
+
+    @override_settings(SHARE_STATE_MAX_APPROVALS=3)
+    def test_approvals_bounded(self):
+        file = self.upload('a.txt', b'hello')
+        for i in range(5):
+            Share.objects.create(target=file, code='code%02d' % i)
+            self.client.post('/share/post_code/%s/' % file.pk,
+                             {'code': 'code%02d' % i})
+        res = self.client.get('/share/detail/%s/' % file.pk)
+        self.assertEqual(len(res.wsgi_request.share_state['shares']), 3)
+
+
+class ShareExpireTest(ShareTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.src = self.make_tree()
+        self.file = File.objects.get(name='b.txt')
+        past = timezone.now() - timedelta(days=1)
+        self.live = Share.objects.create(target=self.src, code=None)
+        self.dead = Share.objects.create(target=self.file, code='abcd',
+                                         expire=past)
+
+    def test_shares_skip_expired(self):
+        shares = list(self.file.shares())
+        self.assertEqual(shares, [(self.live, 'parent')])
+        self.assertEqual(list(Share.objects.live()), [self.live])
+
+    def test_list_shares(self):
+        res = self.client.get('/share/share/list/')
+        self.assertEqual(list(res.context['shares']), [self.live])
+
+    def test_sweep(self):
+        archive = os.path.join(self.media_root, 'archive.jsonl')
+        call_command('sweep_shares', batch=1, archive=archive,
+                     stdout=StringIO())
+        self.assertEqual(list(Share.objects.all()), [self.live])
+        with open(archive) as f:
+            self.assertIn('"code": "abcd"', f.read())
+
+
+class RangeTest(ShareTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.content = bytes(range(256)) * 64
+        self.file = self.upload('a.bin', self.content)
+        self.url = '/share/download/%s/' % self.file.pk
+
+    def get(self, range):
+        res = self.client.get(self.url, HTTP_RANGE=range)
+        body = b''.join(res.streaming_content) if res.streaming else b''
+        return res, body
+
+    def test_ranges(self):
+        res, body = self.get('bytes=10-19')
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(body, self.content[10:20])
+        self.assertEqual(res['Content-Range'], 'bytes 10-19/16384')
+        res, body = self.get('bytes=-100')
+        self.assertEqual(body, self.content[-100:])
+        res, body = self.get('bytes=16000-')
+        self.assertEqual(body, self.content[16000:])
+        res, body = self.get('bytes=20000-')
+        self.assertEqual(res.status_code, 416)
+        res, body = self.get('bytes=0-1,5-6')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Accept-Ranges'], 'bytes')
+        res, body = self.get('bytes=5-3')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(body, self.content)
+
+    def test_compressed_range(self):
+        file = self.upload('a.txt', b'0123456789\n' * 1000)
+        res = self.client.get('/share/download/%s/' % file.pk,
+                              HTTP_RANGE='bytes=5-15',
+                              HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(res.status_code, 206)
+        self.assertNotIn('Content-Encoding', res)
+        self.assertEqual(b''.join(res.streaming_content), b'56789\n01234')
+
+    def test_file_wrapper(self):
+        fo = self.file.object
+        with fo.open() as f:
+            self.assertTrue(hasattr(f, 'fileno'))
+        with fo.open(0, 10) as f:
+            self.assertFalse(hasattr(f, 'fileno'))
+        request = RequestFactory().get(self.url)
+        res = blob_response(request, fo, 'application/octet-stream')
+        self.assertTrue(hasattr(res.file_to_stream, 'fileno'))
+
+        # 服务器只关闭 file_to_stream，同样发出 request_finished
+        finished = []
+
+        def receiver(**kwargs):
+            finished.append(1)
+
+        request_finished.disconnect(close_old_connections)
+        request_finished.connect(receiver)
+        try:
+            res.file_to_stream.close()
+        finally:
+            request_finished.disconnect(receiver)
+            request_finished.connect(close_old_connections)
+        self.assertEqual(finished, [1])
+        self.assertTrue(res.file_to_stream.file.closed)
+
+
+class InlineExecutor(Executor):
+    """在当前线程中执行，测试中的数据库事务对视图可见"""
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class AsgiTest(ShareTestCase):
+
+    def call(self, app, path, method='GET', chunks=(b'',), disconnect=False,
+             headers=()):
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'query_string': b'',
+                 'headers': [(b'host', b'testserver')] + list(headers)}
+        messages = [{'type': 'http.request', 'body': chunk,
+                     'more_body': i < len(chunks) - 1}
+                    for i, chunk in enumerate(chunks)]
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            while not (disconnect and len(sent) > 1):
+                await asyncio.sleep(0)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+            await asyncio.sleep(0)
+
+        loop = asyncio.new_event_loop()
+        request_started.disconnect(close_old_connections)
+        request_finished.disconnect(close_old_connections)
+        try:
+            loop.run_until_complete(app(scope, receive, send))
+        finally:
+            request_started.connect(close_old_connections)
+            request_finished.connect(close_old_connections)
+            loop.close()
+        return sent
+
+    @override_settings(STREAM_BLOCK_SIZE=100000)
+    def test_download(self):
+        # 比热点缓存的上限大，不会整个放在内存中
+        content = os.urandom(300000)
+        file = self.upload('a.bin', content)
+        Share.objects.create(target=file, code=None)
+        app = AsgiHandler(get_wsgi_application(), InlineExecutor())
+        sent = self.call(app, '/share/download/%s/' % file.pk)
+        self.assertEqual(sent[0]['status'], 200)
+        bodies = [x['body'] for x in sent[1:]]
+        self.assertEqual(b''.join(bodies), content)
+        self.assertEqual(len(bodies), 4)
+
+        sent = self.call(app, '/share/download/%s/' % file.pk,
+                         disconnect=True)
+        self.assertLess(len(sent), 5)
+
+    def test_request_body(self):
+        def echo(environ, start_response):
+            size = int(environ['CONTENT_LENGTH'])
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [environ['wsgi.input'].read(size)]
+
+        app = AsgiHandler(echo, InlineExecutor())
+        app.memory_size = 4
+        sent = self.call(app, '/', 'POST', [b'abc', b'def', b'ghi'])
+        self.assertEqual(sent[1]['body'], b'abcdefghi')
+
+    @override_settings(QUOTA_BYTES=1000)
+    def test_admission(self):
+        def app(environ, start_response):
+            raise AssertionError('the body should not be received')
+
+        app = AsgiHandler(app, InlineExecutor())
+        cookie = 'sessionid=%s' % self.client.cookies['sessionid'].value
+        sent = self.call(app, '/share/upload/', 'POST', [b'x' * 5000],
+                         headers=[(b'cookie', cookie.encode()),
+                                  (b'content-length', b'5000')])
+        self.assertEqual(sent[0]['status'], 413)
+        self.assertIn(b'quota exceeded', sent[1]['body'])
+
+
+class MetricsTest(ShareTestCase):
+
+    @override_settings(DEBUG=True)
+    def test_request_metrics(self):
+        file = self.upload('a.txt', b'hello')
+        with self.assertLogs('share.requests', 'INFO') as logs:
+            res = self.client.get('/share/download/%s/' % file.pk)
+        b''.join(res.streaming_content)
+        self.assertGreater(int(res['X-DB-Queries']), 0)
+        self.assertIn('"view": "share:download"', logs.output[0])
+
+        text = self.client.get('/share/metrics/').content.decode()
+        self.assertIn('share_request_db_queries_count{view="share:download"}',
+                      text)
+        self.assertIn('share_storage_bytes_total{direction="write"}', text)
+
+    def test_queries_counted_without_debug_cursor(self):
+        file = self.upload('a.txt', b'hello')
+        connection.queries_log.clear()
+        with self.assertLogs('share.requests', 'INFO') as logs:
+            self.client.get('/share/detail/%s/' % file.pk)
+        # 不记录SQL
+        self.assertEqual(len(connection.queries_log), 0)
+        self.assertGreater(json.loads(logs.records[0].getMessage())['queries'],
+                           0)
+        self.assertFalse(connection.force_debug_cursor)
+        self.assertNotIn('make_cursor', vars(connection))
+
+    def test_transfer_metrics(self):
+        downloaded = transfer_bytes.get(direction='download')
+        active = active_transfers.get(direction='download')
+        hits = upload_dedup.get(result='hit')
+        file = self.upload('a.txt', b'hello')
+        self.upload('b.txt', b'hello')
+        self.assertEqual(upload_dedup.get(result='hit'), hits + 1)
+        res = self.client.get('/share/download/%s/' % file.pk)
+        self.assertEqual(active_transfers.get(direction='download'),
+                         active + 1)
+        b''.join(res.streaming_content)
+        self.assertEqual(active_transfers.get(direction='download'), active)
+        self.assertEqual(transfer_bytes.get(direction='download'),
+                         downloaded + 5)
+        text = self.client.get('/share/metrics/').content.decode()
+        self.assertIn('share_storage_used_bytes{volume=', text)
+
+    def test_metrics_forbidden(self):
+        res = self.client.get('/share/metrics/', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(res.status_code, 403)
+
+
+class HotCacheTest(ShareTestCase):
+
+    def setUp(self):
+        super().setUp()
+        hot.clear()
+        self.file = self.upload('a.txt', b'hello world\n' * 100)
+        self.share = Share.objects.create(target=self.home, code=None)
+        self.client.logout()
+        self.url = '/share/download/%s/' % self.file.pk
+
+    def test_hot_download(self):
+        res = self.client.get(self.url)
+        self.assertEqual(b''.join(res.streaming_content),
+                         b'hello world\n' * 100)
+        hits = hot.stats()['hits']
+        with self.assertNumQueries(0):
+            res = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(hot.stats()['hits'], hits + 1)
+        self.assertEqual(res['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(res.content),
+                         b'hello world\n' * 100)
+        self.assertIn('a.txt', res['Content-Disposition'])
+
+    def test_hot_range(self):
+        self.client.get(self.url)
+        with self.assertNumQueries(0):
+            res = self.client.get(self.url, HTTP_RANGE='bytes=6-10',
+                                  HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(b''.join(res.streaming_content), b'world')
+
+    def test_invalidate(self):
+        self.client.get(self.url)
+        self.share.delete()
+        self.assertEqual(hot.stats()['entries'], 0)
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+
+    def test_other_process(self):
+        # 其它进程中的变化：只换掉了共享缓存中的版本号
+        self.client.get(self.url)
+        self.assertIsNotNone(hot.get((self.file.pk, 'download')))
+        Share.objects.filter(pk=self.share.pk).update(code='abcdef')
+        hot.shared().set(VERSION_KEY, 'other', None)
+        self.assertIsNone(hot.get((self.file.pk, 'download')))
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+
+    def test_expiring_share(self):
+        self.share.expire = timezone.now() - timedelta(seconds=1)
+        self.share.save()
+        Share.objects.create(target=self.file, code=None,
+                             expire=timezone.now() + timedelta(hours=1))
+        self.client.get(self.url)
+        self.assertEqual(hot.stats()['entries'], 1)
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    """测试用的S3替身，只实现存储后端用到的请求，不校验签名"""
+
+    objects = {}
+
+    def log_message(self, *args):
+        ...
+
+    def send(self, code, body=b'', headers=None):
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_PUT(self):
+        source = self.headers.get('x-amz-copy-source')
+        if source:
+            data = self.objects[source]
+        else:
+            data = self.rfile.read(int(self.headers['Content-Length']))
+        self.objects[self.path] = data
+        self.send(200)
+
+    def do_GET(self):
+        if '?' in self.path:
+            keys = sorted(k.split('/', 2)[2] for k in self.objects)
+            items = ''.join('<Contents><Key>%s</Key></Contents>' % k
+                            for k in keys)
+            body = '<ListBucketResult>%s</ListBucketResult>' % items
+            return self.send(200, body.encode())
+        data = self.objects.get(self.path)
+        if data is None:
+            return self.send(404)
+        range = self.headers.get('Range')
+        if range:
+            start, end = range[6:].split('-')
+            data = data[int(start):int(end) + 1 if end else None]
+            return self.send(206, data)
+        self.send(200, data)
+
+    def do_HEAD(self):
+        data = self.objects.get(self.path)
+        if data is None:
+            return self.send(404)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+
+    def do_DELETE(self):
+        self.objects.pop(self.path, None)
+        self.send(204)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class BackendTest(ShareTestCase):
+
+    def check_backend(self, backend):
+        writer = backend.create()
+        writer.write(b'0123456789')
+        writer.commit('ab/cd/abcdef')
+        self.assertEqual(backend.stat('ab/cd/abcdef')['size'], 10)
+        with backend.open('ab/cd/abcdef', 2, 5) as f:
+            self.assertEqual(f.read(), b'234')
+        self.assertIn(('ab/cd', ['abcdef']), list(backend.walk()))
+        backend.delete('ab/cd/abcdef')
+        self.assertIsNone(backend.stat('ab/cd/abcdef'))
+
+    def test_sharded(self):
+        volumes = [os.path.join(self.media_root, x) for x in 'abc']
+        backend = ShardedStorage(volumes)
+        self.check_backend(backend)
+        names = ['%02x/%040x' % (i, i) for i in range(60)]
+        for name in names:
+            writer = backend.create()
+            writer.write(b'x')
+            writer.commit(name)
+        counts = [sum(1 for _, files in v.walk() for _ in files)
+                  for v in backend.volumes]
+        self.assertTrue(all(counts), counts)
+
+        # 增加一个卷后，找不到的文件从其它卷上查找，然后重新平衡
+        backend = ShardedStorage(volumes + [self.media_root + '/d'])
+        self.assertTrue(all(backend.exists(x) for x in names))
+        self.assertTrue(0 < backend.rebalance() < 60)
+        self.assertTrue(all(backend.rank(x)[0].exists(x) for x in names))
+
+    def test_put(self):
+        backend = LocalStorage(self.media_root)
+        for content in [b'first', b'second']:
+            writer = backend.create()
+            writer.write(content)
+            writer.commit('ab/abcd')
+            self.assertFalse(os.path.exists(writer.name))
+        # 已经存在的文件不被覆盖
+        with backend.open('ab/abcd') as f:
+            self.assertEqual(f.read(), b'first')
+
+        # 跨文件系统时先复制到目标目录中，再改名
+        real_replace = os.replace
+        calls = []
+
+        def replace(src, dst):
+            calls.append(src)
+            if len(calls) == 1:
+                raise OSError(errno.EXDEV, 'cross-device link')
+            real_replace(src, dst)
+
+        writer = backend.create()
+        writer.write(b'moved')
+        with mock.patch('share.storage.os.replace', replace):
+            writer.commit('cd/cdef')
+        self.assertEqual(os.path.dirname(calls[1]),
+                         os.path.join(self.media_root, 'cd'))
+        self.assertFalse(os.path.exists(writer.name))
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'cd')),
+                         ['cdef'])
+
+    def test_s3(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeS3Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            endpoint = 'http://127.0.0.1:%s' % server.server_port
+            backend = S3Storage(endpoint, 'share', 'key', 'secret')
+            self.check_backend(backend)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_s3_timeout(self):
+        # 端点接受连接但不响应，请求在超时之后失败，不会一直阻塞
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        try:
+            endpoint = 'http://127.0.0.1:%s' % sock.getsockname()[1]
+            backend = S3Storage(endpoint, 'share', 'key', 'secret',
+                                timeout=0.2)
+            started = time.monotonic()
+            with self.assertRaises(OSError):
+                backend.stat('ab/abcd')
+            self.assertLess(time.monotonic() - started, 5)
+        finally:
+            sock.close()
+
+
+class CollectorTest(ShareTestCase):
+
+    def test_collect(self):
+        file = self.upload('a.txt', b'aaa')
+        fo = file.object
+        orphan = os.path.join(os.path.dirname(make_abspath(fo.path)), 'x')
+        with open(orphan, 'wb') as f:
+            f.write(b'12345')
+        partial = RegularFile.objects.create(
+            size=0, received=2, digest='', finished=False,
+            path=os.path.join(self.media_root, 'tmpabc'))
+        with open(partial.path, 'wb') as f:
+            f.write(b'12')
+        RegularFile.objects.filter(pk=partial.pk).update(
+            time=partial.time - timedelta(days=3))
+
+        stats = Collector(grace=timedelta(0)).run()
+        self.assertEqual(stats['orphan_files'], 1)
+        self.assertEqual(stats['partial_uploads'], 1)
+        self.assertEqual(stats['bytes'], 7)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertFalse(os.path.exists(partial.path))
+        self.assertTrue(os.path.exists(make_abspath(fo.path)))
+        self.assertEqual(RegularFile.objects.count(), 1)
+
+    def test_derived(self):
+        file = self.upload('a.txt', b'line\n' * 10)
+        digest = file.object.digest
+        get_window(file.object, mode='line', line=5)
+        index = make_abspath(index_name(digest))
+        self.assertTrue(os.path.exists(index))
+        stale = make_abspath(thumbnail_name('f' * 40, 64))
+        os.makedirs(os.path.dirname(stale))
+        with open(stale, 'wb') as f:
+            f.write(b'jpeg')
+        stats = Collector(grace=timedelta(0)).run()
+        self.assertEqual(stats['derived_files'], 1)
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(index))
+
+        # 删除文件时一起删除
+        delete_tree(file)
+        reclaim_blobs()
+        self.assertFalse(os.path.exists(index))
+
+
+class SqliteTest(ShareTestCase):
+
+    def test_pragmas(self):
+        path = os.path.join(self.media_root, 'test.sqlite3')
+        conn = DatabaseWrapper(dict(connection.settings_dict, NAME=path))
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode')
+                self.assertEqual(cursor.fetchone()[0], 'wal')
+                cursor.execute('PRAGMA synchronous')
+                self.assertEqual(cursor.fetchone()[0], 1)
+
+            # 事务开始时就取得写锁，其它连接不能再开始写事务
+            conn._start_transaction_under_autocommit()
+            other = sqlite3.connect(path, timeout=0)
+            with self.assertRaises(sqlite3.OperationalError):
+                other.execute('BEGIN IMMEDIATE')
+            other.close()
+        finally:
+            conn.close()
+
+    def test_upload_links(self):
+        a = self.upload('a.txt', b'aaa')
+        b = self.upload('b.txt', b'aaa')
+        fo = RegularFile.objects.get(pk=a.object_pk)
+        File.objects.create(name='c.txt', owner=self.user).link(fo)
+        self.assertEqual(RegularFile.objects.get(pk=fo.pk).links, 2)
+        self.assertEqual(self.home.object.size,
+                         len(':%s:%s' % (a.pk, b.pk)))
+
+
+class IndexTest(ShareTestCase):
+
+    def plan(self, qs):
+        sql, params = qs.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' | '.join(row[-1] for row in cursor.fetchall())
+
+    def test_query_plans(self):
+        plan = self.plan(File.objects.filter(
+            owner=self.user, name='alice', is_regular=False, parent=None))
+        self.assertIn('COVERING INDEX share_file_parent__a77131_idx', plan)
+
+        plan = self.plan(File.objects.filter(parent=self.home)
+                         .order_by('is_regular', 'name'))
+        self.assertIn('COVERING INDEX share_file_parent__a77131_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+        plan = self.plan(File.objects.filter(parent=self.home, name='a'))
+        self.assertIn('INDEX', plan)
+        self.assertNotIn('SCAN', plan)
+
+    def test_upload_same_name(self):
+        self.upload('a.txt', b'aaa')
+        handle_uploaded_file(SimpleUploadedFile('a.txt', b'bbb'),
+                             self.user, self.home)
+        handle_uploaded_file(SimpleUploadedFile('a.txt', b'ccc'),
+                             self.user, self.home)
+        names = File.objects.filter(parent=self.home).order_by('pk') \
+            .values_list('name', flat=True)
+        self.assertEqual(list(names), ['a.txt', 'a (1).txt', 'a (2).txt'])
+
+
+class HomeCacheTest(ShareTestCase):
+
+    def test_get_home(self):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        request.session = {}
+        with self.assertNumQueries(1):
+            home = get_home(request)
+        with self.assertNumQueries(0):
+            cached = get_home(request)
+        self.assertEqual(cached, home)
+        self.assertEqual(cached.object_pk, home.object_pk)
+        self.assertIsNone(cached.parent)
+        self.assertEqual(cached.owner, self.user)
+
+    def test_api(self):
+        res = self.client.post('/share/api/mkdir/', {'names': ['docs']})
+        self.assertTrue(res.json()['status'])
+        self.assertEqual(self.client.session['home'],
+                         [self.home.pk, self.home.object_pk])
+        res = self.client.post('/share/api/ls/', {'long': 'True'}).json()
+        self.assertEqual([x['name'] for x in res['output'][0]['alice']],
+                         ['docs'])
+        docs = File.objects.get(name='docs')
+        self.assertEqual(docs.parent, self.home)
+
+
+class UsageTest(ShareTestCase):
+
+    def test_add_concurrent_create(self):
+        # 更新时记录还不存在，创建之前并发的第一次写入已经创建了记录
+        Usage.objects.update_or_create(user=self.user,
+                                       defaults={'files': 1, 'physical': 0})
+        real_update = QuerySet.update
+        calls = []
+
+        def update(qs, **kwargs):
+            calls.append(1)
+            return 0 if len(calls) == 1 else real_update(qs, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', update):
+            Usage.add(self.user.pk, files=2, physical=10)
+        usage = Usage.objects.get(user=self.user)
+        self.assertEqual((usage.files, usage.physical), (3, 10))
+
+    def totals(self, name, parent=None):
+        parent = parent or self.home
+        if name == 'alice':
+            return File.objects.get(pk=self.home.pk).totals()
+        return File.objects.get(parent=parent, name=name).totals()
+
+    def usage(self):
+        usage = Usage.objects.get(user=self.user)
+        return usage.files, usage.logical, usage.physical
+
+    def test_incremental(self):
+        self.make_tree()
+        self.upload('c.txt', b'hello')
+        self.assertEqual(self.totals('alice'), (11, 3))
+        self.assertEqual(self.totals('src'), (6, 2))
+        src = File.objects.get(parent=self.home, name='src')
+        self.assertEqual(self.totals('sub', src), (3, 1))
+        self.assertEqual(self.usage(), (3, 11, 11))
+
+        # 复制不增加实际占用
+        self.client.post('/share/api/copy/', {'names': ['src'],
+                                              'target': 'src2'})
+        self.assertEqual(self.totals('src2'), (6, 2))
+        self.assertEqual(self.totals('alice'), (17, 5))
+        self.assertEqual(self.usage(), (5, 17, 11))
+
+        self.client.post('/share/api/move/', {'names': ['src2'],
+                                              'target': 'src/sub'})
+        self.assertEqual(self.totals('src'), (12, 4))
+        self.assertEqual(self.totals('sub', src), (9, 3))
+        self.assertEqual(self.totals('alice'), (17, 5))
+
+        # 删除原来的目录，文件对象还有复制的名字在使用
+        self.client.post('/share/api/move/', {'names': ['src/sub/src2'],
+                                              'target': '.'})
+        self.client.post('/share/api/rmdir/', {'names': ['src'],
+                                               'recursive': True})
+        self.assertEqual(self.usage(), (3, 11, 11))
+        self.client.post('/share/api/rmdir/', {'names': ['src2'],
+                                               'recursive': True})
+        self.assertEqual(self.totals('alice'), (5, 1))
+        self.assertEqual(self.usage(), (1, 5, 5))
+
+    def test_recount_and_api(self):
+        self.make_tree()
+        self.client.post('/share/api/copy/', {'names': ['src/a.txt'],
+                                              'target': 'a.txt'})
+        before = self.usage(), self.totals('alice'), self.totals('src')
+        Usage.objects.all().delete()
+        DirectoryFile.objects.update(total_size=0, total_files=0)
+        recount(apps)
+        self.assertEqual(
+            (self.usage(), self.totals('alice'), self.totals('src')), before)
+
+        res = self.client.post('/share/api/usage/').json()
+        self.assertEqual(res['output'],
+                         {'files': 3, 'logical': 9, 'physical': 6})
+        res = self.client.post('/share/api/ls/', {'long': 'True'}).json()
+        sizes = {x['name']: x['size'] for x in res['output'][0]['alice']}
+        self.assertEqual(sizes, {'src': 6, 'a.txt': 3})
+        res = self.client.get('/share/')
+        self.assertContains(res, '3 files, 9 bytes')
+        self.assertContains(res, 'stored: 6 bytes')
+
+    def test_recount_queries(self):
+        # 目录的统计批量写入，查询数与目录数无关
+        src = self.make_tree()
+        with CaptureQueriesContext(connection) as ctx:
+            recount(apps, [self.user.pk])
+        queries = len(ctx.captured_queries)
+        for i in range(10):
+            create_directory('d%d' % i, self.user, src)
+        with CaptureQueriesContext(connection) as ctx:
+            recount(apps, [self.user.pk])
+        self.assertEqual(len(ctx.captured_queries), queries)
+        self.assertEqual(self.totals('src'), (6, 2))
+
+
+class QuotaTest(ShareTestCase):
+
+    def post_upload(self, *files):
+        return self.client.post('/share/upload/', {
+            'next': '/share/list/%s/' % self.home.pk,
+            'files': [SimpleUploadedFile(name, content)
+                      for name, content in files]})
+
+    @override_settings(QUOTA_BYTES=1000)
+    def test_bytes(self):
+        res = self.post_upload(('a.txt', b'a' * 500))
+        self.assertEqual(res.status_code, 302)
+        # 在读取请求体之前按照Content-Length拒绝
+        res = self.post_upload(('b.txt', b'b' * 600))
+        self.assertEqual(res.status_code, 413)
+        self.assertEqual(RegularFile.objects.count(), 1)
+        self.assertEqual(Usage.objects.get(user=self.user).physical, 500)
+
+    @override_settings(QUOTA_BYTES=1000)
+    def test_enforced_when_writing(self):
+        # 没有经过 QuotaMiddleware 的上传，写入时同样检查
+        self.assertFalse(is_upload('POST', '/share/upload/x'))
+        self.assertEqual(self.post_upload(('a.txt', b'a')).status_code, 302)
+        with self.assertRaises(QuotaExceeded):
+            self.upload('b.txt', b'b' * 2000)
+        self.assertEqual(RegularFile.objects.count(), 1)
+        self.assertEqual(self.client.post('/share/upload/x', {}).status_code,
+                         404)
+
+    @override_settings(QUOTA_FILES=2)
+    def test_files(self):
+        self.upload('a.txt', b'a')
+        # 接收时发现第二个文件超过配额
+        res = self.post_upload(('b.txt', b'b'), ('c.txt', b'c'))
+        self.assertEqual(res.status_code, 413)
+        self.assertEqual(File.objects.filter(parent=self.home).count(), 1)
+
+        Usage.objects.filter(user=self.user).update(quota_files=3)
+        src = self.make_tree()
+        Usage.objects.filter(user=self.user).update(quota_files=4)
+        res = self.client.post('/share/api/copy/', {'names': ['src'],
+                                                    'target': 'src2'}).json()
+        self.assertFalse(res['status'])
+        self.assertIn('quota exceeded', res['errors'][0])
+        res = self.client.post('/share/api/copy/', {'names': ['src/a.txt'],
+                                                    'target': 'a2.txt'})
+        self.assertTrue(res.json()['status'])
+        self.assertEqual(src.totals(), (6, 2))
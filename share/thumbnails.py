@@ -0,0 +1,90 @@
+"""
+图片的缩略图
+
+缩略图按原图的校验和存放在存储的 .thumbs 目录中，内容相同的文件共用缩略图，
+原图被删除时一起删除（RegularFile.delete_blob，以及垃圾回收）。
+尺寸只能是 settings.THUMBNAIL_SIZES 中的某一档，缩略图在线程池中生成，
+上传图片后即开始生成，访问时还没有生成的，等待生成完成。
+"""
+
+import os
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+from django.conf import settings
+
+from .storage import storage
+from .metrics import cache_requests
+
+
+pool = None
+pending = {}
+lock = threading.Lock()
+
+
+def sizes():
+    return getattr(settings, 'THUMBNAIL_SIZES', (64, 256))
+
+
+def thumbnail_name(digest, size):
+    return os.path.join('.thumbs', str(size), digest[:2], digest + '.jpg')
+
+
+def thumbnail_names(digest):
+    """所有尺寸的缩略图的名字"""
+    return [thumbnail_name(digest, size) for size in sizes()]
+
+
+def make_thumbnail(fo, size):
+    """生成缩略图并保存到存储中，返回缩略图的名字"""
+    name = thumbnail_name(fo.digest, size)
+    if storage.exists(name):
+        return name
+    with fo.open() as f:
+        im = Image.open(BytesIO(f.read()))
+    # JPEG可以在解码时直接缩小，减少内存和CPU的消耗
+    im.draft('RGB', (size, size))
+    im = im.convert('RGB')
+    im.thumbnail((size, size), Image.LANCZOS)
+    writer = storage.create()
+    try:
+        im.save(writer.file, format='JPEG', quality=80, optimize=True)
+        writer.commit(name)
+    except Exception:
+        writer.abort()
+        raise
+    return name
+
+
+def submit(fo, size):
+    """在线程池中生成缩略图，相同的缩略图同一时间只生成一次"""
+    global pool
+    key = (fo.digest, size)
+    with lock:
+        if pool is None:
+            workers = getattr(settings, 'THUMBNAIL_WORKERS', 2)
+            pool = ThreadPoolExecutor(max_workers=workers)
+        future = pending.get(key)
+        if future is None:
+            future = pool.submit(make_thumbnail, fo, size)
+            pending[key] = future
+            future.add_done_callback(lambda _: pending.pop(key, None))
+    return future
+
+
+def generate_all(fo):
+    """上传图片之后，生成所有尺寸的缩略图"""
+    for size in sizes():
+        submit(fo, size)
+
+
+def get_thumbnail(fo, size, timeout=10):
+    """返回缩略图的名字，还没有生成的等待生成完成"""
+    name = thumbnail_name(fo.digest, size)
+    if storage.exists(name):
+        cache_requests.inc(cache='thumbnail', result='hit')
+        return name
+    cache_requests.inc(cache='thumbnail', result='miss')
+    return submit(fo, size).result(timeout)
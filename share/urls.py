@@ -12,9 +12,14 @@ urlpatterns = [
         views.list_dir, name='list_dir'),
     url(r'^detail/(?P<pk>[0-9]+)/$', views.detail, name='detail'),
     url(r'^view/(?P<pk>[0-9]+)/$', views.view, name='view'),
+    url(r'^preview/(?P<pk>[0-9]+)/$', views.preview, name='preview'),
     url(r'^download/(?P<pk>[0-9]+)/$', views.download, name='download'),
+    url(r'^thumbnail/(?P<pk>[0-9]+)/(?P<size>[0-9]+)/(?P<digest>[0-9a-f]+)/$',
+        views.thumbnail, name='thumbnail'),
     url(r'^edit/(?P<pk>[0-9]+)/$', views.edit, name='edit'),
     url(r'^delete/(?P<pk>[0-9]+)/$', views.delete, name='delete'),
+    url(r'^copy/(?P<pk>[0-9]+)/$', views.copy, name='copy'),
+    url(r'^move/(?P<pk>[0-9]+)/$', views.move, name='move'),
     url(r'^share/list/(?:page/(?P<page>[0-9]+)/)?$', views.list_shares, name='list_shares'),
     url(r'^share/create/(?P<pk>[0-9]+)/$', views.create_share, name='create_share'),
     url(r'^share/edit/(?P<pk>[0-9]+)/$', views.edit_share, name='edit_share'),
@@ -22,11 +27,16 @@ urlpatterns = [
     url(r'^post_code/(?P<pk>[0-9]+)/$', views.post_code, name='post_code'),
     url(r'^captcha/', views.gen_captcha, name='gen_captcha'),
     url(r'^search/', views.search, name='search'),
-    url(r'^upload/', views.upload, name='upload'),
+    url(r'^upload/$', views.upload, name='upload'),
+    url(r'^metrics/$', views.metrics, name='metrics'),
     url(r'^api/login/', api.login, name='api_login'),
     url(r'^api/inform_login/', api.inform_login, name='api_inform_login'),
     url(r'^api/ls/', api.ls, name='api_ls'),
     url(r'^api/mkdir/', api.mkdir, name='api_mkdir'),
     url(r'^api/rmdir/', api.rmdir, name='api_rmdir'),
     url(r'^api/exists/', api.exists, name='api_exists'),
+    url(r'^api/stat/', api.stat, name='api_stat'),
+    url(r'^api/usage/', api.usage, name='api_usage'),
+    url(r'^api/copy/', api.copy, name='api_copy'),
+    url(r'^api/move/', api.move, name='api_move'),
 ]
@@ -0,0 +1,76 @@
+"""
+重新计算存储使用量的统计：每个目录的 total_size/total_files，
+以及每个用户的 Usage。
+
+正常情况下这些统计随文件的增删增量地更新（File.add/remove，上传，删除），
+只有在直接写数据库（例如 generate_dataset.py）或者统计出错之后才需要重新计算。
+数据迁移中也使用这里的函数，所以模型通过 apps 取得。
+"""
+
+from django.db import transaction, connection
+
+from .libs import chunked
+
+
+def recount(apps, users=None):
+    """按用户逐个重新计算，users是用户的pk，默认所有拥有文件的用户"""
+    File = apps.get_model('share', 'File')
+    if users is None:
+        users = (File.objects.filter(parent=None).order_by('owner_id')
+                 .values_list('owner_id', flat=True).distinct())
+    for user_id in users:
+        recount_user(apps, user_id)
+
+
+def recount_user(apps, user_id):
+    File = apps.get_model('share', 'File')
+    DirectoryFile = apps.get_model('share', 'DirectoryFile')
+    RegularFile = apps.get_model('share', 'RegularFile')
+    Usage = apps.get_model('share', 'Usage')
+
+    with transaction.atomic():
+        rows = list(File.objects.filter(owner_id=user_id).values_list(
+            'pk', 'parent_id', 'object_pk', 'is_regular'))
+        sizes = {}
+        blobs = {x[2] for x in rows if x[3]}
+        for pks in chunked(blobs):
+            sizes.update(RegularFile.objects.filter(pk__in=pks)
+                         .values_list('pk', 'size'))
+
+        # 每个文件的大小加到所有的父目录上
+        parents = {pk: parent for pk, parent, _, _ in rows}
+        totals = {pk: [0, 0] for pk, _, _, regular in rows if not regular}
+        files = logical = 0
+        for pk, parent, object_pk, regular in rows:
+            if not regular:
+                continue
+            size = sizes.get(object_pk, 0)
+            files += 1
+            logical += size
+            while parent is not None:
+                totals[parent][0] += size
+                totals[parent][1] += 1
+                parent = parents.get(parent)
+
+        objects = {pk: object_pk for pk, _, object_pk, _ in rows}
+        update_totals(DirectoryFile, [
+            (size, count, objects[pk])
+            for pk, (size, count) in totals.items()])
+        Usage.objects.update_or_create(user_id=user_id, defaults={
+            'files': files, 'logical': logical,
+            'physical': sum(sizes.values())})
+
+
+def update_totals(DirectoryFile, params):
+    """
+    批量写入目录的统计，params是(total_size, total_files, pk)。
+    同一条UPDATE语句用executemany执行，不必每个目录一次ORM的update
+    """
+    meta = DirectoryFile._meta
+    quote = connection.ops.quote_name
+    sql = 'UPDATE %s SET %s = %%s, %s = %%s WHERE %s = %%s' % (
+        quote(meta.db_table), quote(meta.get_field('total_size').column),
+        quote(meta.get_field('total_files').column), quote(meta.pk.column))
+    with connection.cursor() as cursor:
+        for chunk in chunked(params, 5000):
+            cursor.executemany(sql, chunk)
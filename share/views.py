@@ -1,30 +1,41 @@
-import os
 import re
 import hashlib
-from io import BytesIO
-from tempfile import NamedTemporaryFile
 
+import magic
 from django.shortcuts import render, get_object_or_404
 from django import urls
 from django.urls import reverse
-from django.http import (HttpResponseRedirect, StreamingHttpResponse,
-                         HttpResponseBadRequest, HttpResponse, Http404)
+from django.http import (HttpResponseRedirect, HttpResponseBadRequest,
+                         HttpResponse, HttpResponseForbidden, Http404)
 from django.contrib import auth
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import UserCreationForm
 from django.conf import settings
+from django.db import transaction, IntegrityError
 from django.core.exceptions import ValidationError
-from django.utils import timezone
 from django.views.decorators.http import require_POST
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-
-from .forms import LoginForm, RenameForm, ShareForm, UploadForm
-from .models import DirectoryFile, RegularFile, File, Share
-from .libs import make_abspath, gen_code
-from .views_libs import (create_directory, get_session_id,
-                         get_session_data, set_session_data,
-                         share_approved, permission_ok, make_image, gentext,
-                         make_path, get_items)
+from django.contrib.staticfiles.templatetags.staticfiles import static
+
+from .forms import (LoginForm, RenameForm, ShareForm, UploadForm,
+                    TransferForm)
+from .models import DirectoryFile, RegularFile, File, Share, Usage
+from .libs import gen_code
+from .storage import storage, blob_path
+from .compression import choose_codec, suffixes, Encoder
+from .thumbnails import generate_all, get_thumbnail, sizes
+from .preview import get_window
+from . import captcha
+from .hotcache import hot, response as hot_response
+from .metrics import (render as render_metrics, track_upload,
+                      upload_dedup, magic_calls)
+from .views_libs import (create_directory, approve_share, share_approved, permission_ok,
+                         get_items, copy_tree, move_file, TransferError,
+                         delete_tree, blob_response, BlobResponse,
+                         child_exists, free_name, get_home,
+                         remember_home)
+from .api import transform_path, resolve_abspath
+from .quota import remaining, enforce, QuotaExceeded
 
 
 @login_required
@@ -32,9 +43,7 @@ def index(request, page=1):
     """
     用户主页，显示用户资源的相关链接：文件，共享。
     """
-    user = request.user
-    home = get_object_or_404(File, name=user.username, owner=user,
-                             is_regular=False, parent=None)
+    home = get_home(request)
     return list_dir(request, dir=home, page=page)
 
 
@@ -58,7 +67,12 @@ def list_dir(request, pk=None, dir=None, page=1):
         # 如果page超出范围，比如说9999, 就选择最后一页
         files = paginator.page(paginator.num_pages)
 
-    context = {'files': files, 'parents': parents, 'title': 'File list'}
+    total_size, total_files = dir.totals()
+    context = {'files': files, 'parents': parents, 'title': 'File list',
+               'total_size': total_size, 'total_files': total_files}
+    if dir.parent_id is None:
+        # 家目录，显示用户的使用量
+        context['usage'] = Usage.objects.filter(user=request.user).first()
     return render(request, 'share/list_dir.html', context=context)
 
 @require_POST
@@ -68,9 +82,7 @@ def post_code(request, pk):
         code = request.POST['code']
         for share, _ in file.shares():
             if share.code == code:
-                shares = get_session_data(request, 'shares') or []
-                shares.append(share.pk)
-                set_session_data(request, 'shares', shares)
+                approve_share(request, share)
                 url = reverse('share:detail', args=(pk,))
                 return HttpResponseRedirect(url)
         return HttpResponse('invalid code')
@@ -106,6 +118,12 @@ def detail(request, pk):
 
 def view(request, pk):
     """查看文件内容"""
+    anonymous = not request.user.is_authenticated()
+    if anonymous:
+        entry = hot.get((int(pk), 'view'))
+        if entry is not None:
+            return hot_response(request, entry)
+
     file = get_object_or_404(File, pk=pk)
     if file.is_regular and not file.object.finished:
         raise Http404('No File matches the given query')
@@ -115,18 +133,68 @@ def view(request, pk):
         return HttpResponseRedirect(url)
 
     if file.is_viewable():
-        abspath = make_abspath(file.object.path)
-        buf = open(abspath, 'rb')
-        response = StreamingHttpResponse(buf)
-        response['Content-Type'] = file.raw_mimetype()
-        return response
+        fo = file.object
+        content_type = file.raw_mimetype()
+        if anonymous and file.shared_to_all():
+            entry = hot.fill((file.pk, 'view'), file, fo, content_type)
+            if entry is not None:
+                return hot_response(request, entry)
+        return blob_response(request, fo, content_type)
     else:
         context = {'file': file, 'title': 'View file content'}
         return render(request, 'share/view.html', context=context)
 
 
+def preview(request, pk):
+    """分页预览大文本文件，每次只发送一个窗口的内容"""
+    file = get_object_or_404(File, pk=pk, is_regular=True)
+    if not file.object.finished:
+        raise Http404('No File matches the given query')
+
+    if not permission_ok(request, file):
+        url = reverse('share:login') + '?next=' + request.META['PATH_INFO']
+        return HttpResponseRedirect(url)
+
+    if file.mimetype() != 'text':
+        return HttpResponseBadRequest("Only a text file can be previewed.")
+
+    try:
+        mode = request.GET.get('mode', 'head')
+        offset = int(request.GET.get('offset', 0))
+        line = int(request.GET.get('line', 1)) - 1
+        size = int(request.GET.get('size', 0)) or None
+        if offset < 0 or line < 0 or (size is not None and size < 0):
+            raise ValueError(size)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid offset, line or size.")
+    window = get_window(file.object, mode, offset, line, size)
+
+    if request.GET.get('format') == 'raw':
+        response = HttpResponse(window['data'],
+                                content_type='text/plain; charset=utf-8')
+        response['X-Preview-Start'] = str(window['start'])
+        response['X-Preview-End'] = str(window['end'])
+        response['X-Preview-Size'] = str(window['size'])
+        return response
+
+    context = {'file': file, 'title': 'Preview file content',
+               'text': window['data'].decode('utf-8', 'replace'),
+               'start': window['start'], 'end': window['end'],
+               'size': window['size'],
+               'prev': max(window['start'] - window['window'], 0),
+               'has_prev': window['start'] > 0,
+               'has_next': window['end'] < window['size']}
+    return render(request, 'share/preview.html', context=context)
+
+
 def download(request, pk):
     """下载文件"""
+    anonymous = not request.user.is_authenticated()
+    if anonymous:
+        entry = hot.get((int(pk), 'download'))
+        if entry is not None:
+            return attachment(hot_response(request, entry), entry.name)
+
     file = get_object_or_404(File, pk=pk)
     if file.is_regular and not file.object.finished:
         raise Http404('No File matches the given query')
@@ -138,12 +206,43 @@ def download(request, pk):
     if not file.is_regular:
         return HttpResponseBadRequest("Only a regular file can be downloaded.")
 
-    abspath = make_abspath(file.object.path)
-    buf = open(abspath, 'rb')
-    response = StreamingHttpResponse(buf)
-    response['Content-Type'] = 'application/octet-stream'
-    response['Content-Length'] = str(file.object.size)
-    response['Content-Disposition'] = 'attachment;filename="%s"' % file.name
+    fo = file.object
+    content_type = 'application/octet-stream'
+    if anonymous and file.shared_to_all():
+        entry = hot.fill((file.pk, 'download'), file, fo, content_type)
+        if entry is not None:
+            return attachment(hot_response(request, entry), file.name)
+    return attachment(blob_response(request, fo, content_type), file.name)
+
+
+def attachment(response, name):
+    response['Content-Disposition'] = 'attachment;filename="%s"' % name
+    return response
+
+
+def thumbnail(request, pk, size, digest):
+    """图片的缩略图，URL中带有校验和，内容不会改变，可以永久缓存"""
+    file = get_object_or_404(File, pk=pk, is_regular=True)
+    fo = file.object
+    size = int(size)
+    if fo.digest != digest or not fo.finished or size not in sizes():
+        raise Http404('No File matches the given query')
+
+    if not permission_ok(request, file):
+        url = reverse('share:login') + '?next=' + request.META['PATH_INFO']
+        return HttpResponseRedirect(url)
+
+    try:
+        name = get_thumbnail(fo, size)
+    except Exception:
+        # 无法生成缩略图（不是图片，或者图片已损坏），显示类型图标
+        return HttpResponseRedirect(static('share/icons/image.png'))
+    response = BlobResponse(storage.open(name))
+    response['Content-Type'] = 'image/jpeg'
+    response['Content-Length'] = str(storage.stat(name)['size'])
+    scope = 'public' if file.shared_to_all() else 'private'
+    response['Cache-Control'] = '%s, max-age=31536000, immutable' % scope
+    response['ETag'] = '"%s-%s"' % (digest, size)
     return response
 
 
@@ -151,10 +250,9 @@ def download(request, pk):
 def list_shares(request, page=1):
     """查看所有的共享"""
     user = request.user
-    now = timezone.now()
-    shares = Share.objects.filter(target__owner=user)
-    shares = [x for x in shares if not x.is_expired()]
-    shares = sorted(shares, key=(lambda x: x.target.is_regular))
+    shares = Share.objects.live().filter(target__owner=user)
+    shares = shares.select_related('target').order_by('target__is_regular',
+                                                      'pk')
 
     # 分页
     paginator = Paginator(shares, settings.PAGE_SIZE)
@@ -283,28 +381,90 @@ def edit(request, pk):
         form = RenameForm(request.POST)
         if form.is_valid():
             name = form.cleaned_data['name']
-            file.name = name
-            file.save()
-            return HttpResponseRedirect(reverse('share:detail', args=(pk,)))
+            if name != file.name and child_exists(file.parent, name):
+                form.add_error('name', 'file exists: %s' % name)
+            else:
+                old_name, file.name = file.name, name
+                try:
+                    with transaction.atomic():
+                        file.save()
+                except IntegrityError:
+                    # 检查之后，并发的请求创建了同名的文件
+                    file.name = old_name
+                    form.add_error('name', 'file exists: %s' % name)
+                else:
+                    return HttpResponseRedirect(reverse('share:detail',
+                                                        args=(pk,)))
     else:
         form = RenameForm({'name': file.name})
     context = {'form': form, 'title': 'Edit file'}
     return render(request, 'share/edit.html', context=context)
 
 
+@login_required
+def copy(request, pk):
+    """复制文件或目录树"""
+    return transfer(request, pk, 'Copy')
+
+
+@login_required
+def move(request, pk):
+    """移动文件或目录树"""
+    return transfer(request, pk, 'Move')
+
+
+def transfer(request, pk, operation):
+    user = request.user
+    file = get_object_or_404(File, pk=pk, owner=user)
+    if file.is_regular and not file.object.finished:
+        raise Http404('No File matches the given query')
+
+    if request.method == 'POST':
+        form = TransferForm(request.POST)
+        if form.is_valid():
+            home = get_home(request)
+            target = form.cleaned_data['target']
+            name = form.cleaned_data['name'] or None
+            abspath = transform_path(target, home)
+            dest = abspath and resolve_abspath(abspath, home)
+            if not dest or dest.is_regular:
+                form.add_error('target', 'no such directory: %s' % target)
+            else:
+                try:
+                    if operation == 'Copy':
+                        copy_tree(file, dest, user, name)
+                    else:
+                        move_file(file, dest, name)
+                except (TransferError, QuotaExceeded) as e:
+                    form.add_error(None, str(e))
+                else:
+                    url = reverse('share:list_dir', args=(dest.pk,))
+                    return HttpResponseRedirect(url)
+    else:
+        parent = file.parent.abspath() if file.parent else ''
+        form = TransferForm(initial={'target': parent})
+    context = {'form': form, 'file_name': file.name,
+               'operation': operation, 'title': '%s file' % operation}
+    return render(request, 'share/transfer.html', context=context)
+
+
 @login_required
 def delete(request, pk):
     """删除文件"""
-    file = get_object_or_404(File, pk=pk)
+    file = get_object_or_404(File, pk=pk, owner=request.user)
     if file.is_regular and not file.object.finished:
         raise Http404('No File matches the given query')
 
-    if not file.is_regular:
-        return HttpResponseBadRequest("Only a regular file can be deleted.")
+    if file.parent is None:
+        return HttpResponseBadRequest("The home directory can not be deleted.")
 
     if request.method == 'POST':
         if request.POST.get('submit', '') == 'Delete':
-            file.unlink()
+            # 目录会连同其中所有的子目录和文件一起删除
+            try:
+                delete_tree(file)
+            except TransferError as e:
+                return HttpResponseBadRequest(str(e))
             next_url = request.POST['next']
             return HttpResponseRedirect(next_url)
     next_url = request.META['HTTP_REFERER']
@@ -321,10 +481,7 @@ def login(request):
         form = LoginForm(request.POST)
         if form.is_valid():
             # 先对比验证码，在校验用户名字和密码
-            posted_captcha = form.cleaned_data['captcha']
-            saved_captcha = get_session_data(request, 'captcha')
-            if (saved_captcha is not None
-                    and posted_captcha.lower() == saved_captcha):
+            if captcha.verify(request, form.cleaned_data['captcha']):
                 username = form.cleaned_data['username']
                 password = form.cleaned_data['password']
                 user = auth.authenticate(username=username, password=password)
@@ -354,6 +511,7 @@ def signup(request):
             raw_password = form.cleaned_data.get('password1')
             user = auth.authenticate(username=username, password=raw_password)
             auth.login(request, user)
+            remember_home(request, home)
             return HttpResponseRedirect(reverse('share:index'))
     else:
         form = UserCreationForm()
@@ -363,14 +521,11 @@ def signup(request):
 
 def gen_captcha(request):
     """ 生成验证码图片 """
-    text = gentext(4)
-    # 把验证码内容存到session中
-    set_session_data(request, 'captcha', text.lower())
-    im = make_image(text)
-    imgout = BytesIO()
-    im.save(imgout, format='png')
-    img_bytes = imgout.getvalue()
-    return HttpResponse(img_bytes, content_type='image/png')
+    text, img_bytes = captcha.pool.get()
+    captcha.remember(request, text)
+    response = HttpResponse(img_bytes, content_type='image/png')
+    response['Cache-Control'] = 'no-store'
+    return response
 
 
 @login_required
@@ -406,15 +561,22 @@ def search(request):
 @login_required
 def upload(request):
     if request.method == 'POST':
+        # 超过配额时，share.quota 在接收的过程中停止接收
         form = UploadForm(request.POST, request.FILES)
+        if getattr(request, 'quota_error', None):
+            return HttpResponse(request.quota_error, status=413)
         next_url = request.POST['next']
         if form.is_valid():
             pk = urls.resolve(next_url).kwargs['pk']
             user = request.user
             dir = get_object_or_404(File, pk=pk, owner=user)
             files = request.FILES.getlist('files')
-            for file in files:
-                handle_uploaded_file(file, user, dir)
+            try:
+                for file in files:
+                    with track_upload(file.size):
+                        handle_uploaded_file(file, user, dir)
+            except QuotaExceeded as e:
+                return HttpResponse(str(e), status=413)
             return HttpResponseRedirect(next_url)
     else:
         form = UploadForm()
@@ -428,31 +590,89 @@ def upload(request):
 
 
 def handle_uploaded_file(ufile, owner, dir):
-    time = timezone.now()
-    store_dir = make_path(time)
-    store_dir = os.path.join(settings.MEDIA_ROOT, store_dir)
-    os.makedirs(store_dir, mode=0o755, exist_ok=True)
-    tmpfile = NamedTemporaryFile(dir=store_dir, delete=False)
+    # 超过配额时抛出QuotaExceeded，已经接收的数据被丢弃
+    left = remaining(owner.pk)
+    enforce(left, files=1)
+    writer = storage.create()
 
     # 接收数据
     fo = RegularFile.objects.create(size=0, received=0, digest='',
-                                     path=tmpfile.name, finished=False)
+                                     path=writer.name, finished=False)
     read = 0
     hash = hashlib.sha1()
-    for chunk in ufile.chunks(chunk_size=512):
-        tmpfile.write(chunk)
-        hash.update(chunk)
-        read += len(chunk)
-        fo.received = read
-    fo.size = read
-    fo.digest = hash.hexdigest()
-    fo.path = make_path(time, fo.digest)
-    fo.finished = True
-    abspath = os.path.join(settings.MEDIA_ROOT, fo.path)
-    os.rename(tmpfile.name, abspath)
-    fo.save()
-
-    # 链接，加入目录
-    file = File.objects.create(name=ufile.name, owner=owner)
-    file.link(fo)
-    dir.add(file)
+    # 先缓存开头的一段数据，据此决定是否压缩存储
+    sample = b''
+    sample_size = getattr(settings, 'COMPRESSION_SAMPLE_SIZE', 64 * 1024)
+    encoder = None
+    try:
+        for chunk in ufile.chunks(chunk_size=512):
+            hash.update(chunk)
+            read += len(chunk)
+            enforce(left, read, 1)
+            fo.received = read
+            if encoder is None:
+                sample += chunk
+                if len(sample) >= sample_size:
+                    mime, encoder = make_encoder(fo, sample, ufile.size)
+                    writer.write(encoder.compress(sample))
+            else:
+                writer.write(encoder.compress(chunk))
+        if encoder is None:
+            mime, encoder = make_encoder(fo, sample, ufile.size)
+            writer.write(encoder.compress(sample))
+        writer.write(encoder.flush())
+        fo.size = read
+        fo.digest = hash.hexdigest()
+        fo.path = blob_path(fo.digest, fo.time,
+                            suffix=suffixes.get(fo.codec, ''))
+        # 先在数据库中记录最终的路径，再检查和写入存储。删除文件的一方
+        # （reclaim_blobs）在写事务中检查路径是否还被引用，
+        # 要么看到这条记录而保留文件，要么在这之前已经删除完，这里重新写入
+        RegularFile.objects.filter(pk=fo.pk).update(path=fo.path)
+        exists = storage.exists(fo.path)
+        upload_dedup.inc(result='hit' if exists else 'miss')
+        if exists:
+            # 相同内容的文件已经存在，不再写入（S3上不必重新上传）
+            writer.abort()
+        else:
+            writer.commit(fo.path)
+    except Exception:
+        writer.abort()
+        fo.delete()
+        raise
+    # 完成，链接，加入目录，在一个事务中写入
+    for attempt in range(3):
+        try:
+            with transaction.atomic():
+                fo.finished = True
+                fo.save()
+                # 与目录中已有的文件重名时，改用 名字 (n).扩展名
+                file = File.objects.create(name=free_name(dir, ufile.name),
+                                           owner=owner, parent=dir)
+                file.link(fo)
+                Usage.add(owner.pk, physical=fo.size)
+                dir.add(file)
+            break
+        except IntegrityError:
+            # 并发的上传用了同一个名字，重新选择名字
+            if attempt == 2:
+                raise
+    if mime.startswith('image/'):
+        generate_all(fo)
+
+
+def make_encoder(fo, sample, size=None):
+    magic_calls.inc()
+    mime = magic.Magic(mime=True).from_buffer(sample)
+    fo.mime = mime
+    fo.codec = choose_codec(mime, sample, size)
+    return mime, Encoder(fo.codec)
+
+
+def metrics(request):
+    """运行指标，Prometheus的文本格式，只允许管理员及指定的地址访问"""
+    allowed = getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1'])
+    if not (request.user.is_staff or request.META['REMOTE_ADDR'] in allowed):
+        return HttpResponseForbidden('forbidden')
+    return HttpResponse(render_metrics(),
+                        content_type='text/plain; version=0.0.4')
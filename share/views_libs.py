@@ -1,41 +1,78 @@
 import os
+import re
 import string
 import random
+import threading
+from collections import Counter, defaultdict
+from functools import lru_cache
 
 from PIL import Image, ImageDraw, ImageFont
 from django.conf import settings
+from django.db import transaction, connection, IntegrityError
+from django.db.models import F
+from django.http import HttpResponse, FileResponse
+from django.shortcuts import get_object_or_404
 
-from .models import DirectoryFile, File
+from .models import DirectoryFile, RegularFile, File, Share, Reclaim, Usage
+from .libs import chunked
+from .storage import storage, block_size
+from .compression import accepts
+from .metrics import Transfer
+from . import quota
 
 
 def create_directory(name, owner):
-    fo = DirectoryFile.objects.create()
-    dir = File.objects.create(name=name, owner=owner, is_regular=False)
-    dir.link(fo)
+    with transaction.atomic():
+        fo = DirectoryFile.objects.create()
+        dir = File.objects.create(name=name, owner=owner, is_regular=False,
+                                  object_pk=fo.pk)
     return dir
 
 
-def get_session_id(request):
-    name = settings.SESSION_COOKIE_NAME
-    sid = request.COOKIES.get(name)
-    if sid is None:
-        request.session.create()
-        sid = request.session.session_key
-    return sid
+def get_home(request):
+    """
+    登录用户的家目录。第一次查询之后，pk和object_pk保存在session中，
+    之后直接构造File对象，不再查询数据库
+    """
+    user = request.user
+    cached = request.session.get('home')
+    if cached:
+        pk, object_pk = cached
+        home = File.from_db(None, ['id', 'name', 'owner_id', 'parent_id',
+                                   'object_pk', 'is_regular'],
+                            [pk, user.username, user.pk, None, object_pk,
+                             False])
+        home.owner = user
+        return home
+    home = get_object_or_404(File, owner=user, name=user.username,
+                             is_regular=False, parent=None)
+    remember_home(request, home)
+    return home
 
 
-def get_session_data(request, key, sid=None):
-    if sid is None:
-        sid = get_session_id(request)
-    return request.session.get(sid, {}).get(key)
+def remember_home(request, home):
+    request.session['home'] = [home.pk, home.object_pk]
 
 
-def set_session_data(request, key, data, sid=None):
-    if sid is None:
-        sid = get_session_id(request)
-    sdata = request.session.get(sid, {})
-    sdata[key] = data
-    request.session[sid] = sdata
+def get_session_data(request, key):
+    return request.share_state.get(key)
+
+
+def set_session_data(request, key, data):
+    if data is None:
+        request.share_state.pop(key, None)
+    else:
+        request.share_state[key] = data
+
+
+def approve_share(request, share):
+    """记录已经通过分享码验证的共享，只保留最近的若干个"""
+    shares = get_session_data(request, 'shares') or []
+    if share.pk in shares:
+        shares.remove(share.pk)
+    shares.append(share.pk)
+    limit = getattr(settings, 'SHARE_STATE_MAX_APPROVALS', 32)
+    set_session_data(request, 'shares', shares[-limit:])
 
 
 def share_approved(request, file):
@@ -54,6 +91,17 @@ def permission_ok(request, file):
             or (file.shared_with_code() and share_approved(request, file)))
 
 
+@lru_cache(maxsize=None)
+def load_font(font_size):
+    """ 加载验证码使用的字体，每个进程只加载一次 """
+    font_path_relative = 'share/fonts/ubuntu.ttf'
+    font_path = os.path.join(settings.STATIC_ROOT, font_path_relative)
+    if not os.path.exists(font_path):
+        font_path = os.path.join(os.path.dirname(__file__), 'static',
+                                 font_path_relative)
+    return ImageFont.truetype(font_path, font_size)
+
+
 def make_image(char):
     """ 生成验证码图片 """
     im_size = (70, 40)
@@ -61,11 +109,7 @@ def make_image(char):
     bg = (0, 0, 0)
     offset = (1, 1)
     im = Image.new('RGB', size=im_size, color=bg)
-    font_path_relative = 'share/fonts/ubuntu.ttf'
-    font_path = os.path.join(settings.STATIC_ROOT, font_path_relative)
-    if not os.path.exists(font_path):
-        font_path = os.path.join('share/static', font_path_relative)
-    font = ImageFont.truetype(font_path, font_size)
+    font = load_font(font_size)
     draw = ImageDraw.ImageDraw(im)
     draw.text(offset, char, fill='yellow', font=font)
     im = im.transform(im_size, Image.AFFINE, (1, -0.3, 0, -0.1, 1, 0), Image.BILINEAR)
@@ -78,13 +122,10 @@ def gentext(n):
     return ''.join([random.choice(chars) for i in range(n)])
 
 
-def make_path(time, digest=''):
-    return os.path.join(time.strftime('%Y%m%d'), digest)
-
-
 def get_items(dir):
     # 列出目錄下的內容，就是子目錄和文件，同時返回所有父目錄
-    files = records_from_ids(dir.object.subdirs + dir.object.files)
+    fo = dir.object
+    files = records_from_ids(fo.subdirs + fo.files)
     parents = [dir]
     while dir.parent:
         parents.append(dir.parent)
@@ -99,5 +140,390 @@ def records_from_ids(ids):
     if not ids:
         return []
     ids = [int(id) for id in ids.strip(':').split(':')]
-    files = File.objects.filter(pk__in=ids).order_by('is_regular', 'name')
+    files = []
+    for pks in chunked(ids):
+        files.extend(File.objects.filter(pk__in=pks))
+    files.sort(key=lambda f: (f.is_regular, f.name))
+    load_objects(files)
     return [f for f in files if getattr(f.object, 'finished', True)]
+
+
+def load_objects(files):
+    """批量读取File指向的文件对象，之后访问file.object不再查询数据库"""
+    for is_regular, model in ((True, RegularFile), (False, DirectoryFile)):
+        pks = [f.object_pk for f in files if f.is_regular == is_regular]
+        objs = {}
+        for chunk in chunked(pks):
+            objs.update(model.objects.in_bulk(chunk))
+        for f in files:
+            if f.is_regular == is_regular and f.object_pk in objs:
+                f._object = objs[f.object_pk]
+
+
+def is_ancestor(node, other):
+    """判断node是否是other本身或者other的某一级父目录"""
+    while other is not None:
+        if other.pk == node.pk:
+            return True
+        other = other.parent
+    return False
+
+
+def child_exists(dir, name):
+    return File.objects.filter(parent=dir, name=name).exists()
+
+
+def free_name(dir, name):
+    """目录中没有被使用的名字：name本身，或者 名字 (n).扩展名"""
+    stem, dot, ext = name.rpartition('.')
+    if not stem:
+        stem, dot, ext = ext, '', ''
+    taken = set(File.objects.filter(parent=dir, name__startswith=stem)
+                .values_list('name', flat=True))
+    n = 1
+    candidate = name
+    while candidate in taken:
+        candidate = '%s (%d)%s%s' % (stem, n, dot, ext)
+        n += 1
+    return candidate
+
+
+class TransferError(ValueError):
+    """复制或者移动的目标不合法"""
+
+
+def check_transfer(file, dest, name, operation):
+    if dest.is_regular:
+        raise TransferError("destination is not a directory")
+    if is_ancestor(file, dest):
+        raise TransferError("cannot %s %s to a subdirectory of itself"
+                            % (operation, file.name))
+    if child_exists(dest, name):
+        raise TransferError("file exists: %s" % name)
+
+
+def move_file(file, dest, name=None):
+    """把文件或者目录移动到目录dest中，只修改数据库记录"""
+    name = name or file.name
+    if file.parent is None:
+        raise TransferError("cannot move the home directory")
+    check_transfer(file, dest, name, 'move')
+
+    parent, old_name = file.parent, file.name
+    try:
+        with transaction.atomic():
+            file.parent.remove(file)
+            file.name = name
+            dest.add(file)
+    except IntegrityError:
+        # 检查之后，并发的请求在dest中创建了同名的文件
+        file.parent, file.name = parent, old_name
+        raise TransferError("file exists: %s" % name)
+    return file
+
+
+def copy_tree(src, dest, owner, name=None):
+    """
+    复制文件或者整个目录树到目录dest中。
+    只创建File/DirectoryFile记录，并批量增加RegularFile的链接数，
+    不读写任何文件内容。返回新建的文件或者目录。
+    """
+    name = name or src.name
+    check_transfer(src, dest, name, 'copy')
+    quota.enforce(quota.remaining(owner.pk), files=src.totals()[1])
+
+    try:
+        return _copy_tree(src, dest, owner, name)
+    except IntegrityError:
+        # 检查之后，并发的请求在dest中创建了同名的文件
+        raise TransferError("file exists: %s" % name)
+
+
+def _copy_tree(src, dest, owner, name):
+    with transaction.atomic():
+        blob_links = Counter()
+        new_dirs = []
+        level = [(src, dest, name)]
+        root = None
+        while level:
+            regs = []
+            dir_map = {}    # 源目录的pk -> 新目录
+            # 新目录的统计与源目录相同
+            totals = {}
+            for pks in chunked(x[0].object_pk for x in level
+                               if not x[0].is_regular):
+                totals.update((pk, (size, files)) for pk, size, files in
+                              DirectoryFile.objects.filter(pk__in=pks)
+                              .values_list('pk', 'total_size', 'total_files'))
+            for node, parent, node_name in level:
+                if node.is_regular:
+                    new = File(name=node_name, owner=owner, parent=parent,
+                               object_pk=node.object_pk)
+                    regs.append(new)
+                    blob_links[node.object_pk] += 1
+                else:
+                    size, files = totals.get(node.object_pk, (0, 0))
+                    fo = DirectoryFile.objects.create(total_size=size,
+                                                      total_files=files)
+                    new = File.objects.create(name=node_name, owner=owner,
+                                              parent=parent, is_regular=False,
+                                              object_pk=fo.pk)
+                    dir_map[node.pk] = new
+                    new_dirs.append(new)
+                if root is None:
+                    root = new
+            File.objects.bulk_create(regs)
+
+            # 同一层的所有目录的子节点，一次查询取出
+            level = []
+            for pks in chunked(dir_map):
+                for child in File.objects.filter(parent__in=pks):
+                    level.append((child, dir_map[child.parent_id], child.name))
+
+        # 链接数相同的文件对象合并为一条UPDATE语句
+        groups = defaultdict(list)
+        for pk, count in blob_links.items():
+            groups[count].append(pk)
+        for count, pks in groups.items():
+            for chunk in chunked(pks):
+                RegularFile.objects.filter(pk__in=chunk).update(
+                    links=F('links') + count)
+
+        rebuild_listings(new_dirs)
+        if root.is_regular:
+            root = File.objects.get(parent=dest, name=name)
+        dest.add(root)
+    return root
+
+
+def rebuild_listings(dirs):
+    """根据File.parent重新生成目录的subdirs/files字段"""
+    listings = {dir.pk: {'subdirs': [], 'files': []} for dir in dirs}
+    for pks in chunked(listings):
+        qs = File.objects.filter(parent__in=pks)
+        for parent_pk, pk, is_regular in qs.values_list(
+                'parent_id', 'pk', 'is_regular'):
+            key = 'files' if is_regular else 'subdirs'
+            listings[parent_pk][key].append(':%s' % pk)
+    for dir in dirs:
+        subdirs = ''.join(listings[dir.pk]['subdirs'])
+        files = ''.join(listings[dir.pk]['files'])
+        DirectoryFile.objects.filter(pk=dir.object_pk).update(
+            subdirs=subdirs, files=files, size=len(subdirs) + len(files))
+
+
+class TreeChanged(Exception):
+    """删除目录树的过程中有文件加入了这棵树"""
+
+
+def delete_tree(file):
+    """
+    递归删除文件或者整个目录树。
+    一次遍历收集整棵树，批量删除记录，批量减少RegularFile的链接数，
+    链接数降为0的文件放入回收队列，由reclaim_blobs在请求之外删除。
+    收集和删除在同一个事务中，期间有文件加入这棵树时重新收集。
+    """
+    for _ in range(3):
+        try:
+            with transaction.atomic():
+                _delete_tree(file)
+            return
+        except TreeChanged:
+            continue
+    raise TransferError('directory is changing')
+
+
+def collect_tree(file):
+    """返回(从上到下每一层的File的pk, 目录的DirectoryFile的pk, RegularFile的pk: 链接数)"""
+    levels = [[file.pk]]
+    dir_objs = []
+    blob_links = Counter()
+    if file.is_regular:
+        blob_links[file.object_pk] += 1
+        return levels, dir_objs, blob_links
+
+    dir_objs.append(file.object_pk)
+    level = [file.pk]
+    while level:
+        next_level = []
+        for pks in chunked(level):
+            qs = File.objects.filter(parent__in=pks)
+            for pk, is_regular, object_pk in qs.values_list(
+                    'pk', 'is_regular', 'object_pk'):
+                next_level.append(pk)
+                if is_regular:
+                    blob_links[object_pk] += 1
+                else:
+                    dir_objs.append(object_pk)
+        if next_level:
+            levels.append(next_level)
+        level = next_level
+    return levels, dir_objs, blob_links
+
+
+def _delete_tree(file):
+    levels, dir_objs, blob_links = collect_tree(file)
+    if file.parent:
+        file.parent.remove(file)
+
+    # 从最深的一层开始删除，避免级联删除时再去查询子节点。
+    # 删除一层之前它的子节点应该都已经删除，否则是收集之后新加入的
+    # （数据库不在事务开始时加写锁时），级联删除会漏掉链接数和回收队列
+    for level in levels[::-1]:
+        for pks in chunked(level):
+            if File.objects.filter(parent__in=pks).exists():
+                raise TreeChanged(file.pk)
+            Share.objects.filter(target__in=pks).delete()
+            File.objects.filter(pk__in=pks).delete()
+    for pks in chunked(dir_objs):
+        DirectoryFile.objects.filter(pk__in=pks).delete()
+
+    groups = defaultdict(list)
+    for pk, count in blob_links.items():
+        groups[count].append(pk)
+    for count, pks in groups.items():
+        for chunk in chunked(pks):
+            RegularFile.objects.filter(pk__in=chunk).update(
+                links=F('links') - count)
+
+    freed = 0
+    for pks in chunked(blob_links):
+        qs = RegularFile.objects.filter(pk__in=pks, links__lte=0)
+        items = [Reclaim(path=fo.path, size=fo.size) for fo in qs]
+        Reclaim.objects.bulk_create(items)
+        freed += sum(x.size for x in items)
+        qs.delete()
+    if freed:
+        Usage.add(file.owner_id, physical=-freed)
+    transaction.on_commit(start_reclaimer)
+
+
+def reclaim_blobs(limit=None):
+    """从文件系统上删除回收队列中的文件，返回删除的文件数和字节数"""
+    count = 0
+    size = 0
+    qs = Reclaim.objects.order_by('pk')
+    if limit:
+        qs = qs[:limit]
+    for item in qs:
+        # 同一路径可能被新的RegularFile记录重新使用（相同内容的文件），
+        # 检查和删除在一个事务中，与上传时记录路径串行执行
+        with transaction.atomic():
+            if (not RegularFile.objects.filter(path=item.path).exists()
+                    and storage.exists(item.path)):
+                RegularFile.delete_blob(item.path)
+                count += 1
+                size += item.size
+            item.delete()
+    return count, size
+
+
+reclaimer_lock = threading.Lock()
+
+
+def start_reclaimer():
+    """在后台线程中处理回收队列，同一时间最多只有一个线程在运行"""
+
+    def run():
+        try:
+            while Reclaim.objects.exists():
+                reclaim_blobs(limit=1000)
+        finally:
+            connection.close()
+            reclaimer_lock.release()
+
+    if reclaimer_lock.acquire(blocking=False):
+        threading.Thread(target=run, daemon=True).start()
+
+
+class BlobResponse(FileResponse):
+    """
+    按照 STREAM_BLOCK_SIZE 的块大小读取文件。WSGI服务器提供了
+    wsgi.file_wrapper 时，由服务器发送文件，本地文件可以使用sendfile。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.file_to_stream is not None:
+            self.file_to_stream = ClosingFile(self.file_to_stream, self)
+
+    @property
+    def block_size(self):
+        return block_size()
+
+
+class ClosingFile:
+    """
+    Django 1.11 的 WSGIHandler 把 file_to_stream 交给 wsgi.file_wrapper 时，
+    服务器只关闭这个文件，不调用 response.close()，request_finished 信号
+    （close_old_connections 等）不会发出；也不传递 block_size，
+    此时每次读取的数据量由服务器决定。关闭这个文件时关闭整个响应。
+    """
+
+    def __init__(self, file, response):
+        self.file = file
+        self.response = response
+        self.read = file.read
+        if hasattr(file, 'fileno'):
+            self.fileno = file.fileno
+
+    def close(self):
+        self.response.close()
+
+
+def parse_range(header, size):
+    """
+    解析Range头，只支持单个范围，返回[start, end)。
+    没有Range头，不支持的格式，或者语法无效的范围（如 bytes=5-3，
+    按RFC 7233忽略，发送整个文件）返回None；范围不能满足时返回(size, size)。
+    """
+    m = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if not m or m.groups() == ('', ''):
+        return None
+    first, last = m.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        end = min(int(last) + 1, size) if last else size
+    else:
+        start = max(size - int(last), 0)
+        end = size
+    if start >= end:
+        return size, size
+    return start, end
+
+
+def blob_response(request, fo, content_type):
+    """
+    发送文件的内容。压缩存储的文件，如果客户端接受该压缩方式，
+    就直接发送压缩的数据，否则边读边解压。
+    支持单个范围的Range请求，范围是针对原始内容的，此时不发送压缩的数据。
+    """
+    header = request.META.get('HTTP_RANGE', '')
+    range = header and parse_range(header, fo.size)
+    if range:
+        start, end = range
+        if start >= end:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%s' % fo.size
+            return response
+        # 读到文件末尾时不指定end，本地文件可以用sendfile发送
+        f = fo.open(start, end if end < fo.size else None)
+        length = end - start
+        response = BlobResponse(Transfer(f, length), status=206)
+        response['Content-Range'] = 'bytes %s-%s/%s' % (start, end - 1,
+                                                        fo.size)
+    elif fo.codec and accepts(request, fo.codec):
+        length = storage.stat(fo.path)['size']
+        response = BlobResponse(Transfer(storage.open(fo.path), length))
+        response['Content-Encoding'] = fo.codec
+    else:
+        length = fo.size
+        response = BlobResponse(Transfer(fo.open(), length))
+    response['Content-Length'] = str(length)
+    if fo.codec:
+        response['Vary'] = 'Accept-Encoding'
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Type'] = content_type
+    return response